@@ -0,0 +1,155 @@
+# 卡片和云文档构建函数的性能测试，与保存的基线对比，任一用例变慢超过阈值时返回非0：
+# python benchmarks/bench_builders.py                 对比benchmarks/baseline_builders.json
+# python benchmarks/bench_builders.py --save          在当前机器上重新生成基线
+import gc
+import os
+import sys
+import json
+import time
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from builders import (get_gmt_time, meeting_card, button, record_link, oauth_url, summary_bref, summary_card,
+                      participant_elements, document_page)
+from bench_md2docx import synthetic_summary
+
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baseline_builders.json")
+CALIBRATION = "_calibration"
+START_TIME, END_TIME = "1724483972", "1724486973"
+STATE = {
+    "message_id": "om_dc13264520392913993dd051dba21dcf",
+    "open_id": "ou_7d8a6e6df7621556ce0d21922b676706",
+    "meeting_id": "6911188411934433028",
+    "record_url": "https://meetings.feishu.cn/minutes/obcnq3b9jl72l83w4f149w9c",
+    "start_time": START_TIME,
+    "end_time": END_TIME,
+    "traceparent": "00-4bf92f3577b34da6a3ce929d0e0e4736-00f067aa0ba902b7-01",
+}
+
+
+def participants(count):
+    # 每10人中有1个外部参会人
+    return [{"open_id": "ou_{:032x}".format(i), "user_type": 1, "is_external": i % 10 == 9,
+             "name": "参会人{}".format(i)} for i in range(count)]
+
+
+def cases():
+    # (用例名, 被测函数)，realistic为常见规模，large为超长会议和大型会议
+    card = meeting_card("产品周会", START_TIME, END_TIME)
+    summaries = {"realistic": synthetic_summary(20), "large": synthetic_summary(10000)}
+    users = {"realistic": participants(10), "large": participants(2000)}
+    yield "get_gmt_time", lambda: get_gmt_time(START_TIME, END_TIME)
+    yield "meeting_card", lambda: meeting_card("产品周会", START_TIME, END_TIME,
+                                               record_link("产品周会", STATE["record_url"]), button("智能纪要生成中..."))
+    yield "oauth_url", lambda: oauth_url(STATE, "cli_a5c7d1e2f3b4c5d6", "https://open.feishu.cn",
+                                         "https://meeting.example.com", "https://applink.feishu.cn")
+    for size in ("realistic", "large"):
+        summary, people = summaries[size], users[size]
+        yield "summary_bref/" + size, lambda summary=summary: summary_bref(summary)
+        yield "summary_card/" + size, lambda summary=summary: summary_card(
+            card, summary, "https://x.feishu.cn/docx/doc1", START_TIME, END_TIME)
+        yield "participant_elements/" + size, lambda people=people: participant_elements(people)
+        yield "document_page/" + size, lambda summary=summary, people=people: document_page(
+            "产品周会", START_TIME, END_TIME, people, summary)
+
+
+def calibration():
+    # 固定的纯Python负载，用于抵消不同机器、不同负载下的速度差异
+    items = [{"id": i, "name": "item{}".format(i), "tags": [i % 3, i % 5]} for i in range(200)]
+    return sorted(items, key=lambda item: (item["tags"][0], -item["id"]))
+
+
+def measure(func, repeat, min_time):
+    # 与timeit相同：测量期间关闭gc，先确定每轮的调用次数，使每轮不少于min_time秒，再取各轮中最快的单次耗时；
+    # 同时返回较快的四分之一轮次与最快值之差，作为最快耗时本身的抖动
+    gc.collect()
+    gc.disable()
+    try:
+        return _measure(func, repeat, min_time)
+    finally:
+        gc.enable()
+
+
+def _measure(func, repeat, min_time):
+    number = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(number):
+            func()
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_time:
+            break
+        number *= 2 if elapsed == 0 else max(2, int(min_time / elapsed) + 1)
+    rounds = [elapsed / number]
+    for _ in range(repeat - 1):
+        start = time.perf_counter()
+        for _ in range(number):
+            func()
+        rounds.append((time.perf_counter() - start) / number)
+    best = min(rounds)
+    return best, sorted(rounds)[len(rounds) // 4] - best
+
+
+def format_time(seconds):
+    if seconds >= 1e-3:
+        return "{:8.2f} ms".format(seconds * 1e3)
+    return "{:8.2f} us".format(seconds * 1e6)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--baseline", default=BASELINE)
+    parser.add_argument("--save", action="store_true", help="将本次结果保存为基线")
+    parser.add_argument("--threshold", type=float, default=0.25, help="允许比基线慢的比例")
+    parser.add_argument("--noise", type=float, default=1.0,
+                        help="变慢的绝对时间还需超过该用例本次测量抖动的倍数，抖动大的微秒级用例不因偶发波动失败")
+    parser.add_argument("--repeat", type=int, default=15)
+    parser.add_argument("--min-time", type=float, default=0.05, help="每轮的最短时间（秒）")
+    parser.add_argument("--filter", default="", help="只运行名称包含该字符串的用例")
+    args = parser.parse_args()
+
+    baseline = {}
+    if not args.save and os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+    # 各用例按相对校准负载的耗时比较，基线在其他机器上生成时也可以使用；
+    # 每个用例前重新测量校准负载，比较的两个值来自同一时间段，不受测试期间机器负载变化的影响
+    scale = measure(calibration, args.repeat, args.min_time)[0]
+    base_scale = baseline.get(CALIBRATION, scale)
+    results = {CALIBRATION: scale}
+    regressions = []
+    print("{:<34} {}".format(CALIBRATION, format_time(scale)))
+    for name, func in cases():
+        if args.filter not in name:
+            continue
+        local_scale = measure(calibration, args.repeat, args.min_time)[0]
+        seconds, noise = [value * scale / local_scale for value in measure(func, args.repeat, args.min_time)]
+        results[name] = seconds
+        suffix = ""
+        if name in baseline:
+            expected = baseline[name] * scale / base_scale
+            if seconds > expected * (1 + args.threshold) and seconds - expected > args.noise * noise:
+                # 超过阈值时再测一次，排除偶发的调度抖动
+                local_scale = measure(calibration, args.repeat, args.min_time)[0]
+                retry, retry_noise = [value * scale / local_scale
+                                      for value in measure(func, args.repeat * 2, args.min_time)]
+                if retry < seconds:
+                    results[name], seconds, noise = retry, retry, retry_noise
+            suffix = "  baseline {}  {:+7.1%}  noise {:5.1%}".format(format_time(expected), seconds / expected - 1,
+                                                                    noise / seconds)
+            if seconds > expected * (1 + args.threshold) and seconds - expected > args.noise * noise:
+                regressions.append(name)
+                suffix += "  REGRESSION"
+        print("{:<34} {}{}".format(name, format_time(seconds), suffix))
+
+    if args.save:
+        with open(args.baseline, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+            f.write("\n")
+        print("baseline saved to {}".format(args.baseline))
+    elif regressions:
+        print("{} builder(s) slower than baseline by more than {:.0%} and {:g}x their noise: {}".format(
+            len(regressions), args.threshold, args.noise, ", ".join(regressions)))
+        sys.exit(1)
@@ -0,0 +1,45 @@
+# 日志在业务线程中的耗时：同步输出完整内容 vs 队列异步输出并截断，python benchmarks/bench_logging.py --size 1000000
+import os
+import sys
+import time
+import logging
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from log import configure_logging, payload, log_context
+
+
+def bench(name, log, count):
+    start = time.perf_counter()
+    for i in range(count):
+        log(i)
+    elapsed = time.perf_counter() - start
+    print("{:<24} {:>10.1f} us/call".format(name, elapsed / count * 1e6))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--size", type=int, default=1000000, help="接口响应的大小（字节）")
+    parser.add_argument("--count", type=int, default=200)
+    args = parser.parse_args()
+    body = ("{\"data\": \"" + "x" * args.size + "\"}").encode()
+    summary = {"paragraph": {"data": "会议纪要" * (args.size // 12)}}
+    root = logging.getLogger()
+
+    # 原来的写法：basicConfig同步输出，.format()在调用前就生成完整字符串
+    devnull = open(os.devnull, "w")
+    logging.basicConfig(level=logging.INFO, stream=devnull)
+    bench("sync full payload", lambda i: (
+        logging.info("Response: %r", (200, body)),
+        logging.info(">>> summary: {}".format(summary))), args.count)
+
+    configure_logging(level="INFO", stream=devnull)
+    with log_context(event_id="ev1", meeting_id="m1", stage="summarize"):
+        bench("queued truncated", lambda i: (
+            logging.info("Response: %s %s", 200, payload(body)),
+            logging.info(">>> summary: %s", payload(summary))), args.count)
+        root.setLevel(logging.WARNING)
+        bench("queued, level disabled", lambda i: (
+            logging.info("Response: %s %s", 200, payload(body)),
+            logging.info(">>> summary: %s", payload(summary))), args.count)
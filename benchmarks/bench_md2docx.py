@@ -0,0 +1,65 @@
+# 会议纪要Markdown编译为云文档块的性能测试：python benchmarks/bench_md2docx.py --bullets 100 1000 10000
+import os
+import sys
+import json
+import time
+import random
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from md2docx import compile_markdown
+
+TITLES = ["产品设计", "性能优化", "测试计划", "竞争分析", "用户反馈", "上线安排", "预算", "分工"]
+CONTENTS = [
+    "确定采用现代简洁的设计风格，按钮和操作区域需要明显且易于点击",
+    "在高负载场景下保证响应时间低于`200ms`，详见[压测报告](https://example.com/report)",
+    "分阶段进行单元测试、集成测试和*性能测试*，模拟高并发场景",
+    "借鉴竞品的优点，~~暂不考虑~~看板视图放到第二期",
+]
+
+
+def synthetic_summary(bullets, seed=1):
+    # 生成带标题、多级列表、有序列表和行内样式的纪要
+    rng = random.Random(seed)
+    lines = ["会议讨论了新软件产品的设计和功能需求，主要内容包括："]
+    for i in range(bullets):
+        if i % 50 == 0:
+            lines.append("## 议题{}".format(i // 50 + 1))
+        title, content = rng.choice(TITLES), rng.choice(CONTENTS)
+        if i % 10 == 9:
+            lines.append("  - **{}**：{}".format(title, content))
+        elif i % 10 == 8:
+            lines.append("{}. {}".format(i % 5 + 1, content))
+        else:
+            lines.append("- **{}**：{}".format(title, content))
+    return "\n".join(lines)
+
+
+def count(blocks):
+    return sum(1 + count(block.children) for block in blocks)
+
+
+def bench(bullets, repeat):
+    text = synthetic_summary(bullets)
+    start = time.perf_counter()
+    for _ in range(repeat):
+        blocks = compile_markdown(text)
+    compile_time = (time.perf_counter() - start) / repeat
+    total = count(blocks)
+
+    start = time.perf_counter()
+    size = len(json.dumps([block.data for block in blocks], ensure_ascii=False))
+    dump_time = time.perf_counter() - start
+
+    print("{:>6} bullets {:>7} blocks  compile {:>8.2f} ms ({:>9.0f} blocks/s)  json {:>7.2f} ms {:>8} bytes".format(
+        bullets, total, compile_time * 1000, total / compile_time, dump_time * 1000, size))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--bullets", type=int, nargs="+", default=[100, 1000, 10000])
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+    for bullets in args.bullets:
+        bench(bullets, args.repeat)
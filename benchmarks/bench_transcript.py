@@ -0,0 +1,66 @@
+# 妙记文字记录解析性能测试：python benchmarks/bench_transcript.py --hours 1 3 6
+import os
+import sys
+import time
+import random
+import argparse
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from transcript import TranscriptParser
+
+PHRASES = [
+    "我们需要在下周之前完成接口联调", "这个方案的性能还需要再评估一下", "用户反馈主要集中在加载速度上",
+    "测试环境已经准备好了", "市场部希望尽快上线", "预算方面还有一些不确定性", "我同意这个分工",
+    "先把核心流程跑通", "后续再补充监控和告警", "数据迁移需要单独排期",
+]
+
+
+def synthetic_transcript(hours, speakers=8, seconds_per_turn=20, timestamps=False, seed=1):
+    # 生成指定时长的妙记导出文本，每段发言2~6句
+    rng = random.Random(seed)
+    total = int(hours * 3600)
+    lines = ["2024-08-24 15:19:33 CST|{}小时 0分钟 0秒".format(int(hours)), "", "关键词:", "性能优化、接口联调、上线计划", ""]
+    for second in range(0, total, seconds_per_turn):
+        speaker = "讲话人{}".format(rng.randint(1, speakers))
+        if timestamps:
+            speaker += " {:02d}:{:02d}:{:02d}".format(second // 3600, second // 60 % 60, second % 60)
+        lines.append(speaker)
+        lines.append("".join(rng.choice(PHRASES) + rng.choice("，。。？") for _ in range(rng.randint(2, 6))))
+        lines.append("")
+    return "\n".join(lines)
+
+
+def bench(hours, chunk_size, timestamps):
+    text = synthetic_transcript(hours, timestamps=timestamps)
+    size = len(text.encode("utf-8"))
+
+    tracemalloc.start()
+    start = time.perf_counter()
+    parser = TranscriptParser()
+    for i in range(0, len(text), chunk_size):
+        parser.feed(text[i:i + chunk_size])
+    transcript = parser.close()
+    parse_time = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    start = time.perf_counter()
+    body = transcript.to_transcripts()
+    body_time = time.perf_counter() - start
+
+    print("{:>4}h ts={:<5} {:>7.2f} MB  {:>6} turns {:>7} sentences  parse {:>7.1f} ms ({:>6.1f} MB/s)  "
+          "body {:>7.1f} ms  parse peak {:>6.2f} MB".format(
+              hours, str(timestamps), size / 1e6, len(transcript), sum(len(p["sentences"]) for p in body),
+              parse_time * 1000, size / 1e6 / parse_time, body_time * 1000, peak / 1e6))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--hours", type=float, nargs="+", default=[1, 3, 6])
+    parser.add_argument("--chunk-size", type=int, default=64 * 1024)
+    args = parser.parse_args()
+    for hours in args.hours:
+        for timestamps in (False, True):
+            bench(hours, args.chunk_size, timestamps)
@@ -0,0 +1,157 @@
+# 端到端压测：python benchmarks/load_driver.py --meetings 200 --rate 2 --latency 0.05 --rate-429 0.01
+# 在进程内启动模拟飞书开放平台，以HOST指向它后加载server，按固定速率触发会议结束事件，
+# 收到带授权按钮的卡片后模拟用户授权回调，收到带云文档地址的总结卡片时记为完成
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+import resource
+import tempfile
+import threading
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from mock_feishu import add_arguments, create_mock, serve, oauth_state, document_url
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(int(len(values) * p / 100), len(values) - 1)]
+
+
+class LoadDriver(object):
+    def __init__(self, server, oauth_delay=0.0):
+        self.server = server
+        self.oauth_delay = oauth_delay
+        # 会议号 -> {"start", "oauth", "done"}
+        self.meetings = {}
+        # 卡片message_id -> 会议号
+        self.messages = {}
+        self.done = threading.Semaphore(0)
+        self._lock = threading.Lock()
+
+    def on_recording(self, meeting_id, url):
+        self.server.on_event_recording_ready(self.server.bot, "rec_{}".format(meeting_id),
+                                             {"meeting": {"id": meeting_id}, "url": url})
+
+    def on_card(self, message_id, card):
+        state = oauth_state(card)
+        if state is not None:
+            meeting_no = state["meeting_id"][1:]
+            with self._lock:
+                if message_id in self.messages:
+                    return
+                self.messages[message_id] = meeting_no
+            timer = threading.Timer(self.oauth_delay, self.authorize, (meeting_no, state))
+            timer.daemon = True
+            timer.start()
+        elif document_url(card):
+            with self._lock:
+                meeting = self.meetings.get(self.messages.get(message_id))
+                if meeting is None or "done" in meeting:
+                    return
+                meeting["done"] = time.monotonic()
+            self.done.release()
+
+    def authorize(self, meeting_no, state):
+        # 模拟会议发起人点击授权按钮后的oauth回调
+        self.meetings[meeting_no]["oauth"] = time.monotonic()
+        user_info = {
+            "open_id": state["open_id"],
+            "state_dict": json.dumps(state, separators=(",", ":")),
+            "user_access_token": {"access_token": "u-mock"},
+        }
+        self.server.on_oauth_user_info(self.server.bot, "oauth_{}".format(meeting_no), user_info)
+
+    def fire(self, meeting_no):
+        now = int(time.time())
+        event = {"meeting": {
+            "id": "m{}".format(meeting_no),
+            "meeting_no": meeting_no,
+            "topic": "Meeting {}".format(meeting_no),
+            "meeting_source": 1,
+            "start_time": str(now - 3600),
+            "end_time": str(now),
+            "owner": {"id": {"open_id": "ou_{}_0".format(meeting_no)}},
+        }}
+        self.meetings[meeting_no] = {"start": time.monotonic()}
+        self.server.on_event_meeting_listen(self.server.bot, "ev_{}".format(meeting_no), event)
+
+    def run(self, count, rate, timeout):
+        start = time.monotonic()
+        for i in range(count):
+            delay = start + i / rate - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            self.fire(str(100000000 + i))
+        deadline = time.monotonic() + timeout
+        for _ in range(count):
+            if not self.done.acquire(timeout=max(deadline - time.monotonic(), 0)):
+                break
+        return start
+
+    def report(self, start, mock):
+        with self._lock:
+            finished = [m for m in self.meetings.values() if "done" in m]
+        total = [m["done"] - m["start"] for m in finished]
+        processing = [m["done"] - m["oauth"] for m in finished]
+        elapsed = max([m["done"] for m in finished], default=time.monotonic()) - start
+        return {
+            "meetings": len(self.meetings),
+            "completed": len(finished),
+            "failed": len(self.meetings) - len(finished),
+            "elapsed": elapsed,
+            "meetings_per_minute": len(finished) / elapsed * 60 if elapsed > 0 else 0.0,
+            # 会议结束事件到收到总结卡片
+            "latency": {"p50": percentile(total, 50), "p95": percentile(total, 95), "p99": percentile(total, 99)},
+            # 授权回调到收到总结卡片
+            "oauth_latency": {"p50": percentile(processing, 50), "p95": percentile(processing, 95),
+                              "p99": percentile(processing, 99)},
+            # Linux下ru_maxrss单位为KB，包含同一进程中的模拟服务
+            "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+            "mock": mock.stats(None, None)[1],
+        }
+
+
+def print_report(result):
+    print("meetings {meetings}  completed {completed}  failed {failed}  elapsed {elapsed:.1f} s  "
+          "{meetings_per_minute:.1f} meetings/min".format(**result))
+    for name in ("latency", "oauth_latency"):
+        print("{:<14} p50 {p50:>7.2f} s  p95 {p95:>7.2f} s  p99 {p99:>7.2f} s".format(name, **result[name]))
+    print("peak rss {:.1f} MB  requests {}  throttled {}".format(
+        result["peak_rss_mb"], sum(result["mock"]["requests"].values()), result["mock"]["throttled"]))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--meetings", type=int, default=50)
+    parser.add_argument("--rate", type=float, default=1.0, help="每秒触发的会议结束事件数")
+    parser.add_argument("--oauth-delay", type=float, default=0.0, help="收到卡片后用户点击授权的时间（秒）")
+    parser.add_argument("--timeout", type=float, default=120, help="最后一个事件触发后等待完成的时间（秒），超时未完成的会议计为失败")
+    parser.add_argument("--json", help="结果另存为json文件，便于对比不同版本")
+    parser.add_argument("--verbose", action="store_true")
+    add_arguments(parser)
+    args = parser.parse_args()
+
+    mock = create_mock(args)
+    _, url = serve(mock)
+    # 必须在加载server之前设置，任务状态写入临时文件，避免恢复上次压测遗留的任务
+    os.environ["HOST"] = url
+    os.environ["JOB_DB"] = os.path.join(tempfile.mkdtemp(), "jobs.db")
+    import server
+    if not args.verbose:
+        logging.getLogger().setLevel(logging.WARNING)
+
+    driver = LoadDriver(server, oauth_delay=args.oauth_delay)
+    mock.on_recording = driver.on_recording
+    mock.on_card = driver.on_card
+    start = driver.run(args.meetings, args.rate, args.timeout)
+    result = driver.report(start, mock)
+    print_report(result)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(result, f, indent=2)
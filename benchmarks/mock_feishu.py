@@ -0,0 +1,317 @@
+# 本地模拟飞书开放平台，覆盖FeishuClient和bot使用的全部接口：python benchmarks/mock_feishu.py --port 9000 --latency 0.05
+import re
+import json
+import time
+import random
+import argparse
+import itertools
+import threading
+from urllib.parse import urlparse, parse_qs, unquote
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from bench_transcript import synthetic_transcript
+from bench_md2docx import synthetic_summary
+
+# 卡片中授权按钮地址里的state_dict，多层url编码
+STATE_DICT = "state_dict="
+
+
+def find_urls(card):
+    # 卡片中所有按钮的跳转地址
+    if isinstance(card, dict):
+        for key, value in card.items():
+            if key == "url" and isinstance(value, str):
+                yield value
+            else:
+                yield from find_urls(value)
+    elif isinstance(card, list):
+        for item in card:
+            yield from find_urls(item)
+
+
+def oauth_state(card):
+    # 从会议卡片的授权按钮中解析state_dict，没有授权按钮时返回None
+    for url in find_urls(card):
+        for _ in range(3):
+            index = url.find(STATE_DICT + "{")
+            if index >= 0:
+                state, _ = json.JSONDecoder().raw_decode(url, index + len(STATE_DICT))
+                return state
+            url = unquote(url)
+    return None
+
+
+def document_url(card):
+    # 总结卡片中查看云文档的地址
+    for url in find_urls(card):
+        if "/docx/" in url:
+            return url
+    return None
+
+
+class MockFeishu(object):
+    # 接口状态保存在内存中：会议号对应的会议在首次查询后经过record_delay秒生成录制文件，
+    # 智能总结任务提交后经过summary_delay秒完成；rate_429为每个请求返回限流的概率
+    def __init__(self, latency=0.0, jitter=0.0, record_delay=0.0, summary_delay=0.0, rate_429=0.0,
+                 transcript_minutes=60, participants=5, summary_bullets=20, seed=1):
+        self.latency = latency
+        self.jitter = jitter
+        self.record_delay = record_delay
+        self.summary_delay = summary_delay
+        self.rate_429 = rate_429
+        self.participants = participants
+        self.transcript = synthetic_transcript(transcript_minutes / 60, seed=seed)
+        self.summary = synthetic_summary(summary_bullets, seed=seed)
+        # 收到录制完成、卡片发送/更新时的回调，由压测驱动设置
+        self.on_recording = None
+        self.on_card = None
+        self.meetings = {}
+        self.tasks = {}
+        self.requests = {}
+        self.throttled = 0
+        self._ids = itertools.count(1)
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self.routes = [
+            ("POST", r"/open-apis/auth/v3/(tenant|app)_access_token/internal/?", self.access_token),
+            ("POST", r"/open-apis/authen/v1/(oidc/)?access_token", self.user_access_token),
+            ("GET", r"/open-apis/authen/v1/user_info", self.user_info),
+            ("GET", r"/open-apis/vc/v1/meetings/list_by_no", self.meeting_list_by_no),
+            ("GET", r"/open-apis/vc/v1/meetings/([^/]+)/recording", self.recording),
+            ("GET", r"/open-apis/vc/v1/meetings/([^/]+)", self.meeting),
+            ("GET", r"/open-apis/vc/v1/participant_list", self.participant_list),
+            ("GET", r"/open-apis/minutes/v1/minutes/([^/]+)/transcript", self.minute_transcript),
+            ("GET", r"/open-apis/minutes/v1/minutes/([^/]+)", self.minute),
+            ("POST", r"/open-apis/audio_video_ai/v1/meeting_assistance", self.submit_summary),
+            ("GET", r"/open-apis/audio_video_ai/v1/meeting_assistance", self.summary_task),
+            ("POST", r"/open-apis/docx/v1/documents", self.create_document),
+            ("POST", r"/open-apis/docx/v1/documents/([^/]+)/blocks/([^/]+)/children", self.create_children),
+            ("POST", r"/open-apis/docx/v1/documents/([^/]+)/blocks/([^/]+)/descendant", self.create_descendant),
+            ("POST", r"/open-apis/message/v4/batch_send/?", self.batch_send),
+            ("POST", r"/open-apis/im/v1/messages", self.send_message),
+            ("PATCH", r"/open-apis/im/v1/messages/([^/]+)", self.update_message),
+            ("GET", r"/open-apis/im/v1/messages/([^/]+)", self.get_message),
+            ("GET", r"/mock/stats", self.stats),
+        ]
+        self.routes = [(method, re.compile(pattern + "$"), handler) for method, pattern, handler in self.routes]
+
+    def next_id(self, prefix):
+        return "{}{}".format(prefix, next(self._ids))
+
+    def handle(self, method, path, query, body):
+        # 返回(状态码, json或文本, 响应头)
+        for route_method, pattern, handler in self.routes:
+            match = pattern.match(path)
+            if route_method != method or not match:
+                continue
+            name = handler.__name__
+            with self._lock:
+                self.requests[name] = self.requests.get(name, 0) + 1
+                # 获取access_token的接口不限流
+                throttle = (path.startswith("/open-apis/") and not path.startswith("/open-apis/auth/")
+                            and self._random.random() < self.rate_429)
+                if throttle:
+                    self.throttled += 1
+                delay = max(self.latency + self._random.uniform(-self.jitter, self.jitter), 0)
+            if delay:
+                time.sleep(delay)
+            if throttle:
+                return 429, {"code": 99991400, "msg": "request trigger frequency limit"}, {"x-ogw-ratelimit-reset": "1"}
+            return handler(query, body, *match.groups())
+        return 404, {"code": 404, "msg": "not found: {} {}".format(method, path)}, {}
+
+    def ok(self, data=None):
+        return 200, {"code": 0, "msg": "success", "data": data or {}}, {}
+
+    def access_token(self, query, body, kind):
+        return 200, {"code": 0, "msg": "ok", "{}_access_token".format(kind): "t-mock", "expire": 7200}, {}
+
+    def user_access_token(self, query, body, oidc=None):
+        return self.ok({"access_token": "u-mock", "refresh_token": "ur-mock", "token_type": "Bearer",
+                        "expires_in": 7200, "open_id": "ou_mock"})
+
+    def user_info(self, query, body):
+        return self.ok({"open_id": "ou_mock", "name": "mock"})
+
+    def _meeting(self, meeting_no):
+        with self._lock:
+            meeting = self.meetings.get(meeting_no)
+            if meeting is None:
+                meeting = self.meetings[meeting_no] = {
+                    "id": "m{}".format(meeting_no),
+                    "meeting_no": meeting_no,
+                    "ended": time.monotonic(),
+                    "record_url": "https://mock.feishu.cn/minutes/obcn{}".format(meeting_no),
+                }
+                if self.on_recording is not None:
+                    timer = threading.Timer(self.record_delay, self.on_recording, (meeting["id"], meeting["record_url"]))
+                    timer.daemon = True
+                    timer.start()
+            return meeting
+
+    def meeting_list_by_no(self, query, body):
+        meeting = self._meeting(query["meeting_no"][0])
+        return self.ok({"meeting_briefs": [{"id": meeting["id"], "topic": "Meeting {}".format(meeting["meeting_no"])}]})
+
+    def recording(self, query, body, meeting_id):
+        meeting = self._meeting(meeting_id[1:])
+        if time.monotonic() - meeting["ended"] < self.record_delay:
+            return 400, {"code": 121005, "msg": "recording not ready"}, {}
+        return self.ok({"recording": {"url": meeting["record_url"], "duration": "3600"}})
+
+    def users(self, meeting_no):
+        return ["ou_{}_{}".format(meeting_no, i) for i in range(self.participants)]
+
+    def meeting(self, query, body, meeting_id):
+        meeting_no = meeting_id[1:]
+        participants = [{"id": open_id, "user_type": 1} for open_id in self.users(meeting_no)]
+        return self.ok({"meeting": {"id": meeting_id, "topic": "Meeting {}".format(meeting_no),
+                                    "meeting_no": meeting_no, "participants": participants}})
+
+    def participant_list(self, query, body):
+        users = self.users(query["meeting_no"][0])
+        page_size = int(query.get("page_size", ["100"])[0])
+        start = int(query.get("page_token", ["0"])[0])
+        page = users[start:start + page_size]
+        more = start + page_size < len(users)
+        return self.ok({
+            "participants": [{"user_id": open_id, "participant_name": open_id} for open_id in page],
+            "has_more": more,
+            "page_token": str(start + page_size) if more else "",
+        })
+
+    def minute_transcript(self, query, body, minute_token):
+        # 追加一段带会议号的发言，避免不同会议的文字稿命中同一条总结缓存
+        return 200, self.transcript + "\n讲话人1\n会议{}到此结束。\n".format(minute_token), {}
+
+    def minute(self, query, body, minute_token):
+        meeting_no = minute_token[len("obcn"):]
+        return self.ok({"minute": {"token": minute_token, "title": "Meeting {}".format(meeting_no),
+                                   "duration": "3600000", "owner_id": self.users(meeting_no)[0]}})
+
+    def submit_summary(self, query, body):
+        task_id = self.next_id("task_")
+        with self._lock:
+            self.tasks[task_id] = time.monotonic()
+        return self.ok({"task_id": task_id})
+
+    def summary_task(self, query, body):
+        with self._lock:
+            submitted = self.tasks.get(query["task_id"][0])
+        if submitted is None:
+            return 400, {"code": 400, "msg": "task not found"}, {}
+        if time.monotonic() - submitted < self.summary_delay:
+            return 200, {"code": 1, "msg": "processing"}, {}
+        return self.ok({"task_id": query["task_id"][0], "paragraph": {"data": self.summary}})
+
+    def create_document(self, query, body):
+        return self.ok({"document": {"document_id": self.next_id("doc"), "revision_id": 1,
+                                     "title": body.get("title", "")}})
+
+    def create_children(self, query, body, document_id, block_id):
+        children = [dict(child, block_id=self.next_id("blk")) for child in body.get("children", [])]
+        return self.ok({"children": children, "document_revision_id": 1, "client_token": query.get("client_token")})
+
+    def create_descendant(self, query, body, document_id, block_id):
+        relations = [{"temporary_block_id": item["block_id"], "block_id": self.next_id("blk")}
+                     for item in body.get("descendants", [])]
+        return self.ok({"block_id_relations": relations, "document_revision_id": 1})
+
+    def batch_send(self, query, body):
+        return self.ok({"message_id": self.next_id("bm_"), "invalid_open_ids": []})
+
+    def _card(self, message_id, content):
+        card = json.loads(content) if isinstance(content, str) else content
+        if self.on_card is not None:
+            self.on_card(message_id, card)
+
+    def send_message(self, query, body):
+        message_id = self.next_id("om_")
+        self._card(message_id, body.get("content") or body.get("card"))
+        return self.ok({"message_id": message_id, "msg_type": body.get("msg_type", "interactive")})
+
+    def update_message(self, query, body, message_id):
+        self._card(message_id, body.get("content") or body.get("card"))
+        return self.ok()
+
+    def get_message(self, query, body, message_id):
+        return self.ok({"items": [{"message_id": message_id, "msg_type": "interactive"}]})
+
+    def stats(self, query, body):
+        with self._lock:
+            return 200, {"requests": dict(self.requests), "throttled": self.throttled,
+                         "meetings": len(self.meetings)}, {}
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def _handle(self):
+        url = urlparse(self.path)
+        length = int(self.headers.get("Content-Length") or 0)
+        raw = self.rfile.read(length) if length else b""
+        try:
+            body = json.loads(raw) if raw else {}
+        except ValueError:
+            body = {}
+        status, payload, headers = self.server.mock.handle(self.command, url.path, parse_qs(url.query), body)
+        if isinstance(payload, str):
+            data = payload.encode("utf-8")
+            content_type = "text/plain; charset=utf-8"
+        else:
+            data = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+            content_type = "application/json; charset=utf-8"
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        for key, value in headers.items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    do_GET = do_POST = do_PATCH = do_PUT = _handle
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(mock, host="127.0.0.1", port=0):
+    # 在后台线程中启动，返回(server, 地址)
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    server.mock = mock
+    threading.Thread(target=server.serve_forever, name="mock-feishu", daemon=True).start()
+    return server, "http://{}:{}".format(*server.server_address[:2])
+
+
+def add_arguments(parser):
+    parser.add_argument("--latency", type=float, default=0.02, help="每个请求的平均延迟（秒）")
+    parser.add_argument("--jitter", type=float, default=0.01, help="延迟的随机波动（秒）")
+    parser.add_argument("--record-delay", type=float, default=1.0, help="会议结束后生成录制文件的时间（秒）")
+    parser.add_argument("--summary-delay", type=float, default=0.0, help="智能总结任务的完成时间（秒）")
+    parser.add_argument("--rate-429", type=float, default=0.0, help="每个请求返回429的概率")
+    parser.add_argument("--transcript-minutes", type=float, default=60, help="文字稿对应的会议时长（分钟）")
+    parser.add_argument("--participants", type=int, default=5)
+    parser.add_argument("--summary-bullets", type=int, default=20)
+
+
+def create_mock(args):
+    return MockFeishu(latency=args.latency, jitter=args.jitter, record_delay=args.record_delay,
+                      summary_delay=args.summary_delay, rate_429=args.rate_429,
+                      transcript_minutes=args.transcript_minutes, participants=args.participants,
+                      summary_bullets=args.summary_bullets)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9000)
+    add_arguments(parser)
+    args = parser.parse_args()
+    server, url = serve(create_mock(args), args.host, args.port)
+    print("mock feishu listening on {}, start the app with HOST={}".format(url, url))
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
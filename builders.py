@@ -0,0 +1,146 @@
+import json
+import datetime
+from urllib.parse import quote
+
+from document import Block
+from md2docx import TEXT, block, text_block, heading_block, text_run, text_style, compile_markdown
+from participants import is_lark_user
+
+# 卡片和云文档内容的构建，均为不依赖接口调用的纯函数，每个会议都会执行，性能测试见benchmarks/bench_builders.py
+
+# 会议时间按东八区展示
+TIMEZONE = datetime.timezone(datetime.timedelta(hours=8))
+WEEKDAYS = ["周一", "周二", "周三", "周四", "周五", "周六", "周日"]
+OAUTH_SCOPE = quote("minutes:minute:download minutes:minutes minutes:minutes:readonly")
+# 总结卡片中预览的行数
+BREF_LINES = 3
+DISCLAIMER = "智能纪要依据会中总结内容生成，不代表平台立场，请谨慎甄别后使用"
+
+
+def get_gmt_time(start_ts, end_ts):
+    start = datetime.datetime.fromtimestamp(int(start_ts), tz=TIMEZONE)
+    end = datetime.datetime.fromtimestamp(int(end_ts), tz=TIMEZONE)
+    return "{:02d}月{:02d}号（{}） {:02d}:{:02d} - {:02d}:{:02d} GMT+08".format(
+        start.month, start.day, WEEKDAYS[start.weekday()], start.hour, start.minute, end.hour, end.minute)
+
+
+def button(content, url=None):
+    item = {
+        "tag": "button",
+        "text": {
+            "tag": "plain_text",
+            "content": content
+        },
+    }
+    if url:
+        item["url"] = url
+    item.update({
+        "type": "primary",
+        "complex_interaction": True,
+        "width": "default",
+        "size": "medium"
+    })
+    return {"tag": "action", "actions": [item]}
+
+
+def card_elements(start_time, end_time, content="", action=None):
+    # 会议卡片正文：会议时间、Markdown内容，可选按钮
+    elements = [
+        {
+            "tag": "note",
+            "elements": [
+                {
+                    "tag": "plain_text",
+                    "content": get_gmt_time(start_time, end_time)
+                }
+            ]
+        },
+        {
+            "tag": "markdown",
+            "content": content,
+            "text_align": "left",
+            "text_size": "normal"
+        },
+    ]
+    if action is not None:
+        elements.append(action)
+    return elements
+
+
+def meeting_card(meeting_topic, start_time, end_time, content="", action=None):
+    return {
+        "config": {},
+        "header": {
+            "title": {
+                "tag": "plain_text",
+                "content": meeting_topic + " - 智能纪要"
+            },
+            "template": "default"
+        },
+        "elements": card_elements(start_time, end_time, content, action)
+    }
+
+
+def record_link(meeting_topic, record_url):
+    return "录制文件（妙记）：[{}]({})".format(meeting_topic, record_url)
+
+
+def oauth_url(state, app_id, host, domain, applink_host):
+    # 授权按钮地址：应用内打开飞书授权页，授权后回调到本服务的/oauth/feishu，state_dict原样带回
+    state_info = json.dumps(state, separators=(',', ':'))
+    inner_oauth = f"{domain}/oauth/feishu?app_id={app_id}&scope={OAUTH_SCOPE}&state_dict={state_info}"
+    feishu_url = f"{host}/open-apis/authen/v1/authorize?app_id={app_id}&redirect_uri={quote(inner_oauth)}&scope={OAUTH_SCOPE}&state={app_id}"
+    return f"{applink_host}/client/web_url/open?mode=appCenter&url=" + quote(feishu_url)
+
+
+def summary_bref(summary_data, lines=BREF_LINES):
+    # 取总结的前几行非空内容作为卡片预览，找到足够的行后不再扫描剩余内容
+    text = summary_data.strip()
+    bref = []
+    start = 0
+    while len(bref) < lines and start <= len(text):
+        end = text.find("\n", start)
+        if end < 0:
+            end = len(text)
+        item = text[start:end]
+        if item.strip():
+            bref.append(item)
+        start = end + 1
+    return " \n".join(bref) + " \n " + " ..."
+
+
+def summary_card(card_content, summary_data, document_url, start_time, end_time):
+    # 总结卡片沿用会议卡片的标题，只替换正文
+    elements = card_elements(start_time, end_time, summary_bref(summary_data), button("查看完整会议纪要", document_url))
+    return dict(card_content, elements=elements)
+
+
+def mention_user(open_id):
+    return {"mention_user": {"text_element_style": text_style(), "user_id": open_id}}
+
+
+def participant_elements(participants):
+    # 飞书用户@提及，外部参会人无法@，只写名字
+    elements = [text_run("参会人：")]
+    for user in participants:
+        if is_lark_user(user):
+            elements.append(mention_user(user["open_id"]))
+        elif user.get("name"):
+            elements.append(text_run(user["name"] + " "))
+    return elements
+
+
+def document_page(meeting_topic, start_time, end_time, participants, summary_data):
+    # 云文档的完整块树：会议信息、参会人、免责声明引用块、包含总结内容的高亮块
+    quote_container = Block({"block_type": 34, "quote_container": {}}, [text_block(DISCLAIMER)])
+    callout = Block({"block_type": 19, "callout": {"background_color": 5, "emoji_id": "page_facing_up"}},
+                    [heading_block(2, "总结", bold=True)] + compile_markdown(summary_data))
+    return [
+        heading_block(1, "会议信息"),
+        text_block("会议主题：{}".format(meeting_topic)),
+        text_block("会议时间：{}".format(get_gmt_time(start_time, end_time))),
+        block(TEXT, participant_elements(participants)),
+        heading_block(1, "智能纪要"),
+        quote_container,
+        callout,
+    ]
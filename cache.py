@@ -0,0 +1,321 @@
+import re
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+from collections import OrderedDict
+
+WHITESPACE = re.compile(r"\s+")
+
+
+class TTLCache(object):
+    # 有容量上限的过期缓存，按最近使用顺序淘汰，读写均为O(1)
+    def __init__(self, maxsize=10000, ttl=3600):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._items)
+
+    def __contains__(self, key):
+        return self._lookup(key) is not None
+
+    def _lookup(self, key):
+        item = self._items.get(key)
+        if item is None:
+            return None
+        if item[0] < time.monotonic():
+            del self._items[key]
+            return None
+        self._items.move_to_end(key)
+        return item
+
+    def _store(self, key, value):
+        self._items[key] = (time.monotonic() + self.ttl, value)
+        self._items.move_to_end(key)
+        while len(self._items) > self.maxsize:
+            self._items.popitem(last=False)
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._lookup(key)
+            if item is None:
+                self.misses += 1
+                return default
+            self.hits += 1
+            return item[1]
+
+    def set(self, key, value):
+        with self._lock:
+            self._store(key, value)
+
+    def add(self, key, value=True):
+        # 不存在时写入并返回True，已存在（重复）时返回False
+        with self._lock:
+            if self._lookup(key) is not None:
+                self.hits += 1
+                return False
+            self.misses += 1
+            self._store(key, value)
+            return True
+
+    def pop(self, key, default=None):
+        with self._lock:
+            item = self._items.pop(key, None)
+            return default if item is None else item[1]
+
+    def stats(self):
+        return {
+            "size": len(self._items),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+
+class SummaryCache(object):
+    # 会议总结缓存，key为规范化文字稿、总结方式和提示词版本的哈希
+    # 内存中按LRU保留最近的结果，指定path时同时写入sqlite，重启后仍可命中
+    def __init__(self, maxsize=1000, ttl=7 * 86400, path=None):
+        self.ttl = ttl
+        self.path = path
+        self.memory = TTLCache(maxsize=maxsize, ttl=ttl)
+        self.hits = 0
+        self.misses = 0
+        self.bytes_saved = 0
+        self._lock = threading.Lock()
+        self._conn = None
+        if path:
+            self._conn = sqlite3.connect(path, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("CREATE TABLE IF NOT EXISTS summaries (key TEXT PRIMARY KEY, value TEXT NOT NULL, "
+                               "created REAL NOT NULL)")
+            self._conn.commit()
+
+    @staticmethod
+    def key(text, backend, version):
+        # 合并空白字符后计算哈希，空格、换行的差异不影响命中
+        normalized = WHITESPACE.sub(" ", text).strip()
+        digest = hashlib.sha256("{}\0{}\0".format(backend, version).encode("utf-8"))
+        digest.update(normalized.encode("utf-8"))
+        return digest.hexdigest()
+
+    def get(self, key, size=0):
+        # size为命中时省去提交的输入字节数
+        value = self.memory.get(key)
+        if value is None and self._conn is not None:
+            with self._lock:
+                row = self._conn.execute("SELECT value FROM summaries WHERE key = ? AND created > ?",
+                                         (key, time.time() - self.ttl)).fetchone()
+            if row:
+                value = row[0]
+                self.memory.set(key, value)
+        with self._lock:
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self.bytes_saved += size
+        return value
+
+    def set(self, key, value):
+        self.memory.set(key, value)
+        if self._conn is not None:
+            with self._lock:
+                self._conn.execute("INSERT OR REPLACE INTO summaries VALUES (?, ?, ?)", (key, value, time.time()))
+                self._conn.commit()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self.memory),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+            "bytes_saved": self.bytes_saved,
+        }
+
+
+class SqliteTTLCache(object):
+    # 与TTLCache接口相同，保存在sqlite文件中，同一台机器的多个进程共享（如入口去重、录制完成事件）；
+    # 容量由ttl限制，过期记录在写入时顺带清理。值需要可以JSON序列化
+    def __init__(self, path, name, ttl=3600, purge_interval=60):
+        self.name = name
+        self.ttl = ttl
+        self.maxsize = 0
+        self.hits = 0
+        self.misses = 0
+        self.purge_interval = purge_interval
+        self._purged = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS ttl_cache (
+                name TEXT NOT NULL,
+                key TEXT NOT NULL,
+                value TEXT NOT NULL,
+                expires REAL NOT NULL,
+                PRIMARY KEY (name, key)
+            )
+        """)
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM ttl_cache WHERE name = ? AND expires > ?",
+                                      (self.name, time.time())).fetchone()[0]
+
+    def __contains__(self, key):
+        with self._lock:
+            return self._lookup(key) is not None
+
+    def _lookup(self, key):
+        row = self._conn.execute("SELECT value FROM ttl_cache WHERE name = ? AND key = ? AND expires > ?",
+                                 (self.name, key, time.time())).fetchone()
+        return None if row is None else json.loads(row[0])
+
+    def _purge(self, now):
+        if now - self._purged > self.purge_interval:
+            self._purged = now
+            self._conn.execute("DELETE FROM ttl_cache WHERE expires <= ?", (now,))
+
+    def get(self, key, default=None):
+        with self._lock:
+            value = self._lookup(key)
+            if value is None:
+                self.misses += 1
+                return default
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        now = time.time()
+        with self._lock:
+            self._purge(now)
+            self._conn.execute("INSERT OR REPLACE INTO ttl_cache VALUES (?, ?, ?, ?)",
+                               (self.name, key, json.dumps(value, ensure_ascii=False), now + self.ttl))
+
+    def add(self, key, value=True):
+        # 不存在或已过期时写入并返回True，其他进程已写入（重复）时返回False
+        now = time.time()
+        with self._lock:
+            self._purge(now)
+            added = self._conn.execute(
+                "INSERT INTO ttl_cache VALUES (?, ?, ?, ?) ON CONFLICT (name, key) DO UPDATE "
+                "SET value = excluded.value, expires = excluded.expires WHERE ttl_cache.expires <= ?",
+                (self.name, key, json.dumps(value, ensure_ascii=False), now + self.ttl, now)).rowcount
+            if added:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return bool(added)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            value = self._lookup(key)
+            self._conn.execute("DELETE FROM ttl_cache WHERE name = ? AND key = ?", (self.name, key))
+            return default if value is None else value
+
+    def stats(self):
+        return {
+            "size": len(self),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+
+class RedisTTLCache(object):
+    # 与TTLCache接口相同，保存在redis中，多台机器共享；每个key使用redis的过期时间，
+    # 另用有序集合记录过期时间，用于统计数量。值需要可以JSON序列化
+    def __init__(self, url, name, ttl=3600, prefix="ttlcache"):
+        # 只有使用redis时才需要安装redis
+        import redis
+
+        self.name = name
+        self.ttl = ttl
+        self.maxsize = 0
+        self.hits = 0
+        self.misses = 0
+        self.prefix = "{}:{{{}}}".format(prefix, name)
+        self.index = self.prefix + ":index"
+        self.redis = redis.Redis.from_url(url, decode_responses=True)
+        self._lock = threading.Lock()
+
+    def _key(self, key):
+        return "{}:{}".format(self.prefix, key)
+
+    def __len__(self):
+        now = time.time()
+        pipe = self.redis.pipeline()
+        pipe.zremrangebyscore(self.index, "-inf", now)
+        pipe.zcard(self.index)
+        return pipe.execute()[1]
+
+    def __contains__(self, key):
+        return self.redis.exists(self._key(key)) > 0
+
+    def _count(self, hit):
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def get(self, key, default=None):
+        value = self.redis.get(self._key(key))
+        self._count(value is not None)
+        return default if value is None else json.loads(value)
+
+    def set(self, key, value):
+        pipe = self.redis.pipeline()
+        pipe.set(self._key(key), json.dumps(value, ensure_ascii=False), px=int(self.ttl * 1000))
+        self._index(pipe, key)
+        pipe.execute()
+
+    def _index(self, pipe, key):
+        now = time.time()
+        pipe.zremrangebyscore(self.index, "-inf", now)
+        pipe.zadd(self.index, {key: now + self.ttl})
+
+    def add(self, key, value=True):
+        # SET NX保证多个进程同时写入时只有一个返回True
+        added = self.redis.set(self._key(key), json.dumps(value, ensure_ascii=False), px=int(self.ttl * 1000), nx=True)
+        if added:
+            pipe = self.redis.pipeline()
+            self._index(pipe, key)
+            pipe.execute()
+        self._count(not added)
+        return bool(added)
+
+    def pop(self, key, default=None):
+        pipe = self.redis.pipeline()
+        pipe.get(self._key(key))
+        pipe.delete(self._key(key))
+        pipe.zrem(self.index, key)
+        value = pipe.execute()[0]
+        return default if value is None else json.loads(value)
+
+    def stats(self):
+        return {
+            "size": len(self),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+
+def create_ttl_cache(backend, name, maxsize=10000, ttl=3600, path=None, url=None):
+    # backend与任务队列相同：memory为进程内TTLCache，sqlite、redis为多个进程共享的缓存
+    if backend == "sqlite":
+        return SqliteTTLCache(path, name, ttl=ttl)
+    if backend == "redis":
+        return RedisTTLCache(url, name, ttl=ttl)
+    if backend == "memory":
+        return TTLCache(maxsize=maxsize, ttl=ttl)
+    raise ValueError("unknown cache backend: {}".format(backend))
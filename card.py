@@ -0,0 +1,100 @@
+import copy
+import time
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from cache import TTLCache
+
+
+class CardState(object):
+    __slots__ = ("seq", "sent_seq", "pending", "scheduled", "last_sent", "lock")
+
+    def __init__(self):
+        # seq为最新一次更新的序号，sent_seq为已发送的序号，序号更小的更新不再发送
+        self.seq = 0
+        self.sent_seq = 0
+        self.pending = None
+        self.scheduled = False
+        self.last_sent = 0.0
+        self.lock = threading.Lock()
+
+
+class CardUpdater(object):
+    # 按message_id合并卡片更新：同一张卡片在interval秒内只发送一次，期间只保留最新状态，
+    # 被覆盖的中间状态直接丢弃；终态（final=True）立即发送并使尚未发送的中间状态失效
+    def __init__(self, bot, scheduler, interval=2.0, workers=4, maxsize=10000, ttl=3600):
+        self.bot = bot
+        self.scheduler = scheduler
+        self.interval = interval
+        self.states = TTLCache(maxsize=maxsize, ttl=ttl)
+        self.requested = 0
+        self.sent = 0
+        self.superseded = 0
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="card")
+
+    def _state(self, message_id):
+        with self._lock:
+            state = self.states.get(message_id)
+            if state is None:
+                state = CardState()
+                self.states.set(message_id, state)
+            return state
+
+    def update(self, message_id, content, final=False):
+        # 立即发送时返回接口响应，合并到稍后发送时返回None
+        state = self._state(message_id)
+        with self._lock:
+            self.requested += 1
+            state.seq += 1
+            seq = state.seq
+            if state.pending is not None:
+                self.superseded += 1
+                state.pending = None
+            if not final:
+                wait = state.last_sent + self.interval - time.monotonic()
+                if wait > 0 or state.scheduled:
+                    # 调用方之后可能继续修改content，保存副本
+                    state.pending = (seq, copy.deepcopy(content))
+                    if not state.scheduled:
+                        state.scheduled = True
+                        self.scheduler.call_later(max(wait, 0), self._executor.submit, self._flush, message_id)
+                    return None
+            # 在锁内记录发送时间，发送期间到达的更新合并到下一次发送
+            state.last_sent = time.monotonic()
+        return self._send(message_id, state, seq, content)
+
+    def _flush(self, message_id):
+        state = self._state(message_id)
+        with self._lock:
+            state.scheduled = False
+            pending, state.pending = state.pending, None
+            if pending is not None:
+                state.last_sent = time.monotonic()
+        if pending is None:
+            return
+        try:
+            self._send(message_id, state, *pending)
+        except Exception:
+            logging.exception(">>> card update failed: %s", message_id)
+
+    def _send(self, message_id, state, seq, content):
+        with state.lock:
+            if seq <= state.sent_seq:
+                with self._lock:
+                    self.superseded += 1
+                return None
+            state.sent_seq = seq
+            response = self.bot.update_card(message_id, content)
+        with self._lock:
+            self.sent += 1
+        return response
+
+    def stats(self):
+        return {
+            "requested": self.requested,
+            "sent": self.sent,
+            "superseded": self.superseded,
+            "cards": len(self.states),
+        }
@@ -18,3 +18,96 @@ ANTHROPIC_API_BASE=""
 ANTHROPIC_API_KEY=""
 OPENAI_API_BASE=""
 OPENAI_API_KEY=""
+# 会议总结方式：feishu为飞书会议智能总结接口，llm为大模型总结
+SUMMARY_BACKEND="feishu"
+LLM_MODEL="gpt-4o-mini"
+# 大模型总结时每块文字稿的最大token数（估算）
+LLM_CHUNK_TOKENS=6000
+# 同时请求大模型的最大数量
+LLM_WORKERS=4
+# 每个模型的最大并发请求数，未配置的模型使用default
+LLM_CONCURRENCY="default:8"
+# 1为流式生成，边生成边更新卡片
+LLM_STREAMING=1
+
+# card config
+# 同一张卡片两次更新的最小间隔（秒），期间的中间状态合并为一次更新
+CARD_UPDATE_INTERVAL=2
+# 批量发送总结卡片的最大并发请求数
+NOTIFY_WORKERS=8
+
+# summary cache config
+SUMMARY_CACHE_SIZE=1000
+# 总结结果保留时间（秒）
+SUMMARY_CACHE_TTL=604800
+# 总结结果持久化的sqlite文件，为空时只缓存在内存中
+SUMMARY_CACHE_DB=""
+
+# worker config
+MEETING_WORKERS=4
+OAUTH_WORKERS=4
+# 单个任务最长执行时间（秒）
+JOB_TIMEOUT=7200
+# 每个阶段的最大并发数
+STAGE_LIMITS="meeting:8,get_record:8,get_record_minute:8,summary:4,docx:4"
+# 任务状态持久化的sqlite文件
+JOB_DB="jobs.db"
+# 已结束任务的保留时间（秒），超过后定期清理
+JOB_RETENTION=604800
+# 任务队列及入口去重、录制完成事件的存储：memory为进程内；sqlite为QUEUE_DB文件，同一台机器的多个进程共享；
+# redis为QUEUE_URL，多台机器共享
+QUEUE_BACKEND="memory"
+QUEUE_DB="queue.db"
+QUEUE_URL="redis://localhost:6379/0"
+# 取出的任务超过该时间（秒）未完成或挂起时，认为worker已退出，重新执行；为0时与JOB_TIMEOUT相同
+QUEUE_VISIBILITY=0
+# 为0时本进程只接收事件写入队列，不执行任务，需要使用sqlite或redis队列由其他进程执行
+QUEUE_CONSUMER=1
+# 未收到录制完成事件时，查询录制文件的最小轮询间隔（秒）
+RECORD_POLL_INTERVAL=120
+
+# participant config
+USER_CACHE_SIZE=10000
+# 参会人信息缓存时间（秒）
+USER_CACHE_TTL=3600
+
+# dedup config
+DEDUP_SIZE=10000
+# 去重记录保留时间（秒）
+DEDUP_TTL=3600
+
+# http config
+HTTP_POOL_SIZE=32
+# keep-alive连接空闲保留时间（秒）
+HTTP_KEEPALIVE=60
+HTTP_CONNECT_TIMEOUT=5
+# 各接口分组的读超时（秒）
+HTTP_READ_TIMEOUTS="default:10,minutes:60,meeting_assistance:30,docx:15"
+# 各接口分组每秒请求数上限
+RATE_LIMITS="default:10,vc:10,minutes:5,meeting_assistance:5,docx:3,message:5"
+
+# docx config
+# 1为使用创建嵌套块接口一次写入整个文档，0为逐层创建子块
+DOCX_DESCENDANT=1
+# 同时写入不同父块的最大并发数
+DOCX_WORKERS=4
+
+# async config
+# 1为启用asyncio流水线，轮询阶段不再占用线程
+ASYNC_PIPELINE=0
+# 事件循环中同时执行的最大任务数
+ASYNC_CONCURRENCY=200
+# trace config
+# 链路追踪导出方式：file为写入TRACE_FILE，otlp为发送到OTLP_ENDPOINT，为空时不导出
+TRACE_EXPORTER=""
+TRACE_FILE="traces.jsonl"
+# OTLP/HTTP collector地址
+OTLP_ENDPOINT="http://localhost:4318/v1/traces"
+# log config
+LOG_LEVEL="INFO"
+# text为文本格式，json为每行一个json对象，附带event_id、meeting_id、stage等字段
+LOG_FORMAT="text"
+# 日志中接口响应等内容的最大长度（字符），超出部分截断，0为只记录长度
+LOG_PAYLOAD_LIMIT=2048
+# 待输出日志的队列长度，队列满时丢弃日志，不阻塞业务线程
+LOG_QUEUE_SIZE=10000
@@ -0,0 +1,138 @@
+import time
+import uuid
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from worker import check_deadline
+from tracing import bind
+
+# 需要重试的响应：文档版本冲突、限流和服务端错误
+RETRY_STATUS = (409, 429, 500, 502, 503, 504)
+
+
+class Block(object):
+    # 云文档块树的节点，data为块的json（不含block_id和children）
+    __slots__ = ("data", "children")
+
+    def __init__(self, data, children=None):
+        self.data = data
+        self.children = children or []
+
+    def size(self):
+        return 1 + sum(child.size() for child in self.children)
+
+
+class DocumentWriter(object):
+    # 先在内存中构建完整的块树，再用尽量少的请求写入云文档：
+    # 优先使用创建嵌套块接口一次写入整棵树，超过单次请求上限时按顺序分批追加，
+    # 放不下的容器块先创建空块，其子块在下一轮写入，不同父块的写入并发执行
+    max_blocks = 1000
+    max_children = 50
+
+    def __init__(self, client, workers=4, retries=3, descendant=True):
+        self.client = client
+        self.retries = retries
+        self.descendant = descendant
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="docx")
+
+    def write(self, document_id, blocks, headers=None):
+        # 返回调用接口的次数
+        tasks = [(document_id, blocks)]
+        calls = 0
+        while tasks:
+            check_deadline()
+            if len(tasks) == 1:
+                results = [self._write_children(document_id, tasks[0][0], tasks[0][1], headers)]
+            else:
+                results = list(self.executor.map(
+                    bind(lambda task: self._write_children(document_id, task[0], task[1], headers)), tasks))
+            tasks = []
+            for count, pending in results:
+                calls += count
+                tasks.extend(pending)
+        return calls
+
+    def _write_children(self, document_id, parent_id, blocks, headers):
+        # 同一父块下的子块按顺序分批追加到末尾，返回(请求数, 需要继续写入子块的[(块ID, 子块)])
+        count = 0
+        pending = []
+        for batch in self._batches(blocks):
+            if self.descendant:
+                pending.extend(self._create_descendant(document_id, parent_id, batch, headers))
+            else:
+                pending.extend(self._create_children(document_id, parent_id, batch, headers))
+            count += 1
+        return count, pending
+
+    def _batches(self, blocks):
+        # 嵌套模式按块总数分批，子树放不下时只计容器块本身；普通模式每批最多max_children个子块
+        batch = []
+        size = 0
+        for block in blocks:
+            if self.descendant:
+                cost = block.size()
+                if cost > self.max_blocks:
+                    cost = 1
+                limit = self.max_blocks
+            else:
+                cost = 1
+                limit = self.max_children
+            if batch and size + cost > limit:
+                yield batch
+                batch = []
+                size = 0
+            batch.append(block)
+            size += cost
+        if batch:
+            yield batch
+
+    def _create_descendant(self, document_id, parent_id, batch, headers):
+        descendants = []
+        deferred = []
+        remaining = [self.max_blocks]
+
+        def add(block):
+            block_id = "tmp_{}".format(len(descendants))
+            item = dict(block.data, block_id=block_id, children=[])
+            descendants.append(item)
+            remaining[0] -= 1
+            if block.children and block.size() - 1 <= remaining[0]:
+                item["children"] = [add(child) for child in block.children]
+            elif block.children:
+                deferred.append((block_id, block.children))
+            return block_id
+
+        body = {
+            "index": -1,
+            "children_id": [add(block) for block in batch],
+            "descendants": descendants,
+        }
+        data = self._post(self.client.create_descendant, body, document_id, parent_id, headers)
+        relations = {i["temporary_block_id"]: i["block_id"] for i in data.get("block_id_relations", [])}
+        return [(relations[block_id], children) for block_id, children in deferred]
+
+    def _create_children(self, document_id, parent_id, batch, headers):
+        body = {
+            "index": -1,
+            "children": [block.data for block in batch],
+        }
+        data = self._post(self.client.create_block, body, document_id, parent_id, headers)
+        created = data["children"]
+        return [(created[i]["block_id"], block.children) for i, block in enumerate(batch) if block.children]
+
+    def _post(self, create, body, document_id, block_id, headers):
+        # 同一批次重试时使用相同的client_token，避免重复创建
+        client_token = str(uuid.uuid4())
+        for attempt in range(self.retries + 1):
+            response = create(body, document_id=document_id, block_id=block_id, headers=headers,
+                              client_token=client_token)
+            if response.status_code == 200:
+                result = response.json()
+                if result.get("code", 0) == 0:
+                    return result["data"]
+                raise Exception("create block failed: {} {}".format(result.get("code"), result.get("msg")))
+            if response.status_code not in RETRY_STATUS or attempt == self.retries:
+                raise Exception("create block api failed: {}".format(response.status_code))
+            delay = min(0.5 * 2 ** attempt, 5)
+            logging.info(">>> create block %s retry after %s", response.status_code, delay)
+            time.sleep(delay)
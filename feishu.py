@@ -1,93 +1,293 @@
+import time
 import logging
+import threading
+
+import httpx
+
+from ratelimit import get_rate_limiter
+from metrics import FEISHU_SECONDS, FEISHU_RESPONSES, FEISHU_RETRIES
+from tracing import start_span
+from log import payload
+
+
+class HttpPool(object):
+    # 进程内共享的连接池，所有FeishuClient复用同一组keep-alive连接
+    client_class = httpx.Client
+
+    def __init__(self, max_connections=32, keepalive_expiry=60, connect_timeout=5, read_timeouts=None):
+        # 实际生效的参数，用于创建相同配置的异步连接池
+        self.config = {"max_connections": max_connections, "keepalive_expiry": keepalive_expiry,
+                       "connect_timeout": connect_timeout, "read_timeouts": dict(read_timeouts or {})}
+        self.max_connections = max_connections
+        self.connect_timeout = connect_timeout
+        self.read_timeouts = {"default": 10}
+        self.read_timeouts.update(read_timeouts or {})
+        self.client = self.client_class(
+            limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections,
+                                keepalive_expiry=keepalive_expiry),
+            timeout=httpx.Timeout(self.read_timeouts["default"], connect=connect_timeout),
+        )
+        self.in_flight = 0
+        self.peak = 0
+        self.requests = 0
+        self._lock = threading.Lock()
+
+    def timeout(self, endpoint):
+        read = self.read_timeouts.get(endpoint, self.read_timeouts["default"])
+        return httpx.Timeout(read, connect=self.connect_timeout)
+
+    def request(self, method, url, endpoint=None, stream=False, **kwargs):
+        # stream=True时不读取响应体，由调用方迭代后关闭，关闭前一直计入in_flight
+        self._enter()
+        try:
+            request = self.client.build_request(method, url, timeout=self.timeout(endpoint), **kwargs)
+            response = self.client.send(request, stream=stream)
+        except BaseException:
+            self._exit()
+            raise
+        if stream:
+            response.close = self._exit_on_close(response.close)
+        else:
+            self._exit()
+        return response
+
+    def _exit_on_close(self, close):
+        # 包装响应的close/aclose，重复关闭时只计数一次
+        closed = []
+
+        def wrapper():
+            if not closed:
+                closed.append(True)
+                self._exit()
+            return close()
+        return wrapper
+
+    def _enter(self):
+        with self._lock:
+            self.in_flight += 1
+            self.requests += 1
+            self.peak = max(self.peak, self.in_flight)
+
+    def _exit(self):
+        with self._lock:
+            self.in_flight -= 1
+
+    def stats(self):
+        return {
+            "max_connections": self.max_connections,
+            "in_flight": self.in_flight,
+            "peak": self.peak,
+            "requests": self.requests,
+            "utilisation": self.in_flight / self.max_connections,
+        }
+
+
+class AsyncHttpPool(HttpPool):
+    # 异步连接池，只能在创建它的事件循环中使用
+    client_class = httpx.AsyncClient
+
+    async def request(self, method, url, endpoint=None, stream=False, **kwargs):
+        self._enter()
+        try:
+            request = self.client.build_request(method, url, timeout=self.timeout(endpoint), **kwargs)
+            response = await self.client.send(request, stream=stream)
+        except BaseException:
+            self._exit()
+            raise
+        if stream:
+            response.aclose = self._exit_on_close(response.aclose)
+        else:
+            self._exit()
+        return response
+
+
+_http_pool = None
+_http_pool_lock = threading.Lock()
+
+
+def configure_http_pool(**kwargs):
+    global _http_pool
+    with _http_pool_lock:
+        _http_pool = HttpPool(**kwargs)
+    return _http_pool
+
+
+def get_http_pool():
+    global _http_pool
+    with _http_pool_lock:
+        if _http_pool is None:
+            _http_pool = HttpPool()
+        return _http_pool
+
+
+def log_body(response, log_content=True):
+    try:
+        content = response.content
+    except httpx.ResponseNotRead:
+        # 流式响应尚未读取，只记录状态
+        return "<stream>"
+    # 响应内容在日志实际输出时才转换为文本，超出长度的部分截断
+    return payload(content) if log_content else len(content)
+
+
+def create_async_http_pool():
+    # 使用与同步连接池相同的配置（未调用configure_http_pool时为默认配置），需在目标事件循环中调用
+    return AsyncHttpPool(**get_http_pool().config)
 
 
 class FeishuClient():
-    def __init__(self, bot, *args, **kwargs):
+    # 触发限流(429)后的最大重试次数
+    rate_limit_retries = 3
+
+    def __init__(self, bot, pool=None, limiter=None, *args, **kwargs):
         self.bot = bot
+        self.pool = pool
+        self.limiter = limiter
+
+    def auth_headers(self, headers):
+        # 未指定用户token时使用应用的tenant_access_token
+        headers = dict(headers or {})
+        if "Authorization" not in headers:
+            headers["Authorization"] = "Bearer {}".format(self.bot.tenant_access_token)
+        return headers
+
+    def request(self, method, endpoint, url, headers=None, **kwargs):
+        headers = self.auth_headers(headers)
+        pool = self.pool or get_http_pool()
+        bucket = (self.limiter or get_rate_limiter()).bucket(endpoint)
+        for attempt in range(self.rate_limit_retries + 1):
+            bucket.acquire()
+            start = time.perf_counter()
+            with start_span("feishu.{}".format(endpoint), method=method, url=url.split("?")[0]) as span:
+                try:
+                    response = pool.request(method, url, endpoint=endpoint, headers=headers, **kwargs)
+                except Exception:
+                    FEISHU_RESPONSES.inc(endpoint, "error")
+                    raise
+                finally:
+                    FEISHU_SECONDS.observe(time.perf_counter() - start, endpoint)
+                span.set("status", response.status_code)
+            FEISHU_RESPONSES.inc(endpoint, str(response.status_code))
+            bucket.on_response(response.status_code, response.headers)
+            if response.status_code != 429 or attempt == self.rate_limit_retries:
+                break
+            FEISHU_RETRIES.inc(endpoint)
+            response.close()
+        return response
+
+    def send(self, method, endpoint, url, headers=None, log_content=True, **kwargs):
+        logging.info("request url: %r", url)
+        response = self.request(method, endpoint, url, headers=headers, **kwargs)
+        logging.info("Response: %s %s", response.status_code, log_body(response, log_content))
+        return response
 
     def get_meeting_list_by_no(self, meeting_no, start_time, end_time, headers=None):
         # 根据会议号获取会议ID
         url = f"{self.bot.host}/open-apis/vc/v1/meetings/list_by_no?meeting_no={meeting_no}&start_time={start_time}&end_time={end_time}"
-        logging.info("Request: %r", url)
-        response =  self.bot.get(url) if not headers else self.bot.get(url, headers=headers)
-        logging.info("Response: %r", (response.status_code, response.content))
-        return response
+        return self.send("GET", "vc", url, headers=headers)
 
     def get_record(self, meeting_id, headers=None):
         # 根据会议ID获取会议录制文件地址
         url = f"{self.bot.host}/open-apis/vc/v1/meetings/{meeting_id}/recording"
-        logging.info("request url: %r", url)
-        response = self.bot.get(url) if not headers else self.bot.get(url, headers=headers)
-        logging.info("Response: %r", (response.status_code, response.content))
-        return response
+        return self.send("GET", "vc", url, headers=headers)
 
     def get_meeting(self, meeting_id, headers=None):
         # 获取会议详情
         url = f"{self.bot.host}/open-apis/vc/v1/meetings/{meeting_id}?with_participants=true"
-        logging.info("request url: %r", url)
-        response = self.bot.get(url) if not headers else self.bot.get(url, headers=headers)
-        logging.info("Response: %r", (response.status_code, response.content))
-        return response
+        return self.send("GET", "vc", url, headers=headers)
 
-    def get_record_minute(self, minute_token, headers=None):
-        # 导出妙计文件内容
+    def get_participant_list(self, meeting_no, start_time, end_time, page_token=None, page_size=100, headers=None):
+        # 分页获取参会人明细
+        url = f"{self.bot.host}/open-apis/vc/v1/participant_list?meeting_no={meeting_no}&meeting_start_time={start_time}&meeting_end_time={end_time}&meeting_status=2&user_id_type=open_id&page_size={page_size}"
+        if page_token:
+            url += f"&page_token={page_token}"
+        return self.send("GET", "vc", url, headers=headers)
+
+    def batch_get_users(self, open_ids, headers=None):
+        # 批量获取用户信息，一次最多50个open_id
+        query = "&".join(f"user_ids={open_id}" for open_id in open_ids)
+        url = f"{self.bot.host}/open-apis/contact/v3/users/batch?user_id_type=open_id&{query}"
+        return self.send("GET", "contact", url, headers=headers)
+
+    def get_record_minute(self, minute_token, headers=None, stream=False):
+        # 导出妙计文件内容，stream=True时返回未读取的响应，调用方按块迭代后需关闭
         url = f"{self.bot.host}/open-apis/minutes/v1/minutes/{minute_token}/transcript"
-        logging.info("request url: %r", url)
-        response = self.bot.get(url) if not headers else self.bot.get(url, headers=headers)
-        logging.info("Response: %r", (response.status_code, len(response.content)))
-        return response
+        return self.send("GET", "minutes", url, headers=headers, log_content=False, stream=stream)
 
     def get_minute(self, minute_token, headers=None):
         # 获取妙计详情
         url = f"{self.bot.host}/open-apis/minutes/v1/minutes/{minute_token}"
-        logging.info("request url: %r", url)
-        response = self.bot.get(url) if not headers else self.bot.get(url, headers=headers)
-        logging.info("Response: %r", (response.status_code, response.content))
-        return response
+        return self.send("GET", "minutes", url, headers=headers)
 
     def submit_summary_task(self, body, headers=None):
         # 提交会议智能总结任务
         url = f"{self.bot.host}/open-apis/audio_video_ai/v1/meeting_assistance"
-        logging.info("request url: %r", url)
-        response = self.bot.post(url, json=body) if not headers else self.bot.post(url, json=body, headers=headers)
-        logging.info("Response: %r", (response.status_code, response.content))
-        return response
+        return self.send("POST", "meeting_assistance", url, json=body, headers=headers)
 
     def get_summary_task(self, task_id, headers=None):
         # 查询总结任务详情
         url = f"{self.bot.host}/open-apis/audio_video_ai/v1/meeting_assistance?task_id={task_id}"
-        logging.info("request url: %r", url)
-        response = self.bot.get(url) if not headers else self.bot.get(url, headers=headers)
-        logging.info("Response: %r", (response.status_code, response.content))
-        return response
+        return self.send("GET", "meeting_assistance", url, headers=headers)
 
     def create_docx(self, body, headers=None):
         # 创建云文档
         url = f"{self.bot.host}/open-apis/docx/v1/documents"
-        logging.info("request url: %r", url)
-        response = self.bot.post(url, json=body) if not headers else self.bot.post(url, json=body, headers=headers)
-        logging.info("Response: %r", (response.status_code, response.content))
-        return response
+        return self.send("POST", "docx", url, json=body, headers=headers)
 
-    def create_block(self, body, document_id=None, block_id=None, headers=None):
-        # 创建块
-        url = f"{self.bot.host}/open-apis/docx/v1/documents/{document_id}/blocks/{block_id}/children"
-        logging.info("request url: %r", url)
-        response = self.bot.post(url, json=body) if not headers else self.bot.post(url, json=body, headers=headers)
-        logging.info("Response: %r", (response.status_code, response.content))
-        return response
+    def create_block(self, body, document_id=None, block_id=None, headers=None, client_token=None):
+        # 创建块，client_token用于重试时幂等
+        url = f"{self.bot.host}/open-apis/docx/v1/documents/{document_id}/blocks/{block_id}/children?document_revision_id=-1"
+        if client_token:
+            url += f"&client_token={client_token}"
+        return self.send("POST", "docx", url, json=body, headers=headers)
+
+    def create_descendant(self, body, document_id=None, block_id=None, headers=None, client_token=None):
+        # 创建嵌套块，一次请求写入多层子块
+        url = f"{self.bot.host}/open-apis/docx/v1/documents/{document_id}/blocks/{block_id}/descendant?document_revision_id=-1"
+        if client_token:
+            url += f"&client_token={client_token}"
+        return self.send("POST", "docx", url, json=body, headers=headers)
 
     def send_message_batch(self, body, headers=None):
         # 批量发送消息
         url = f"{self.bot.host}/open-apis/message/v4/batch_send/"
-        logging.info("request url: %r", url)
-        response = self.bot.post(url, json=body) if not headers else self.bot.post(url, json=body, headers=headers)
-        logging.info("Response: %r", (response.status_code, response.content))
-        return response
+        return self.send("POST", "message", url, json=body, headers=headers)
 
     def get_message(self, message_id, headers=None):
         url = f"{self.bot.host}/open-apis/im/v1/messages/{message_id}"
+        return self.send("GET", "im", url, headers=headers)
+
+
+class AsyncFeishuClient(FeishuClient):
+    # 异步版本，接口与FeishuClient一致，所有方法返回协程
+    def __init__(self, bot, pool, limiter=None, *args, **kwargs):
+        super().__init__(bot, pool=pool, limiter=limiter, *args, **kwargs)
+
+    async def request(self, method, endpoint, url, headers=None, **kwargs):
+        headers = self.auth_headers(headers)
+        bucket = (self.limiter or get_rate_limiter()).bucket(endpoint)
+        for attempt in range(self.rate_limit_retries + 1):
+            await bucket.acquire_async()
+            start = time.perf_counter()
+            with start_span("feishu.{}".format(endpoint), method=method, url=url.split("?")[0]) as span:
+                try:
+                    response = await self.pool.request(method, url, endpoint=endpoint, headers=headers, **kwargs)
+                except Exception:
+                    FEISHU_RESPONSES.inc(endpoint, "error")
+                    raise
+                finally:
+                    FEISHU_SECONDS.observe(time.perf_counter() - start, endpoint)
+                span.set("status", response.status_code)
+            FEISHU_RESPONSES.inc(endpoint, str(response.status_code))
+            bucket.on_response(response.status_code, response.headers)
+            if response.status_code != 429 or attempt == self.rate_limit_retries:
+                break
+            FEISHU_RETRIES.inc(endpoint)
+            await response.aclose()
+        return response
+
+    async def send(self, method, endpoint, url, headers=None, log_content=True, **kwargs):
         logging.info("request url: %r", url)
-        response = self.bot.get(url) if not headers else self.bot.get(url, headers=headers)
-        logging.info("Response: %r", (response.status_code, response.content))
+        response = await self.request(method, endpoint, url, headers=headers, **kwargs)
+        logging.info("Response: %s %s", response.status_code, log_body(response, log_content))
         return response
@@ -0,0 +1,572 @@
+import json
+import time
+import uuid
+import heapq
+import sqlite3
+import logging
+import itertools
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from worker import Job, EarlyWakes
+
+# 任务队列：入口（webhook、oauth回调）写入，worker取出执行。
+# get()取出任务时获得租约，租约期间同一分区（会议）的其他任务不会被取出；
+# 执行结束ack()删除任务，挂起nack()放回队列并在delay秒后重新可见，
+# 超过visibility秒未ack/nack（worker进程退出）时租约失效，任务重新可见。
+# wake(key)到达时任务正在执行或尚未以该key挂起，记录wake_ttl秒，之后以该key挂起的任务立即可见。
+# sqlite、redis队列中的任务只保存job.data中不以"_"开头的字段，与JobStore相同。
+
+
+def dump_job(job):
+    return json.dumps({
+        "job_id": job.job_id,
+        "kind": job.kind,
+        "stage": job.stage,
+        "attempt": job.attempt,
+        "deadline": job.deadline,
+        "stage_started": job.stage_started,
+        "data": {k: v for k, v in job.data.items() if not k.startswith("_")},
+    }, ensure_ascii=False)
+
+
+def load_job(text):
+    item = json.loads(text)
+    return Job(item["kind"], item["data"], stage=item["stage"], attempt=item["attempt"],
+               job_id=item["job_id"], deadline=item["deadline"], stage_started=item.get("stage_started"))
+
+
+class Lease(object):
+    __slots__ = ("job", "message_id", "token")
+
+    def __init__(self, job, message_id, token):
+        self.job = job
+        self.message_id = message_id
+        self.token = token
+
+    def __repr__(self):
+        return "<Lease {} {!r}>".format(self.message_id, self.job)
+
+
+def _partition_of(partition, job):
+    key = partition(job) if partition else None
+    return None if key is None else str(key)
+
+
+class _Message(object):
+    __slots__ = ("id", "job", "partition", "key", "ready_at", "token", "lease_until")
+
+    def __init__(self, message_id, job, partition):
+        self.id = message_id
+        self.job = job
+        self.partition = partition
+        self.key = None
+        self.ready_at = 0
+        self.token = None
+        self.lease_until = None
+
+
+class MemoryQueue(object):
+    # 进程内队列，任务保存在内存中（包括"_"开头的临时字段），入口和worker必须在同一进程
+    durable = False
+
+    def __init__(self, name, partition=None, visibility=3600, wake_ttl=600):
+        self.name = name
+        self.partition = partition
+        self.visibility = visibility
+        self._cond = threading.Condition()
+        self._messages = {}
+        # 可取出的任务，按入队顺序
+        self._ready = OrderedDict()
+        # (ready_at, seq, id)和(lease_until, seq, id)，记录延迟删除，出堆时与任务当前状态不符的跳过
+        self._delayed = []
+        self._expiry = []
+        self._leased = 0
+        self._locks = {}
+        self._keys = {}
+        self._woken = EarlyWakes(wake_ttl)
+        self._seq = itertools.count()
+
+    def put(self, job, delay=0, key=None):
+        message = _Message(next(self._seq), job, _partition_of(self.partition, job))
+        with self._cond:
+            self._messages[message.id] = message
+            self._schedule(message, delay, key)
+            self._cond.notify()
+
+    def get(self, timeout=None):
+        # 取出最早可见、且所在分区没有被租用的任务，timeout秒内没有任务时返回None
+        end = None if timeout is None else time.time() + timeout
+        with self._cond:
+            while True:
+                now = time.time()
+                self._promote(now)
+                lease = self._claim(now)
+                if lease is not None:
+                    return lease
+                wait = min([heap[0][0] - now for heap in (self._delayed, self._expiry) if heap], default=None)
+                if end is not None:
+                    if end <= now:
+                        return None
+                    wait = end - now if wait is None else min(wait, end - now)
+                self._cond.wait(wait)
+
+    def ack(self, lease):
+        with self._cond:
+            message = self._leased_message(lease)
+            if message is None:
+                return False
+            self._release(message)
+            del self._messages[message.id]
+            if message.key is not None and self._keys.get(message.key) == message.id:
+                del self._keys[message.key]
+            # 分区解除租用后，同一会议的其他任务可以被取出
+            self._cond.notify_all()
+            return True
+
+    def nack(self, lease, delay=0, key=None):
+        with self._cond:
+            message = self._leased_message(lease)
+            if message is None:
+                return False
+            self._release(message)
+            message.job = lease.job
+            self._schedule(message, delay, key)
+            self._cond.notify_all()
+            return True
+
+    def wake(self, key):
+        # 等待中的任务立即可见；不存在或正在执行时记录下来并返回False
+        with self._cond:
+            message = self._messages.get(self._keys.get(key))
+            if message is None or message.token is not None or message.id in self._ready:
+                self._woken.add(key)
+                return False
+            del self._keys[key]
+            message.ready_at = time.time()
+            self._ready[message.id] = message
+            self._cond.notify()
+            return True
+
+    def qsize(self):
+        with self._cond:
+            return len(self._ready)
+
+    def delayed(self):
+        with self._cond:
+            return len(self._messages) - len(self._ready) - self._leased
+
+    def _schedule(self, message, delay, key):
+        if key is not None:
+            message.key = key
+            self._keys[key] = message.id
+            if self._woken.take(key):
+                delay = 0
+        message.ready_at = time.time() + delay
+        if delay > 0:
+            heapq.heappush(self._delayed, (message.ready_at, next(self._seq), message.id))
+        else:
+            self._ready[message.id] = message
+
+    def _promote(self, now):
+        while self._delayed and self._delayed[0][0] <= now:
+            when, _, message_id = heapq.heappop(self._delayed)
+            message = self._messages.get(message_id)
+            if message is not None and message.token is None and message.ready_at == when:
+                self._ready[message_id] = message
+        while self._expiry and self._expiry[0][0] <= now:
+            when, _, message_id = heapq.heappop(self._expiry)
+            message = self._messages.get(message_id)
+            if message is not None and message.token is not None and message.lease_until == when:
+                logging.warning(">>> %s lease expired, redelivering: %r", self.name, message.job)
+                self._release(message)
+                self._ready[message_id] = message
+
+    def _claim(self, now):
+        for message in self._ready.values():
+            if message.partition is None or message.partition not in self._locks:
+                break
+        else:
+            return None
+        del self._ready[message.id]
+        message.token = uuid.uuid4().hex
+        message.lease_until = now + self.visibility
+        heapq.heappush(self._expiry, (message.lease_until, next(self._seq), message.id))
+        if message.partition is not None:
+            self._locks[message.partition] = message.id
+        self._leased += 1
+        return Lease(message.job, message.id, message.token)
+
+    def _leased_message(self, lease):
+        message = self._messages.get(lease.message_id)
+        if message is None or message.token != lease.token:
+            logging.warning(">>> %s lease lost: %r", self.name, lease)
+            return None
+        return message
+
+    def _release(self, message):
+        if message.partition is not None and self._locks.get(message.partition) == message.id:
+            del self._locks[message.partition]
+        message.token = None
+        message.lease_until = None
+        self._leased -= 1
+
+
+class SqliteQueue(object):
+    # 保存在sqlite文件中的队列，同一台机器上的多个进程共享；取出任务在一个写事务中完成，
+    # 其他进程通过轮询发现新任务，本进程写入时立即唤醒等待的worker
+    durable = True
+
+    def __init__(self, path, name, partition=None, visibility=3600, poll_interval=0.5, wake_ttl=600):
+        self.path = path
+        self.name = name
+        self.partition = partition
+        self.visibility = visibility
+        self.wake_ttl = wake_ttl
+        self.poll_interval = poll_interval
+        self._conn = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS queue (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                name TEXT NOT NULL,
+                partition TEXT,
+                wake_key TEXT,
+                ready_at REAL NOT NULL,
+                token TEXT,
+                lease_until REAL,
+                data TEXT NOT NULL
+            )
+        """)
+        self._conn.execute("CREATE INDEX IF NOT EXISTS queue_ready ON queue (name, ready_at)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS queue_partition ON queue (name, partition, lease_until)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS queue_key ON queue (name, wake_key)")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS queue_woken (
+                name TEXT NOT NULL,
+                wake_key TEXT NOT NULL,
+                woken_at REAL NOT NULL,
+                PRIMARY KEY (name, wake_key)
+            )
+        """)
+        self._db_lock = threading.Lock()
+        self._cond = threading.Condition()
+
+    def put(self, job, delay=0, key=None):
+        with self._transaction():
+            delay = self._delay(delay, key)
+            self._conn.execute(
+                "INSERT INTO queue (name, partition, wake_key, ready_at, data) VALUES (?, ?, ?, ?, ?)",
+                (self.name, _partition_of(self.partition, job), key, time.time() + delay, dump_job(job)))
+        self._notify()
+
+    def get(self, timeout=None):
+        end = None if timeout is None else time.time() + timeout
+        while True:
+            lease = self._claim()
+            if lease is not None:
+                return lease
+            wait = self.poll_interval
+            if end is not None:
+                if end <= time.time():
+                    return None
+                wait = min(wait, end - time.time())
+            with self._cond:
+                self._cond.wait(wait)
+
+    def ack(self, lease):
+        with self._db_lock:
+            deleted = self._conn.execute("DELETE FROM queue WHERE id = ? AND token = ?",
+                                         (lease.message_id, lease.token)).rowcount
+        if not deleted:
+            logging.warning(">>> %s lease lost: %r", self.name, lease)
+            return False
+        self._notify()
+        return True
+
+    def nack(self, lease, delay=0, key=None):
+        # 与wake在同一把写锁下执行，wake要么在挂起前被记录，要么在挂起后直接唤醒
+        with self._transaction():
+            delay = self._delay(delay, key)
+            updated = self._conn.execute(
+                "UPDATE queue SET data = ?, ready_at = ?, wake_key = COALESCE(?, wake_key), "
+                "token = NULL, lease_until = NULL WHERE id = ? AND token = ?",
+                (dump_job(lease.job), time.time() + delay, key, lease.message_id, lease.token)).rowcount
+        if not updated:
+            logging.warning(">>> %s lease lost: %r", self.name, lease)
+            return False
+        self._notify()
+        return True
+
+    def wake(self, key):
+        now = time.time()
+        with self._transaction():
+            updated = self._conn.execute(
+                "UPDATE queue SET ready_at = ? WHERE name = ? AND wake_key = ? AND token IS NULL AND ready_at > ?",
+                (now, self.name, key, now)).rowcount
+            if not updated:
+                self._conn.execute("DELETE FROM queue_woken WHERE woken_at <= ?", (now - self.wake_ttl,))
+                self._conn.execute("INSERT OR REPLACE INTO queue_woken VALUES (?, ?, ?)", (self.name, key, now))
+        if updated:
+            self._notify()
+        return bool(updated)
+
+    def qsize(self):
+        now = time.time()
+        with self._db_lock:
+            return self._conn.execute(
+                "SELECT COUNT(*) FROM queue WHERE name = ? AND ready_at <= ? AND (token IS NULL OR lease_until <= ?)",
+                (self.name, now, now)).fetchone()[0]
+
+    def delayed(self):
+        with self._db_lock:
+            return self._conn.execute("SELECT COUNT(*) FROM queue WHERE name = ? AND ready_at > ? AND token IS NULL",
+                                      (self.name, time.time())).fetchone()[0]
+
+    @contextmanager
+    def _transaction(self):
+        # BEGIN IMMEDIATE获取写锁，多个进程的读改写依次执行
+        with self._db_lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+            self._conn.execute("COMMIT")
+
+    def _delay(self, delay, key):
+        # 该key之前收到过wake时立即可见
+        if key is None:
+            return delay
+        woken = self._conn.execute("DELETE FROM queue_woken WHERE name = ? AND wake_key = ? AND woken_at > ?",
+                                   (self.name, key, time.time() - self.wake_ttl)).rowcount
+        return 0 if woken else delay
+
+    def _claim(self):
+        # 多个进程同时取任务时不会取到同一条
+        now = time.time()
+        with self._transaction():
+            row = self._conn.execute("""
+                    SELECT id, token, data FROM queue q
+                    WHERE name = ? AND ready_at <= ? AND (token IS NULL OR lease_until <= ?)
+                      AND (partition IS NULL OR NOT EXISTS (
+                        SELECT 1 FROM queue l WHERE l.name = q.name AND l.partition = q.partition
+                          AND l.token IS NOT NULL AND l.lease_until > ?))
+                    ORDER BY ready_at, id LIMIT 1
+                """, (self.name, now, now, now)).fetchone()
+            if row is None:
+                return None
+            message_id, expired, data = row
+            token = uuid.uuid4().hex
+            self._conn.execute("UPDATE queue SET token = ?, lease_until = ? WHERE id = ?",
+                               (token, now + self.visibility, message_id))
+        job = load_job(data)
+        if expired is not None:
+            logging.warning(">>> %s lease expired, redelivering: %r", self.name, job)
+        return Lease(job, message_id, token)
+
+    def _notify(self):
+        with self._cond:
+            self._cond.notify_all()
+
+
+# redis队列的key使用相同的hash tag，在redis cluster中位于同一个slot，脚本可以原子地操作
+# ready: 有序集合，分数为可见时间；leases: 有序集合，分数为租约到期时间；
+# jobs、partitions、tokens、keys: 任务id -> 内容、分区、租约token、唤醒key；
+# locks: 分区 -> 持有租约的任务id；wake: 唤醒key -> 任务id；woken: 有序集合，提前到达的唤醒key，分数为时间
+REDIS_KEYS = ("ready", "leases", "jobs", "partitions", "tokens", "keys", "locks", "wake", "woken")
+
+_RELEASE = """
+local function release(id)
+  redis.call('ZREM', KEYS[2], id)
+  redis.call('HDEL', KEYS[5], id)
+  local p = redis.call('HGET', KEYS[4], id)
+  if p and redis.call('HGET', KEYS[7], p) == id then
+    redis.call('HDEL', KEYS[7], p)
+  end
+end
+-- 登记唤醒key，该key之前收到过wake时返回now，立即可见
+local function set_key(id, key, ready_at, now, ttl)
+  if key ~= '' then
+    redis.call('HSET', KEYS[6], id, key)
+    redis.call('HSET', KEYS[8], key, id)
+    local woken = redis.call('ZSCORE', KEYS[9], key)
+    if woken then
+      redis.call('ZREM', KEYS[9], key)
+      if tonumber(woken) > tonumber(now) - tonumber(ttl) then
+        return now
+      end
+    end
+  end
+  return ready_at
+end
+"""
+
+# ARGV: id, data, partition, ready_at, key, now, wake_ttl
+REDIS_PUT = _RELEASE + """
+redis.call('HSET', KEYS[3], ARGV[1], ARGV[2])
+if ARGV[3] ~= '' then
+  redis.call('HSET', KEYS[4], ARGV[1], ARGV[3])
+end
+redis.call('ZADD', KEYS[1], set_key(ARGV[1], ARGV[5], ARGV[4], ARGV[6], ARGV[7]), ARGV[1])
+return 1
+"""
+
+# ARGV: now, lease_until, token, 每次最多检查的任务数
+REDIS_CLAIM = _RELEASE + """
+local expired = redis.call('ZRANGEBYSCORE', KEYS[2], '-inf', ARGV[1])
+for _, id in ipairs(expired) do
+  release(id)
+  redis.call('ZADD', KEYS[1], ARGV[1], id)
+end
+local ids = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, tonumber(ARGV[4]))
+for _, id in ipairs(ids) do
+  local p = redis.call('HGET', KEYS[4], id)
+  if (not p) or redis.call('HSETNX', KEYS[7], p, id) == 1 then
+    redis.call('ZREM', KEYS[1], id)
+    redis.call('ZADD', KEYS[2], ARGV[2], id)
+    redis.call('HSET', KEYS[5], id, ARGV[3])
+    return {id, redis.call('HGET', KEYS[3], id), #expired}
+  end
+end
+return false
+"""
+
+# ARGV: id, token
+REDIS_ACK = _RELEASE + """
+if redis.call('HGET', KEYS[5], ARGV[1]) ~= ARGV[2] then
+  return 0
+end
+release(ARGV[1])
+local key = redis.call('HGET', KEYS[6], ARGV[1])
+if key and redis.call('HGET', KEYS[8], key) == ARGV[1] then
+  redis.call('HDEL', KEYS[8], key)
+end
+redis.call('HDEL', KEYS[3], ARGV[1])
+redis.call('HDEL', KEYS[4], ARGV[1])
+redis.call('HDEL', KEYS[6], ARGV[1])
+return 1
+"""
+
+# ARGV: id, token, data, ready_at, key, now, wake_ttl
+REDIS_NACK = _RELEASE + """
+if redis.call('HGET', KEYS[5], ARGV[1]) ~= ARGV[2] then
+  return 0
+end
+release(ARGV[1])
+redis.call('HSET', KEYS[3], ARGV[1], ARGV[3])
+redis.call('ZADD', KEYS[1], set_key(ARGV[1], ARGV[5], ARGV[4], ARGV[6], ARGV[7]), ARGV[1])
+return 1
+"""
+
+# ARGV: key, now, wake_ttl
+REDIS_WAKE = """
+local id = redis.call('HGET', KEYS[8], ARGV[1])
+local score = id and redis.call('ZSCORE', KEYS[1], id)
+if score and tonumber(score) > tonumber(ARGV[2]) then
+  redis.call('HDEL', KEYS[8], ARGV[1])
+  redis.call('ZADD', KEYS[1], ARGV[2], id)
+  return 1
+end
+-- 任务正在执行或尚未挂起，记录下来
+redis.call('ZREMRANGEBYSCORE', KEYS[9], '-inf', tonumber(ARGV[2]) - tonumber(ARGV[3]))
+redis.call('ZADD', KEYS[9], ARGV[2], ARGV[1])
+return 0
+"""
+
+
+class RedisQueue(object):
+    # 保存在redis中的队列，多台机器共享；每个操作为一个lua脚本，取出任务与分区加锁原子完成。
+    # 可见时间和租约使用各进程的本地时间，各机器需要同步时钟
+    durable = True
+
+    def __init__(self, url, name, partition=None, visibility=3600, poll_interval=0.5, prefix="jobqueue",
+                 scan_limit=100, wake_ttl=600):
+        # 只有使用redis队列时才需要安装redis
+        import redis
+
+        self.name = name
+        self.partition = partition
+        self.visibility = visibility
+        self.poll_interval = poll_interval
+        self.scan_limit = scan_limit
+        self.wake_ttl = wake_ttl
+        self.redis = redis.Redis.from_url(url, decode_responses=True)
+        self.keys = ["{}:{{{}}}:{}".format(prefix, name, key) for key in REDIS_KEYS]
+        self._put = self.redis.register_script(REDIS_PUT)
+        self._claim = self.redis.register_script(REDIS_CLAIM)
+        self._ack = self.redis.register_script(REDIS_ACK)
+        self._nack = self.redis.register_script(REDIS_NACK)
+        self._wake = self.redis.register_script(REDIS_WAKE)
+        self._cond = threading.Condition()
+
+    def put(self, job, delay=0, key=None):
+        now = time.time()
+        self._put(keys=self.keys, args=[uuid.uuid4().hex, dump_job(job), _partition_of(self.partition, job) or "",
+                                        now + delay, key or "", now, self.wake_ttl])
+        self._notify()
+
+    def get(self, timeout=None):
+        end = None if timeout is None else time.time() + timeout
+        while True:
+            now = time.time()
+            token = uuid.uuid4().hex
+            claimed = self._claim(keys=self.keys, args=[now, now + self.visibility, token, self.scan_limit])
+            if claimed:
+                message_id, data, expired = claimed
+                if expired:
+                    logging.warning(">>> %s %d leases expired, redelivering", self.name, expired)
+                return Lease(load_job(data), message_id, token)
+            wait = self.poll_interval
+            if end is not None:
+                if end <= time.time():
+                    return None
+                wait = min(wait, end - time.time())
+            with self._cond:
+                self._cond.wait(wait)
+
+    def ack(self, lease):
+        if not self._ack(keys=self.keys, args=[lease.message_id, lease.token]):
+            logging.warning(">>> %s lease lost: %r", self.name, lease)
+            return False
+        self._notify()
+        return True
+
+    def nack(self, lease, delay=0, key=None):
+        now = time.time()
+        if not self._nack(keys=self.keys, args=[lease.message_id, lease.token, dump_job(lease.job),
+                                                now + delay, key or "", now, self.wake_ttl]):
+            logging.warning(">>> %s lease lost: %r", self.name, lease)
+            return False
+        self._notify()
+        return True
+
+    def wake(self, key):
+        woken = bool(self._wake(keys=self.keys, args=[key, time.time(), self.wake_ttl]))
+        if woken:
+            self._notify()
+        return woken
+
+    def qsize(self):
+        return self.redis.zcount(self.keys[0], "-inf", time.time())
+
+    def delayed(self):
+        return self.redis.zcount(self.keys[0], "({}".format(time.time()), "+inf")
+
+    def _notify(self):
+        with self._cond:
+            self._cond.notify_all()
+
+
+def create_queue(backend, name, partition=None, visibility=3600, path=None, url=None):
+    # backend为memory、sqlite或redis；partition(job)返回任务所属的分区，同一分区同时只有一个任务在执行
+    if backend == "sqlite":
+        return SqliteQueue(path, name, partition=partition, visibility=visibility)
+    if backend == "redis":
+        return RedisQueue(url, name, partition=partition, visibility=visibility)
+    if backend == "memory":
+        return MemoryQueue(name, partition=partition, visibility=visibility)
+    raise ValueError("unknown queue backend: {}".format(backend))
@@ -0,0 +1,340 @@
+import re
+import time
+import logging
+import threading
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_EXCEPTION
+
+from langchain_openai import ChatOpenAI
+from langchain_anthropic import ChatAnthropic
+from langchain.schema import HumanMessage, SystemMessage
+
+from config import ANTHROPIC_API_BASE, ANTHROPIC_API_KEY, OPENAI_API_BASE, OPENAI_API_KEY
+from transcript import SENTENCE_END
+from worker import remaining_time, JobTimeout
+from tracing import start_span, bind
+
+# 修改提示词后递增，使已缓存的总结失效
+PROMPT_VERSION = 1
+
+metting_prompt = """我们来玩游戏。 你将扮演 MeetingGPT，一个帮助人们整理会议纪要的中文人工智能。
+    该 AI 旨在将用户输入的录音文字稿整理成逻辑清晰、结构清楚的会议纪要，它知道如何将每条信息放入笔记中对应的位置，尽管同一主题的信息可能散落在文字稿中不同的位置。
+    最重要的游戏规则：
+    （1）永远不要解释你自己，只要给我所要求的输出即可。 如果我要求你在“xx”之间显示一些东西，你会完全按照我的要求显示它。
+    （2）输出格式：第一行为类似'会议讨论了xxx，主要内容包括：'格式的总结内容，后续每一行都是总结的要点，所有要点都以bulletpoint的形式输出，一个bulletpoint下不可以有sub bulletpoint。
+    （3）每一个bulletpoint句末不要有标点，每一个bulletpoint的格式类似为'- **title**：content'
+    （4）以中文输出
+    我将把会议的录音文字稿发给你，你会按照要求输出整理完成的中文会议纪要。"""
+
+# map阶段：每段文字稿只提取要点，不输出总结行
+chunk_prompt = """你将扮演 MeetingGPT，一个帮助人们整理会议纪要的中文人工智能。
+    我会发给你一场长会议录音文字稿中的一段（第{index}段，共{total}段），请提取这一段中讨论的要点。
+    规则：
+    （1）永远不要解释你自己，只输出要点。
+    （2）所有要点都以bulletpoint的形式输出，一个bulletpoint下不可以有sub bulletpoint，格式为'- **title**：content'，句末不要有标点。
+    （3）保留具体的结论、分工、时间节点和数字。
+    （4）以中文输出"""
+
+# reduce阶段：合并各段要点，输出与metting_prompt一致的格式
+reduce_prompt = """你将扮演 MeetingGPT，一个帮助人们整理会议纪要的中文人工智能。
+    我会发给你同一场会议按时间顺序分段整理出的要点，请将它们合并成一份完整的会议纪要，同一主题的要点需要合并，去掉重复内容。
+    最重要的游戏规则：
+    （1）永远不要解释你自己，只要给我所要求的输出即可。
+    （2）输出格式：第一行为类似'会议讨论了xxx，主要内容包括：'格式的总结内容，后续每一行都是总结的要点，所有要点都以bulletpoint的形式输出，一个bulletpoint下不可以有sub bulletpoint。
+    （3）每一个bulletpoint句末不要有标点，每一个bulletpoint的格式类似为'- **title**：content'
+    （4）以中文输出"""
+
+# 中日韩文字及全角标点按1个token估算，其余字符按4个字符1个token估算
+CJK = re.compile(r"[\u3000-\u303f\u3400-\u4dbf\u4e00-\u9fff\uff00-\uffef]")
+# 模型输出中其他形式的列表项，如"* xx"、"1. xx"
+BULLET = re.compile(r"^\s*(?:[*•]|\d+[.、)])\s+")
+
+
+def base_url(model_name):
+    return ANTHROPIC_API_BASE if "claude-3" in model_name else OPENAI_API_BASE
+
+
+def create_chat(model_name, temperature=0.7, streaming=False):
+    if "claude-3" in model_name:
+        model_config = {
+            "temperature": temperature,
+            "model_name": model_name,
+            "streaming": streaming,
+            "anthropic_api_key": ANTHROPIC_API_KEY,
+            # default="https://api.anthropic.com",
+            "anthropic_api_url": ANTHROPIC_API_BASE,
+            "max_retries": 3
+        }
+        return ChatAnthropic(**model_config)
+    model_config = {
+        "temperature": temperature,
+        "model_name": model_name,
+        "streaming": streaming,
+        "openai_api_key": OPENAI_API_KEY,
+        "openai_api_base": OPENAI_API_BASE,
+        "max_retries": 3
+    }
+    return ChatOpenAI(**model_config)
+
+
+class ChatPool(object):
+    # 按(模型, 接口地址, temperature)复用大模型客户端，客户端内的连接池和重试状态由各线程共享
+    # 每个模型单独限制同时请求数，未配置的模型使用default
+    def __init__(self, limits=None):
+        self.limits = {"default": 8}
+        self.limits.update(limits or {})
+        self.clients = {}
+        self.semaphores = {}
+        self.model_stats = {}
+        self._lock = threading.Lock()
+
+    def get(self, model_name, temperature=0.7):
+        key = (model_name, base_url(model_name), temperature)
+        chat = self.clients.get(key)
+        if chat is None:
+            with self._lock:
+                chat = self.clients.get(key)
+                if chat is None:
+                    chat = self.clients[key] = create_chat(model_name, temperature=temperature)
+        return chat
+
+    def _model(self, model_name):
+        semaphore = self.semaphores.get(model_name)
+        if semaphore is None:
+            with self._lock:
+                semaphore = self.semaphores.get(model_name)
+                if semaphore is None:
+                    limit = self.limits.get(model_name, self.limits["default"])
+                    self.model_stats[model_name] = {"requests": 0, "errors": 0, "in_flight": 0, "peak": 0,
+                                                    "latency_total": 0.0, "latency_max": 0.0}
+                    semaphore = self.semaphores[model_name] = threading.BoundedSemaphore(limit)
+        return semaphore, self.model_stats[model_name]
+
+    @contextmanager
+    def limit(self, model_name):
+        semaphore, stats = self._model(model_name)
+        if not semaphore.acquire(timeout=remaining_time()):
+            raise JobTimeout("llm {} timeout".format(model_name))
+        with self._lock:
+            stats["requests"] += 1
+            stats["in_flight"] += 1
+            stats["peak"] = max(stats["peak"], stats["in_flight"])
+        start = time.monotonic()
+        try:
+            yield
+        except Exception:
+            with self._lock:
+                stats["errors"] += 1
+            raise
+        finally:
+            latency = time.monotonic() - start
+            with self._lock:
+                stats["in_flight"] -= 1
+                stats["latency_total"] += latency
+                stats["latency_max"] = max(stats["latency_max"], latency)
+            semaphore.release()
+
+    def invoke(self, model_name, messages, temperature=0.7):
+        chat = self.get(model_name, temperature)
+        with start_span("llm.invoke", model=model_name), self.limit(model_name):
+            return chat.invoke(messages)
+
+    def stream(self, model_name, messages, temperature=0.7):
+        # 逐块返回模型输出，整个流式响应期间占用一个并发名额
+        chat = self.get(model_name, temperature)
+        with start_span("llm.stream", model=model_name), self.limit(model_name):
+            for chunk in chat.stream(messages):
+                yield chunk.content
+
+    def stats(self):
+        result = {}
+        with self._lock:
+            for model_name, stats in self.model_stats.items():
+                result[model_name] = dict(stats, limit=self.limits.get(model_name, self.limits["default"]),
+                                          latency_avg=stats["latency_total"] / (stats["requests"] or 1))
+        return result
+
+
+_chat_pool = None
+_chat_pool_lock = threading.Lock()
+
+
+def configure_chat_pool(limits=None):
+    global _chat_pool
+    with _chat_pool_lock:
+        _chat_pool = ChatPool(limits)
+    return _chat_pool
+
+
+def get_chat_pool():
+    global _chat_pool
+    with _chat_pool_lock:
+        if _chat_pool is None:
+            _chat_pool = ChatPool()
+        return _chat_pool
+
+
+def llm_model(input, model_name="gpt-4o-mini", prompt=metting_prompt):
+    system_message = [SystemMessage(content=prompt)]
+
+    # 不需要上下文
+    messages = system_message + [HumanMessage(content=input)]
+    return get_chat_pool().invoke(model_name, messages).content
+
+
+def llm_model_stream(input, on_text, model_name="gpt-4o-mini", prompt=metting_prompt):
+    # 流式生成，每收到一块输出调用on_text(已生成的全部内容)，返回完整结果
+    messages = [SystemMessage(content=prompt), HumanMessage(content=input)]
+    text = ""
+    for content in get_chat_pool().stream(model_name, messages):
+        if content:
+            text += content
+            on_text(text)
+    return text
+
+
+def estimate_tokens(text):
+    cjk = len(text) - len(CJK.sub("", text))
+    return cjk + (len(text) - cjk + 3) // 4
+
+
+def split_text(text, max_tokens):
+    # 超长的单段发言按句子拆分，单句仍超长时按字符硬切
+    pieces = []
+    current = ""
+    start = 0
+    sentences = []
+    for match in SENTENCE_END.finditer(text):
+        sentences.append(text[start:match.end()])
+        start = match.end()
+    sentences.append(text[start:])
+    for sentence in sentences:
+        while estimate_tokens(sentence) > max_tokens:
+            if current:
+                pieces.append(current)
+                current = ""
+            pieces.append(sentence[:max_tokens])
+            sentence = sentence[max_tokens:]
+        if current and estimate_tokens(current) + estimate_tokens(sentence) > max_tokens:
+            pieces.append(current)
+            current = ""
+        current += sentence
+    if current.strip():
+        pieces.append(current)
+    return pieces
+
+
+def chunk_turns(turns, max_tokens):
+    # 按讲话人边界将(讲话人, 内容)切分为不超过max_tokens的文本块，同一段发言尽量不拆开
+    chunks = []
+    current = []
+    size = 0
+    for speaker, text in turns:
+        head = "{}\n".format(speaker)
+        head_tokens = estimate_tokens(head)
+        tokens = head_tokens + estimate_tokens(text)
+        if tokens > max_tokens:
+            parts = [(head + part, estimate_tokens(part) + head_tokens)
+                     for part in split_text(text, max(max_tokens - head_tokens, 1))]
+        else:
+            parts = [(head + text, tokens)]
+        for part, tokens in parts:
+            if current and size + tokens > max_tokens:
+                chunks.append("\n\n".join(current))
+                current = []
+                size = 0
+            current.append(part)
+            size += tokens
+    if current:
+        chunks.append("\n\n".join(current))
+    return chunks
+
+
+def normalize_summary(text):
+    # 统一列表项为"- "开头，去掉空行，便于生成云文档
+    lines = []
+    for line in text.strip().split("\n"):
+        if not line.strip():
+            continue
+        lines.append(BULLET.sub("- ", line, count=1))
+    return "\n".join(lines)
+
+
+class Summarizer(object):
+    # 长会议map-reduce总结：文字稿按讲话人切块后并发提取要点，再合并为最终纪要
+    # 所有任务共用一个有界线程池，限制同时请求大模型的数量
+    # 分组合并的最大轮数
+    reduce_rounds = 3
+
+    def __init__(self, model_name="gpt-4o-mini", chunk_tokens=6000, workers=4):
+        self.model_name = model_name
+        self.chunk_tokens = chunk_tokens
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="llm")
+
+    def summarize(self, transcript, on_progress=None):
+        # transcript为可迭代的(讲话人, 内容)；指定on_progress时流式生成，随时回调已生成的部分纪要
+        start = time.monotonic()
+        chunks = chunk_turns(transcript, self.chunk_tokens)
+        if len(chunks) <= 1:
+            summary = self._generate("\n\n".join(chunks), metting_prompt, on_progress)
+        else:
+            notes = self.map_chunks(chunks, on_progress)
+            summary = self.reduce_notes(notes, on_progress)
+        logging.info(">>> llm summary: %s chunks, %.1fs", len(chunks), time.monotonic() - start)
+        return normalize_summary(summary)
+
+    def map_chunks(self, chunks, on_progress=None):
+        calls = [(chunk, chunk_prompt.format(index=i + 1, total=len(chunks))) for i, chunk in enumerate(chunks)]
+        if on_progress is None:
+            return self._invoke_all(calls)
+        # 每完成一段就按原顺序推送已完成的要点，无需等待全部完成
+        notes = [None] * len(calls)
+
+        def on_result(index, note):
+            notes[index] = note
+            on_progress("\n".join(note for note in notes if note))
+        return self._invoke_all(calls, on_result)
+
+    def reduce_notes(self, notes, on_progress=None):
+        # 要点合计仍超过上限时分组合并，直到可以一次合并；最多合并reduce_rounds轮，
+        # 合并后分组数不再减少（模型输出没有变短）时，截断每段要点后做最后一次合并
+        count = None
+        for _ in range(self.reduce_rounds):
+            groups = self._reduce_groups(notes)
+            if len(groups) <= 1:
+                return self._generate(groups[0] if groups else "", reduce_prompt, on_progress)
+            if count is not None and len(groups) >= count:
+                break
+            count = len(groups)
+            notes = self._invoke_all([(group, reduce_prompt) for group in groups])
+        budget = max(self.chunk_tokens // max(len(notes), 1) - 8, 1)
+        logging.warning(">>> reduce did not converge, truncating %d notes to %d tokens", len(notes), budget)
+        notes = [(split_text(note, budget) or [""])[0] for note in notes]
+        return self._generate("\n\n".join(self._reduce_groups(notes)), reduce_prompt, on_progress)
+
+    def _reduce_groups(self, notes):
+        return chunk_turns((("第{}段".format(i + 1), note) for i, note in enumerate(notes)), self.chunk_tokens)
+
+    def _generate(self, content, prompt, on_progress=None):
+        if on_progress is None:
+            return llm_model(content, model_name=self.model_name, prompt=prompt)
+        return llm_model_stream(content, on_progress, model_name=self.model_name, prompt=prompt)
+
+    def _invoke_all(self, calls, on_result=None):
+        # 并发执行，结果按提交顺序返回；任一失败或任务超时则整体失败
+        futures = [self.executor.submit(bind(llm_model), content, self.model_name, prompt) for content, prompt in calls]
+        if on_result is not None:
+            for index, future in enumerate(futures):
+                future.add_done_callback(
+                    lambda f, index=index: f.cancelled() or f.exception() or on_result(index, f.result()))
+        done, not_done = wait(futures, timeout=remaining_time(), return_when=FIRST_EXCEPTION)
+        for future in done:
+            if future.exception() is not None:
+                for f in not_done:
+                    f.cancel()
+                raise future.exception()
+        if not_done:
+            for f in not_done:
+                f.cancel()
+            raise JobTimeout("llm summary timeout")
+        return [future.result() for future in futures]
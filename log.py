@@ -0,0 +1,146 @@
+import sys
+import copy
+import json
+import queue
+import atexit
+import reprlib
+import logging
+import contextvars
+from contextlib import contextmanager
+from logging.handlers import QueueHandler, QueueListener
+
+from tracing import current_span
+
+# 当前任务的日志字段，如event_id、meeting_id、stage
+_fields = contextvars.ContextVar("log_fields", default={})
+# 日志中接口响应等内容的最大长度，0为只记录长度
+_payload_limit = 2048
+TEXT_FORMAT = "%(levelname)s:%(name)s:%(message)s"
+_repr = reprlib.Repr()
+_repr.maxlevel = 6
+_repr.maxdict = _repr.maxlist = _repr.maxtuple = 50
+_repr.maxstring = _repr.maxother = _payload_limit
+
+
+@contextmanager
+def log_context(**fields):
+    # 在当前线程/协程中为之后的日志附加字段，值为None的字段不记录
+    token = _fields.set(dict(_fields.get(), **{k: v for k, v in fields.items() if v is not None}))
+    try:
+        yield
+    finally:
+        _fields.reset(token)
+
+
+class Payload(object):
+    # 延迟到日志真正输出时才转换为字符串，超出长度的部分截断
+    __slots__ = ("value", "limit")
+
+    def __init__(self, value, limit=None):
+        self.value = value
+        self.limit = _payload_limit if limit is None else limit
+
+    def __str__(self):
+        value = self.value
+        if isinstance(value, bytes):
+            size = len(value)
+            if self.limit <= 0:
+                return "<{} bytes>".format(size)
+            text = value[:self.limit].decode("utf-8", "replace")
+        elif isinstance(value, str):
+            text = value
+            size = len(text)
+            if self.limit <= 0:
+                return "<{} chars>".format(size)
+            text = text[:self.limit]
+        elif self.limit <= 0:
+            return "<{}>".format(type(value).__name__)
+        else:
+            # dict、list等只生成有限长度的repr，不遍历完整内容
+            text = _repr.repr(value)
+            size = len(text)
+            text = text[:self.limit]
+        if size > self.limit:
+            text += "...<{} more>".format(size - self.limit)
+        return text
+
+    __repr__ = __str__
+
+
+def payload(value, limit=None):
+    return Payload(value, limit)
+
+
+class ContextFilter(logging.Filter):
+    # 在调用日志的线程中读取上下文字段，日志记录稍后在后台线程中输出
+    def filter(self, record):
+        record.__dict__.update(_fields.get())
+        span = current_span()
+        if span is not None:
+            record.trace_id = span.trace_id
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    fields = ("event_id", "meeting_id", "job_id", "stage", "trace_id")
+
+    def format(self, record):
+        item = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "thread": record.threadName,
+            "message": record.getMessage(),
+        }
+        for name in self.fields:
+            value = getattr(record, name, None)
+            if value is not None:
+                item[name] = value
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            item["exception"] = record.exc_text
+        return json.dumps(item, ensure_ascii=False, default=str)
+
+
+class AsyncQueueHandler(QueueHandler):
+    # 调用线程只做消息插值（getMessage），记录参数当时的值；不调用Formatter，
+    # 时间、文本/JSON格式、异常堆栈的格式化和写入都由QueueListener的后台线程完成；
+    # 队列满时丢弃日志，不阻塞业务线程
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        # 队列在进程内，exc_info原样传给后台线程，不需要像默认实现那样先格式化
+        record = copy.copy(record)
+        record.message = record.getMessage()
+        record.msg = record.message
+        record.args = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+def configure_logging(level="INFO", json_format=False, queue_size=10000, payload_limit=2048, stream=None):
+    global _payload_limit
+    _payload_limit = payload_limit
+    _repr.maxstring = _repr.maxother = max(payload_limit, 20)
+    output = logging.StreamHandler(stream or sys.stderr)
+    output.setFormatter(JsonFormatter() if json_format else logging.Formatter(TEXT_FORMAT))
+    handler = AsyncQueueHandler(queue.Queue(queue_size))
+    handler.addFilter(ContextFilter())
+    root = logging.getLogger()
+    for existing in list(root.handlers):
+        root.removeHandler(existing)
+    root.addHandler(handler)
+    root.setLevel(level)
+    listener = QueueListener(handler.queue, output, respect_handler_level=True)
+    listener.start()
+    # 退出前输出队列中剩余的日志
+    atexit.register(listener.stop)
+    return handler
@@ -0,0 +1,142 @@
+import re
+
+from document import Block
+
+# 飞书云文档块类型
+TEXT = 2
+HEADING1 = 3
+BULLET = 12
+ORDERED = 13
+CODE = 14
+QUOTE = 15
+DIVIDER = 22
+
+# 块类型对应的json字段名，heading1~heading9的块类型为3~11
+BLOCK_KEYS = {TEXT: "text", BULLET: "bullet", ORDERED: "ordered", CODE: "code", QUOTE: "quote"}
+BLOCK_KEYS.update({HEADING1 + i: "heading{}".format(i + 1) for i in range(9)})
+
+HEADING = re.compile(r"^(#{1,9})\s+(.*)$")
+LIST_ITEM = re.compile(r"^(\s*)(?:([-*+])|(\d+)[.)])\s+(.*)$")
+FENCE = re.compile(r"^\s*```")
+HR = re.compile(r"^\s*(?:-{3,}|\*{3,}|_{3,})\s*$")
+# 行内标记，按优先级依次为：行内代码、链接、加粗、删除线、斜体
+INLINE = re.compile(r"`([^`]+)`|\[([^\]]+)\]\(([^)\s]+)\)|\*\*(.+?)\*\*|__(.+?)__|~~(.+?)~~|\*([^*\s][^*]*?)\*")
+
+# 所有块共用的段落样式，只读
+BLOCK_STYLE = {"align": 1, "folded": False}
+# 代码块样式，1为纯文本
+CODE_STYLE = {"language": 1, "wrap": False}
+_text_styles = {}
+
+
+def text_style(bold=False, italic=False, strikethrough=False, inline_code=False):
+    # 相同组合的样式只创建一次，序列化时共用同一个dict
+    key = (bold, italic, strikethrough, inline_code)
+    style = _text_styles.get(key)
+    if style is None:
+        style = _text_styles[key] = {
+            "bold": bold,
+            "inline_code": inline_code,
+            "italic": italic,
+            "strikethrough": strikethrough,
+            "underline": False
+        }
+    return style
+
+
+def text_run(content, style=None, url=None):
+    if style is None:
+        style = text_style()
+    if url:
+        style = dict(style, link={"url": url})
+    return {"text_run": {"content": content, "text_element_style": style}}
+
+
+def inline_elements(text, bold=False, italic=False, strikethrough=False, elements=None):
+    # 解析行内标记生成text_run列表，嵌套的标记递归处理，未闭合的标记按原文输出
+    if elements is None:
+        elements = []
+    style = text_style(bold, italic, strikethrough)
+    start = 0
+    for match in INLINE.finditer(text):
+        if match.start() > start:
+            elements.append(text_run(text[start:match.start()], style))
+        code, link_text, url, bold_text, bold_text2, strike_text, italic_text = match.groups()
+        if code is not None:
+            elements.append(text_run(code, text_style(bold, italic, strikethrough, inline_code=True)))
+        elif link_text is not None:
+            elements.append(text_run(link_text, style, url=url))
+        elif bold_text is not None or bold_text2 is not None:
+            inline_elements(bold_text or bold_text2, True, italic, strikethrough, elements)
+        elif strike_text is not None:
+            inline_elements(strike_text, bold, italic, True, elements)
+        else:
+            inline_elements(italic_text, bold, True, strikethrough, elements)
+        start = match.end()
+    if start < len(text):
+        elements.append(text_run(text[start:], style))
+    return elements
+
+
+def block(block_type, elements, style=BLOCK_STYLE):
+    body = {"elements": elements, "style": style}
+    return Block({"block_type": block_type, BLOCK_KEYS[block_type]: body})
+
+
+def text_block(content, bold=False):
+    return block(TEXT, [text_run(content, text_style(bold))])
+
+
+def heading_block(level, content, bold=False):
+    return block(HEADING1 + level - 1, [text_run(content, text_style(bold))])
+
+
+def compile_markdown(text):
+    # 单次遍历将Markdown转换为云文档块树：标题、多级有序/无序列表、引用、代码块、分割线，
+    # 其余非空行为普通文本；列表按缩进嵌套为子块
+    blocks = []
+    # 列表嵌套栈：(缩进, 列表项块)
+    stack = []
+    code_lines = None
+    for line in text.split("\n"):
+        if code_lines is not None:
+            if FENCE.match(line):
+                blocks.append(block(CODE, [text_run("\n".join(code_lines))], style=CODE_STYLE))
+                code_lines = None
+            else:
+                code_lines.append(line)
+            continue
+        if not line.strip():
+            continue
+        if FENCE.match(line):
+            stack = []
+            code_lines = []
+            continue
+        if HR.match(line):
+            stack = []
+            blocks.append(Block({"block_type": DIVIDER, "divider": {}}))
+            continue
+        match = LIST_ITEM.match(line)
+        if match and not match.group(4).strip():
+            continue
+        if match:
+            indent = len(match.group(1).expandtabs(4))
+            block_type = BULLET if match.group(2) else ORDERED
+            item = block(block_type, inline_elements(match.group(4).strip()))
+            while stack and stack[-1][0] >= indent:
+                stack.pop()
+            (stack[-1][1].children if stack else blocks).append(item)
+            stack.append((indent, item))
+            continue
+        stack = []
+        line = line.strip()
+        match = HEADING.match(line)
+        if match:
+            blocks.append(block(HEADING1 + len(match.group(1)) - 1, inline_elements(match.group(2).strip())))
+        elif line.startswith(">"):
+            blocks.append(block(QUOTE, inline_elements(line.lstrip(">").strip())))
+        else:
+            blocks.append(block(TEXT, inline_elements(line)))
+    if code_lines:
+        blocks.append(block(CODE, [text_run("\n".join(code_lines))], style=CODE_STYLE))
+    return blocks
@@ -0,0 +1,156 @@
+import threading
+
+# 默认直方图分桶（秒），覆盖单次接口调用到整段录制等待
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800, 3600)
+
+
+def format_labels(names, values, extra=None):
+    pairs = list(zip(names, values))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ""
+    escaped = (str(v).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"') for _, v in pairs)
+    return "{" + ",".join('{}="{}"'.format(k, v) for (k, _), v in zip(pairs, escaped)) + "}"
+
+
+def format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+class Metric(object):
+    kind = "untyped"
+
+    def __init__(self, name, help, labels=(), func=None):
+        # 指定func时在导出时调用，返回{标签值元组: 数值}，用于导出各组件stats()中已有的计数
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.func = func
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def header(self):
+        return ["# HELP {} {}".format(self.name, self.help), "# TYPE {} {}".format(self.name, self.kind)]
+
+    def render(self):
+        if self.func is not None:
+            values = self.func()
+            with self._lock:
+                self._values = dict(values)
+        lines = self.header()
+        with self._lock:
+            items = sorted(self._values.items())
+        for labels, value in items:
+            lines.append("{}{} {}".format(self.name, format_labels(self.labels, labels), format_value(value)))
+        return lines
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def set(self, value, *labels):
+        with self._lock:
+            self._values[labels] = value
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets)) + (float("inf"),)
+
+    def observe(self, value, *labels):
+        with self._lock:
+            item = self._values.get(labels)
+            if item is None:
+                # [各分桶计数, 总和, 总数]
+                item = self._values[labels] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    item[0][i] += 1
+                    break
+            item[1] += value
+            item[2] += 1
+
+    def render(self):
+        lines = self.header()
+        with self._lock:
+            items = sorted((labels, (list(item[0]), item[1], item[2])) for labels, item in self._values.items())
+        for labels, (counts, total, count) in items:
+            cumulative = 0
+            for bound, n in zip(self.buckets, counts):
+                cumulative += n
+                lines.append("{}_bucket{} {}".format(
+                    self.name, format_labels(self.labels, labels, ("le", format_value(float(bound)))), cumulative))
+            lines.append("{}_sum{} {}".format(self.name, format_labels(self.labels, labels), format_value(total)))
+            lines.append("{}_count{} {}".format(self.name, format_labels(self.labels, labels), count))
+        return lines
+
+
+class Registry(object):
+    def __init__(self):
+        self.metrics = {}
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            return self.metrics.setdefault(metric.name, metric)
+
+    def render(self):
+        # Prometheus文本格式
+        with self._lock:
+            metrics = list(self.metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+
+def counter(name, help, labels=(), func=None):
+    return REGISTRY.register(Counter(name, help, labels, func=func))
+
+
+def gauge(name, help, labels=(), func=None):
+    return REGISTRY.register(Gauge(name, help, labels, func=func))
+
+
+def histogram(name, help, labels=(), buckets=DEFAULT_BUCKETS):
+    return REGISTRY.register(Histogram(name, help, labels, buckets))
+
+
+# 流水线阶段
+STAGE_SECONDS = histogram("pipeline_stage_seconds", "Time spent executing a pipeline stage once.",
+                          ("pipeline", "stage"))
+STAGE_TOTAL_SECONDS = histogram("pipeline_stage_total_seconds",
+                                "Time from entering a stage to leaving it, including polling waits.",
+                                ("pipeline", "stage"))
+STAGE_RETRIES = counter("pipeline_stage_retries_total", "Poll attempts that asked to retry a stage.",
+                        ("pipeline", "stage"))
+JOBS = counter("pipeline_jobs_total", "Finished pipeline jobs by status.", ("pipeline", "status"))
+
+# 飞书开放平台接口
+FEISHU_SECONDS = histogram("feishu_request_seconds", "Feishu open platform request latency.", ("endpoint",))
+FEISHU_RESPONSES = counter("feishu_responses_total", "Feishu open platform responses by status code.",
+                           ("endpoint", "status"))
+# 限流按令牌桶分组统计，未单独配置速率的接口计入default
+FEISHU_THROTTLED = counter("feishu_throttled_total", "Feishu responses with status 429.", ("endpoint",))
+FEISHU_RETRIES = counter("feishu_retries_total", "Feishu requests retried after status 429.", ("endpoint",))
+FEISHU_BACKOFF = counter("feishu_backoff_seconds_total",
+                         "Time requests waited for rate limit tokens or Retry-After.", ("endpoint",))
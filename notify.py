@@ -0,0 +1,82 @@
+import time
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from tracing import bind
+
+
+class Notifier(object):
+    # 消息卡片批量发送：接收人按接口上限分批并发发送，失败的批次只重试其中的接收人，
+    # 接口返回的无效open_id不再重试；发送速率由FeishuClient的message分组限流控制
+    batch_size = 200
+
+    def __init__(self, client, workers=8, retries=2):
+        self.client = client
+        self.retries = retries
+        self.requests = 0
+        self.sent = 0
+        self.invalid = 0
+        self.failed = 0
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="notify")
+
+    def send_card(self, open_ids, card, headers=None):
+        # 返回{"sent": [...], "invalid": [...], "failed": [...]}
+        pending = list(dict.fromkeys(open_ids))
+        sent = []
+        invalid = []
+        for attempt in range(self.retries + 1):
+            batches = [pending[i:i + self.batch_size] for i in range(0, len(pending), self.batch_size)]
+            if len(batches) == 1:
+                results = [self._send_batch(batches[0], card, headers)]
+            else:
+                results = list(self._executor.map(bind(lambda batch: self._send_batch(batch, card, headers)), batches))
+            pending = []
+            for batch, result in zip(batches, results):
+                if result is None:
+                    pending.extend(batch)
+                    continue
+                invalid.extend(result)
+                result = set(result)
+                sent.extend(open_id for open_id in batch if open_id not in result)
+            if not pending or attempt == self.retries:
+                break
+            delay = min(2 ** attempt, 10)
+            logging.info(">>> notify %s recipients failed, retry after %s", len(pending), delay)
+            time.sleep(delay)
+        with self._lock:
+            self.sent += len(sent)
+            self.invalid += len(invalid)
+            self.failed += len(pending)
+        return {"sent": sent, "invalid": invalid, "failed": pending}
+
+    def _send_batch(self, open_ids, card, headers):
+        # 发送成功时返回无效的open_id列表，失败时返回None
+        with self._lock:
+            self.requests += 1
+        body = {
+            "open_ids": open_ids,
+            "msg_type": "interactive",
+            "card": card,
+        }
+        try:
+            response = self.client.send_message_batch(body, headers=headers)
+            if response.status_code != 200:
+                return None
+            result = response.json()
+            if result.get("code") != 0:
+                logging.error(">>> batch send failed: %s %s", result.get("code"), result.get("msg"))
+                return None
+            return (result.get("data") or {}).get("invalid_open_ids") or []
+        except Exception as e:
+            logging.error(">>> ERROR: %s", e)
+            return None
+
+    def stats(self):
+        return {
+            "requests": self.requests,
+            "sent": self.sent,
+            "invalid": self.invalid,
+            "failed": self.failed,
+        }
@@ -0,0 +1,114 @@
+import logging
+
+from cache import TTLCache
+
+# 参会人类型：1为飞书用户，其余为会议室、PSTN、SIP等设备
+LARK_USER = 1
+
+
+class ParticipantResolver(object):
+    # 解析会议参会人：分页读取完整的参会人明细，合并同一人多次入会的记录；
+    # 明细中没有用户类型，会议详情中也没有的参会人通过通讯录批量查询，
+    # 查询结果按open_id缓存，会议的参会人列表按meeting_id缓存，在各任务间共享
+    page_size = 100
+    max_pages = 100
+    # 通讯录批量查询每次最多50个用户
+    batch_size = 50
+
+    def __init__(self, client, maxsize=10000, ttl=3600):
+        self.client = client
+        self.users = TTLCache(maxsize=maxsize, ttl=ttl)
+        self.meetings = TTLCache(maxsize=maxsize, ttl=ttl)
+
+    def resolve(self, meeting_id, meeting, start_time, end_time):
+        # meeting为get_meeting返回的会议详情，返回按首次入会顺序排列的参会人
+        participants = self.meetings.get(meeting_id)
+        if participants is None:
+            # 有序去重，保留首次入会的顺序
+            found = {}
+            for item in meeting.get("participants") or []:
+                self._merge(found, item.get("id"), user_type=item.get("user_type"),
+                            is_external=item.get("is_external"))
+            complete = True
+            if meeting.get("meeting_no"):
+                try:
+                    for item in self._participant_list(meeting["meeting_no"], start_time, end_time):
+                        if item.get("meeting_room_id"):
+                            continue
+                        self._merge(found, item.get("user_id"), name=item.get("participant_name"))
+                except Exception as e:
+                    # 明细接口失败时使用已读取的参会人，不缓存不完整的列表
+                    logging.error(">>> ERROR: participant list %s", e)
+                    complete = False
+            participants = list(found.values())
+            if complete:
+                self.meetings.set(meeting_id, participants)
+        users = self.lookup([user["open_id"] for user in participants if "user_type" not in user])
+        return [dict(users.get(user["open_id"]) or {}, **user) for user in participants]
+
+    def lookup(self, open_ids):
+        # 查询用户类型和姓名，缓存中没有的分批调用通讯录接口；查询失败的用户本次按未知类型处理
+        users = {}
+        missing = []
+        for open_id in open_ids:
+            user = self.users.get(open_id)
+            if user is None:
+                missing.append(open_id)
+            else:
+                users[open_id] = user
+        for i in range(0, len(missing), self.batch_size):
+            batch = missing[i:i + self.batch_size]
+            try:
+                items = self._batch_get_users(batch)
+            except Exception as e:
+                logging.error(">>> ERROR: contact users %s", e)
+                continue
+            for open_id in batch:
+                # 通讯录中查不到的用户（如外部用户）同样缓存，避免重复查询
+                item = items.get(open_id)
+                user = {"open_id": open_id}
+                if item is not None:
+                    user.update(name=item.get("name"), user_type=LARK_USER, is_external=False)
+                self.users.set(open_id, user)
+                users[open_id] = user
+        return users
+
+    def _merge(self, found, open_id, **fields):
+        if not open_id:
+            return
+        user = found.setdefault(open_id, {"open_id": open_id})
+        for key, value in fields.items():
+            if value is not None:
+                user[key] = value
+
+    def _batch_get_users(self, open_ids):
+        response = self.client.batch_get_users(open_ids)
+        if response.status_code != 200:
+            raise Exception("contact users api failed")
+        result = response.json()
+        if result.get("code") != 0:
+            raise Exception("contact users failed: {} {}".format(result.get("code"), result.get("msg")))
+        items = (result.get("data") or {}).get("items") or []
+        return {item.get("open_id"): item for item in items}
+
+    def _participant_list(self, meeting_no, start_time, end_time):
+        page_token = None
+        for _ in range(self.max_pages):
+            response = self.client.get_participant_list(meeting_no, start_time, end_time,
+                                                        page_token=page_token, page_size=self.page_size)
+            if response.status_code != 200:
+                raise Exception("participant list api failed")
+            result = response.json()
+            if result.get("code") != 0:
+                raise Exception("participant list failed: {} {}".format(result.get("code"), result.get("msg")))
+            data = result.get("data") or {}
+            for item in data.get("participants") or []:
+                yield item
+            page_token = data.get("page_token")
+            if not data.get("has_more") or not page_token:
+                return
+
+
+def is_lark_user(user):
+    # 未知类型时按飞书用户处理
+    return user.get("user_type", LARK_USER) == LARK_USER and not user.get("is_external")
@@ -0,0 +1,122 @@
+import time
+import asyncio
+import logging
+import threading
+
+from metrics import FEISHU_THROTTLED, FEISHU_BACKOFF
+
+
+class TokenBucket(object):
+    # 令牌桶限流，遇到429时速率减半，请求成功后逐步恢复
+    def __init__(self, rate, burst=None, min_rate=0.2, name="default"):
+        self.name = name
+        self.max_rate = float(rate)
+        self.rate = float(rate)
+        self.min_rate = min(min_rate, self.max_rate)
+        self.capacity = float(burst or max(rate, 1))
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0
+        self.throttled = 0
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self):
+        # 预占一个令牌，返回需要等待的秒数
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            self.tokens -= 1
+            wait = max(self.blocked_until - now, 0)
+            if self.tokens < 0:
+                wait = max(wait, -self.tokens / self.rate)
+            return wait
+
+    def acquire(self):
+        wait = self.reserve()
+        if wait > 0:
+            FEISHU_BACKOFF.inc(self.name, amount=wait)
+            time.sleep(wait)
+
+    async def acquire_async(self):
+        wait = self.reserve()
+        if wait > 0:
+            FEISHU_BACKOFF.inc(self.name, amount=wait)
+            await asyncio.sleep(wait)
+
+    def on_response(self, status_code, headers):
+        with self._lock:
+            now = time.monotonic()
+            if status_code == 429:
+                self.throttled += 1
+                FEISHU_THROTTLED.inc(self.name)
+                self._refill(now)
+                self.rate = max(self.rate / 2, self.min_rate)
+                wait = retry_after(headers)
+                if wait:
+                    self.blocked_until = max(self.blocked_until, now + wait)
+                logging.warning(">>> rate limited, rate -> %.2f/s, retry after %s", self.rate, wait)
+            elif self.rate < self.max_rate:
+                self.rate = min(self.rate + self.max_rate * 0.05, self.max_rate)
+
+    def stats(self):
+        return {
+            "rate": self.rate,
+            "max_rate": self.max_rate,
+            "tokens": self.tokens,
+            "throttled": self.throttled,
+        }
+
+
+def retry_after(headers):
+    # 优先使用Retry-After，其次使用开放平台返回的x-ogw-ratelimit-reset
+    for name in ("Retry-After", "x-ogw-ratelimit-reset"):
+        value = headers.get(name)
+        if value:
+            try:
+                return max(float(value), 0)
+            except ValueError:
+                continue
+    return None
+
+
+class RateLimiter(object):
+    # 按接口分组维护令牌桶，未配置的分组使用default
+    def __init__(self, rates=None):
+        self.rates = {"default": 10}
+        self.rates.update(rates or {})
+        self.buckets = {}
+        self._lock = threading.Lock()
+
+    def bucket(self, endpoint):
+        endpoint = endpoint if endpoint in self.rates else "default"
+        bucket = self.buckets.get(endpoint)
+        if bucket is None:
+            with self._lock:
+                bucket = self.buckets.setdefault(endpoint, TokenBucket(self.rates[endpoint], name=endpoint))
+        return bucket
+
+    def stats(self):
+        return {endpoint: bucket.stats() for endpoint, bucket in list(self.buckets.items())}
+
+
+_rate_limiter = None
+_rate_limiter_lock = threading.Lock()
+
+
+def configure_rate_limiter(rates=None):
+    global _rate_limiter
+    with _rate_limiter_lock:
+        _rate_limiter = RateLimiter(rates)
+    return _rate_limiter
+
+
+def get_rate_limiter():
+    global _rate_limiter
+    with _rate_limiter_lock:
+        if _rate_limiter is None:
+            _rate_limiter = RateLimiter()
+        return _rate_limiter
@@ -1,37 +1,45 @@
-import copy
 import os
 import time
 import json
-import datetime
 import logging
 import asyncio
-import threading
-import queue
 import locale
 
 from dotenv import find_dotenv, load_dotenv
-from urllib.parse import urlencode, quote
-from feishu import FeishuClient
+from urllib.parse import urlencode
+from feishu import FeishuClient, AsyncFeishuClient, configure_http_pool, create_async_http_pool
+from ratelimit import configure_rate_limiter
+from worker import WorkerPool, AsyncWorkerPool, StageLimiter, Scheduler, Pipeline, Retry, start_event_loop
+from store import JobStore
+from jobqueue import create_queue
+from cache import SummaryCache, create_ttl_cache
+from transcript import TranscriptParser
+from document import DocumentWriter
+from builders import meeting_card, record_link, button, oauth_url, summary_card, document_page
+from card import CardUpdater
+from notify import Notifier
+from participants import ParticipantResolver, is_lark_user
+from metrics import REGISTRY, gauge, counter
+from tracing import configure_tracing, start_span, current_traceparent
+from log import configure_logging, payload
+from llm import Summarizer, configure_chat_pool, normalize_summary, PROMPT_VERSION
 from config import *
 
 from connectai.lark.oauth import Server as OauthServer
 from connectai.lark.sdk import Bot, MarketBot
 from connectai.lark.webhook import LarkServer
 from connectai.storage import ExpiredDictStorage
-from langchain_openai import ChatOpenAI
-from langchain_anthropic import ChatAnthropic
-from langchain.schema import (
-    get_buffer_string,
-    HumanMessage,
-    AIMessage,
-    SystemMessage,
-    ChatMessage,
-    FunctionMessage
-)
 
 load_dotenv(find_dotenv())
 
-logging.basicConfig(level=logging.INFO)
+# 日志在后台线程中输出
+log_handler = configure_logging(
+    level=os.environ.get("LOG_LEVEL") or LOG_LEVEL,
+    json_format=(os.environ.get("LOG_FORMAT") or LOG_FORMAT) == "json",
+    queue_size=int(os.environ.get("LOG_QUEUE_SIZE") or LOG_QUEUE_SIZE),
+    payload_limit=int(os.environ.get("LOG_PAYLOAD_LIMIT") or LOG_PAYLOAD_LIMIT),
+)
+gauge("log_records_dropped", "Log records dropped because the log queue was full.", func=lambda: {(): log_handler.dropped})
 hook = LarkServer()
 oauth = OauthServer()
 bot = Bot(
@@ -43,857 +51,804 @@ bot = Bot(
     host=os.environ.get("HOST") or HOST
 )
 
-meeting_queue = queue.Queue()
-def meeting_handler():
-    while True:
-        event_id, event, bot = meeting_queue.get()
-        logging.info("============================ event_id: {}".format(event_id))
-        logging.info(">>> event_info: %r", event)
-
-        meeting_no = event["meeting"]["meeting_no"]
-        meeting_topic = event["meeting"]["topic"]
-        meeting_source = event["meeting"]["meeting_source"]
-        start_time = str(int(event["meeting"]["start_time"]) - 1)
-        end_time = event["meeting"]["end_time"]
-        open_id = event["meeting"]["owner"]["id"]["open_id"]
-        card_content = {
-            "config": {},
-            "header": {
-                "title": {
-                    "tag": "plain_text",
-                    "content": meeting_topic + " - 智能纪要"
-                },
-                "template": "default"
-            },
-            "elements": [
-                {
-                    "tag": "note",
-                    "elements": [
-                        {
-                            "tag": "plain_text",
-                            "content": get_gmt_time(start_time, end_time)
-                        }
-                    ]
-                },
-                {
-                    "tag": "markdown",
-                    "content": "",
-                    "text_align": "left",
-                    "text_size": "normal"
-                },
-            ]
-        }
-        client = FeishuClient(bot=bot)
-
-        # 1为日程会议，2为即时会议，3为面试会议，4为开放平台会议，100为其他会议类型
-        if meeting_source in [1, 2]:
-            try:
-                # 根据会议号获取会议ID
-                meeting_url_response = client.get_meeting_list_by_no(meeting_no, start_time, end_time)
-                if meeting_url_response.status_code == 200:
-                    meeting_data = meeting_url_response.json()
-                    if "data" in meeting_data and "meeting_briefs" in meeting_data['data'] and len(
-                            meeting_data['data']['meeting_briefs']):
-                        meeting_id = meeting_data['data']['meeting_briefs'][0]['id']
-                    else:
-                        raise Exception("no meeting id")
-                else:
-                    raise Exception("meeting api failed")
-                logging.info(">>> meeting id: {}".format(meeting_id))
-            except Exception as e:
-                logging.error(">>> ERROR: {}".format(str(e)))
-                card_content["elements"][1]["content"] = "**未查询到会议ID**"
-                bot.send_card(open_id, card_content)
-                continue
-
-            try:
-                # 根据会议ID获取会议录制文件
-                count = 0
-                allCount = 20
-                record_url = None
-                while count < allCount:
-                    logging.info(">>> time {}".format(count + 1))
-                    get_record_response = client.get_record(meeting_id)
-                    if get_record_response.status_code == 200:
-                        record_data = get_record_response.json()
-                        if "data" in record_data:
-                            record_url = record_data["data"]["recording"]["url"]
-                            break
-                    if count == allCount - 1:
-                        break
-                    logging.info(">>> no record, sleep {}".format(10 * (count + 1)))
-                    time.sleep(10 * (count + 1))
-                    count += 1
-
-                if not record_url:
-                    raise Exception("no record url")
-                logging.info(">>> record url: {}".format(record_url))
-            except Exception as e:
-                logging.error(">>> ERROR: {}".format(str(e)))
-                card_content["elements"][1]["content"] = "**未查询到录制文件**"
-                bot.send_card(open_id, card_content)
-                continue
-
-            # 发送卡片消息
-            card_content["elements"][1]["content"] = "录制文件（妙记）：[{}]({})".format(meeting_topic, record_url)
-            card_resp = bot.send_card(open_id, card_content)
-            message_id = card_resp.json()["data"]["message_id"]
-            logging.info(">>> message resp: {}".format(card_resp.json()))
-            logging.info(">>> message_id: {}".format(message_id))
-
-            state_info = json.dumps({
-                "message_id": message_id,
-                "open_id": open_id,
-                "meeting_id": meeting_id,
-                "record_url": record_url,
-                "start_time": start_time,
-                "end_time": end_time,
-            }, separators=(',', ':'))
-
-            # 返回oauth授权地址
-            scope = quote("minutes:minute:download minutes:minutes minutes:minutes:readonly")
-            inner_oauth = f"{DOMAIN}/oauth/feishu?app_id={bot.app_id}&scope={scope}&state_dict={state_info}"
-            feishu_url = f"{bot.host}/open-apis/authen/v1/authorize?app_id={bot.app_id}&redirect_uri={quote(inner_oauth)}&scope={scope}&state={bot.app_id}"
-            oauth_url = f"{APPLINK_HOST}/client/web_url/open?mode=appCenter&url=" + quote(feishu_url)
-
-            card_content["elements"].append(
-                {
-                    "tag": "action",
-                    "actions": [
-                        {
-                            "tag": "button",
-                            "text": {
-                                "tag": "plain_text",
-                                "content": "授权生成会议纪要"
-                            },
-                            "url": oauth_url,
-                            "type": "primary",
-                            "complex_interaction": True,
-                            "width": "default",
-                            "size": "medium"
-                        }
-                    ]
-                }
-            )
-
-            card_resp1 = bot.update_card(message_id, card_content)
-            logging.info(">>> card_resp1 code: {}".format(card_resp1.status_code))
-            logging.info(">>> card_resp1 content: {}".format(card_resp1.content))
-        else:
-            card_content["elements"][1]["content"] = "**不支持的会议类型**"
-            bot.send_card(open_id, card_content)
-threading.Thread(target=meeting_handler, daemon=True).start()
-
-
-oauth_queue = queue.Queue()
-def oauth_handler():
-    while True:
-        bot, user_info = oauth_queue.get()
-        logging.info("============================ oauth process")
-        logging.info(">>> user_info: %r", user_info)
-
-        client = FeishuClient(bot=bot)
-        state_dict = json.loads(user_info["state_dict"])
-        message_id = state_dict["message_id"]
-        open_id = user_info["open_id"]
-        record_url = state_dict["record_url"]
-        meeting_id = state_dict["meeting_id"]
-        start_time = state_dict["start_time"]
-        end_time = state_dict["end_time"]
-
-        try:
-            # 获取会议详情
-            meeting_detail_response = client.get_meeting(meeting_id)
-            if meeting_detail_response.status_code == 200:
-                meeting_detail = meeting_detail_response.json()
-                if "data" in meeting_detail and "meeting" in meeting_detail['data']:
-                    meeting_users = [i["id"] for i in meeting_detail["data"]["meeting"]["participants"]]
-                    meeting_topic = meeting_detail["data"]["meeting"]["topic"]
-                else:
-                    raise Exception("no meeting detail")
+def env_mapping(name, default, cast=int):
+    # 解析 "key:value,key:value" 格式的配置
+    mapping = {}
+    for item in (os.environ.get(name) or default).split(","):
+        if ":" in item:
+            key, value = item.split(":", 1)
+            mapping[key.strip()] = cast(value)
+    return mapping
+
+
+MEETING_WORKERS = int(os.environ.get("MEETING_WORKERS") or MEETING_WORKERS)
+OAUTH_WORKERS = int(os.environ.get("OAUTH_WORKERS") or OAUTH_WORKERS)
+JOB_TIMEOUT = int(os.environ.get("JOB_TIMEOUT") or JOB_TIMEOUT)
+ASYNC_PIPELINE = (os.environ.get("ASYNC_PIPELINE") or str(ASYNC_PIPELINE)) not in ("0", "false", "False", "")
+ASYNC_CONCURRENCY = int(os.environ.get("ASYNC_CONCURRENCY") or ASYNC_CONCURRENCY)
+QUEUE_BACKEND = os.environ.get("QUEUE_BACKEND") or QUEUE_BACKEND
+QUEUE_DB = os.environ.get("QUEUE_DB") or QUEUE_DB
+QUEUE_URL = os.environ.get("QUEUE_URL") or QUEUE_URL
+QUEUE_VISIBILITY = int(os.environ.get("QUEUE_VISIBILITY") or QUEUE_VISIBILITY) or JOB_TIMEOUT
+QUEUE_CONSUMER = (os.environ.get("QUEUE_CONSUMER") or str(QUEUE_CONSUMER)) not in ("0", "false", "False", "")
+stages = StageLimiter(env_mapping("STAGE_LIMITS", STAGE_LIMITS))
+http_pool = configure_http_pool(
+    max_connections=int(os.environ.get("HTTP_POOL_SIZE") or HTTP_POOL_SIZE),
+    keepalive_expiry=float(os.environ.get("HTTP_KEEPALIVE") or HTTP_KEEPALIVE),
+    connect_timeout=float(os.environ.get("HTTP_CONNECT_TIMEOUT") or HTTP_CONNECT_TIMEOUT),
+    read_timeouts=env_mapping("HTTP_READ_TIMEOUTS", HTTP_READ_TIMEOUTS, cast=float),
+)
+rate_limiter = configure_rate_limiter(env_mapping("RATE_LIMITS", RATE_LIMITS, cast=float))
+tracer = configure_tracing(os.environ.get("TRACE_EXPORTER") or TRACE_EXPORTER,
+                           path=os.environ.get("TRACE_FILE") or TRACE_FILE,
+                           endpoint=os.environ.get("OTLP_ENDPOINT") or OTLP_ENDPOINT)
+# 任务状态只用于进程内队列重启后恢复，sqlite、redis队列本身保存未完成的任务；用户凭证在任务结束后删除
+job_store = JobStore(os.environ.get("JOB_DB") or JOB_DB, redact=("user_info",)) if QUEUE_BACKEND == "memory" else None
+JOB_RETENTION = int(os.environ.get("JOB_RETENTION") or JOB_RETENTION)
+# 入口去重：会议事件按event_id，oauth回调按meeting_id+open_id；
+# 与任务队列使用相同的后端，多个进程、多台机器之间共享
+event_dedup = create_ttl_cache(QUEUE_BACKEND, "event_dedup",
+                               maxsize=int(os.environ.get("DEDUP_SIZE") or DEDUP_SIZE),
+                               ttl=int(os.environ.get("DEDUP_TTL") or DEDUP_TTL), path=QUEUE_DB, url=QUEUE_URL)
+# 录制完成事件：meeting_id -> 妙记地址，由接收事件的进程写入，执行wait_record的进程读取
+recording_ready = create_ttl_cache(QUEUE_BACKEND, "recording_ready",
+                                   maxsize=int(os.environ.get("DEDUP_SIZE") or DEDUP_SIZE),
+                                   ttl=int(os.environ.get("DEDUP_TTL") or DEDUP_TTL), path=QUEUE_DB, url=QUEUE_URL)
+# 相同文字稿的总结结果，重复授权或任务重试时直接复用
+summary_cache = SummaryCache(maxsize=int(os.environ.get("SUMMARY_CACHE_SIZE") or SUMMARY_CACHE_SIZE),
+                             ttl=int(os.environ.get("SUMMARY_CACHE_TTL") or SUMMARY_CACHE_TTL),
+                             path=os.environ.get("SUMMARY_CACHE_DB") or SUMMARY_CACHE_DB or None)
+
+POLL_COUNT = 20
+# 流式读取妙记文字记录的分块大小（字符）
+TRANSCRIPT_CHUNK_SIZE = 64 * 1024
+RECORD_POLL_INTERVAL = int(os.environ.get("RECORD_POLL_INTERVAL") or RECORD_POLL_INTERVAL)
+SUMMARY_BACKEND = os.environ.get("SUMMARY_BACKEND") or SUMMARY_BACKEND
+chat_pool = configure_chat_pool(env_mapping("LLM_CONCURRENCY", LLM_CONCURRENCY))
+LLM_STREAMING = (os.environ.get("LLM_STREAMING") or str(LLM_STREAMING)) not in ("0", "false", "False", "")
+CARD_UPDATE_INTERVAL = float(os.environ.get("CARD_UPDATE_INTERVAL") or CARD_UPDATE_INTERVAL)
+summarizer = Summarizer(
+    # model_name="claude-3-sonnet-20240229"
+    model_name=os.environ.get("LLM_MODEL") or LLM_MODEL,
+    chunk_tokens=int(os.environ.get("LLM_CHUNK_TOKENS") or LLM_CHUNK_TOKENS),
+    workers=int(os.environ.get("LLM_WORKERS") or LLM_WORKERS),
+)
+scheduler = Scheduler().start()
+client = FeishuClient(bot=bot)
+DOCX_DESCENDANT = (os.environ.get("DOCX_DESCENDANT") or str(DOCX_DESCENDANT)) not in ("0", "false", "False", "")
+# 参会人信息在各任务间共享
+participant_resolver = ParticipantResolver(client, maxsize=int(os.environ.get("USER_CACHE_SIZE") or USER_CACHE_SIZE),
+                                           ttl=int(os.environ.get("USER_CACHE_TTL") or USER_CACHE_TTL))
+notifier = Notifier(client, workers=int(os.environ.get("NOTIFY_WORKERS") or NOTIFY_WORKERS))
+# 同一张卡片的更新合并发送，终态立即发送；合并只发生在一个任务内（同一进程），
+# 每个任务都以终态更新结束，多个进程之间不需要共享
+card_updater = CardUpdater(bot, scheduler, interval=CARD_UPDATE_INTERVAL)
+document_writer = DocumentWriter(client, workers=int(os.environ.get("DOCX_WORKERS") or DOCX_WORKERS),
+                                 descendant=DOCX_DESCENDANT)
+if ASYNC_PIPELINE:
+    # 异步模式：轮询阶段在同一个事件循环中并发执行，其余阶段在线程池中执行
+    event_loop = start_event_loop()
+
+    async def create_async_client():
+        # 异步连接池只能在创建它的事件循环中使用，在事件循环线程中创建
+        return AsyncFeishuClient(bot=bot, pool=create_async_http_pool())
+
+    async_client = asyncio.run_coroutine_threadsafe(create_async_client(), event_loop).result()
+else:
+    event_loop = None
+    async_client = None
+
+
+def purge_jobs():
+    # 启动时及之后每小时清理过期的已结束任务
+    try:
+        job_store.purge(time.time() - JOB_RETENTION)
+    except Exception:
+        logging.exception(">>> job store purge failed")
+    scheduler.call_later(3600, purge_jobs)
+
+
+if job_store:
+    purge_jobs()
+
+
+def create_queue_for(name, partition):
+    # 同一会议的任务按meeting_id分区，同时只有一个在执行
+    return create_queue(QUEUE_BACKEND, name, partition=partition, visibility=QUEUE_VISIBILITY,
+                        path=QUEUE_DB, url=QUEUE_URL)
+
+
+def create_workers(name, pipeline, jobs, workers):
+    if ASYNC_PIPELINE:
+        pool = AsyncWorkerPool(name, pipeline, loop=event_loop, jobs=jobs, concurrency=ASYNC_CONCURRENCY,
+                               executor_workers=workers, timeout=JOB_TIMEOUT, store=job_store)
+    else:
+        pool = WorkerPool(name, pipeline.run, jobs=jobs, workers=workers, timeout=JOB_TIMEOUT, store=job_store)
+    if not QUEUE_CONSUMER:
+        return pool
+    return pool.start().resume()
+
+
+def poll_delay(job):
+    # 轮询间隔随重试次数线性增长
+    return 10 * (job.attempt + 1)
+
+
+meeting_queue = create_queue_for("meeting", lambda job: job.data["event"]["meeting"].get("id")
+                                 or job.data["event"]["meeting"]["meeting_no"])
+meeting_pipeline = Pipeline("meeting", first="lookup", store=job_store)
+
+
+@meeting_pipeline.stage("lookup")
+def stage_meeting_lookup(job):
+    data = job.data
+    event = data["event"]
+    logging.info("============================ event_id: %s", data["event_id"])
+    logging.info(">>> event_info: %s", payload(event))
+
+    meeting_no = event["meeting"]["meeting_no"]
+    meeting_topic = event["meeting"]["topic"]
+    meeting_source = event["meeting"]["meeting_source"]
+    start_time = str(int(event["meeting"]["start_time"]) - 1)
+    end_time = event["meeting"]["end_time"]
+    open_id = event["meeting"]["owner"]["id"]["open_id"]
+    card_content = meeting_card(meeting_topic, start_time, end_time)
+    data.update({
+        "meeting_topic": meeting_topic,
+        "start_time": start_time,
+        "end_time": end_time,
+        "open_id": open_id,
+        "card_content": card_content,
+    })
+
+    # 1为日程会议，2为即时会议，3为面试会议，4为开放平台会议，100为其他会议类型
+    if meeting_source not in [1, 2]:
+        card_content["elements"][1]["content"] = "**不支持的会议类型**"
+        bot.send_card(open_id, card_content)
+        return None
+
+    try:
+        # 根据会议号获取会议ID
+        with stages("meeting"):
+            meeting_url_response = client.get_meeting_list_by_no(meeting_no, start_time, end_time)
+        if meeting_url_response.status_code == 200:
+            meeting_data = meeting_url_response.json()
+            if "data" in meeting_data and "meeting_briefs" in meeting_data['data'] and len(
+                    meeting_data['data']['meeting_briefs']):
+                meeting_id = meeting_data['data']['meeting_briefs'][0]['id']
             else:
-                raise Exception("meeting detail api failed")
-            logging.info(">>> meeting users: {}".format(meeting_users))
-        except Exception as e:
-            logging.error(">>> ERROR: {}".format(str(e)))
-            bot.send_card(open_id, "未获取到会议详情")
-            continue
-
-        card_content = {
-            "config": {},
-            "header": {
-                "title": {
-                    "tag": "plain_text",
-                    "content": meeting_topic + " - 智能纪要"
-                },
-                "template": "default"
-            },
-            "elements": [
-                {
-                    "tag": "note",
-                    "elements": [
-                        {
-                            "tag": "plain_text",
-                            "content": get_gmt_time(start_time, end_time)
-                        }
-                    ]
-                },
-                {
-                    "tag": "markdown",
-                    "content": "录制文件（妙记）：[{}]({})".format(meeting_topic, record_url),
-                    "text_align": "left",
-                    "text_size": "normal"
-                },
-                {
-                    "tag": "action",
-                    "actions": [
-                        {
-                            "tag": "button",
-                            "text": {
-                                "tag": "plain_text",
-                                "content": "智能纪要生成中..."
-                            },
-                            "type": "primary",
-                            "complex_interaction": True,
-                            "width": "default",
-                            "size": "medium"
-                        }
-                    ]
-                }
-            ]
-        }
-        bot.update_card(message_id, card_content)
-
-        try:
-            # 获取妙计文字记录
-            count = 0
-            allCount = 20
-            file_obj = None
-            minute_token = record_url.split("?")[0].split("minutes/")[-1]
-            while count < allCount:
-                logging.info(">>> time {}".format(count + 1))
-                record_file_response = client.get_record_minute(minute_token, headers={
-                    "Authorization": "Bearer {}".format(user_info['user_access_token']['access_token'])})
-                if record_file_response.status_code == 200:
-                    file_obj = record_file_response.text
-                    break
-                if count == allCount - 1:
-                    break
-                logging.info(">>> no record file, sleep {}".format(10 * (count + 1)))
-                time.sleep(10 * (count + 1))
-                count += 1
-
-            if not file_obj:
-                raise Exception("no record file")
-            logging.info(">>> record file: {}".format(len(file_obj)))
-        except Exception as e:
-            logging.error(">>> ERROR: {}".format(str(e)))
-            card_content["elements"][2]["actions"][0]["text"]["content"] = "未查询到录制文件内容"
-            bot.update_card(message_id, card_content)
-            continue
-
-        try:
-            # 获取妙计详情
-            record_detail_resp = client.get_minute(minute_token, headers={
-                "Authorization": "Bearer {}".format(user_info['user_access_token']['access_token'])})
-            if record_detail_resp.status_code == 200:
-                record_detail = record_detail_resp.json()
+                raise Exception("no meeting id")
+        else:
+            raise Exception("meeting api failed")
+        logging.info(">>> meeting id: %s", meeting_id)
+    except Exception as e:
+        logging.error(">>> ERROR: %s", e)
+        card_content["elements"][1]["content"] = "**未查询到会议ID**"
+        bot.send_card(open_id, card_content)
+        return None
+
+    data["meeting_id"] = meeting_id
+    return "wait_record"
+
+
+def record_key(meeting_id):
+    return "record:{}".format(meeting_id)
+
+
+def ready_record_url(job):
+    # 已收到录制完成事件时直接使用事件中的地址，无需调用get_record
+    record_url = recording_ready.get(job.data["meeting_id"])
+    if record_url:
+        job.data["record_url"] = record_url
+        logging.info(">>> record url from event: %s", record_url)
+    return record_url
+
+
+def on_record_response(job, response):
+    # 处理录制文件查询结果，同步和异步阶段共用
+    data = job.data
+    if response.status_code == 200:
+        record_data = response.json()
+        if "data" in record_data:
+            data["record_url"] = record_data["data"]["recording"]["url"]
+            logging.info(">>> record url: %s", data["record_url"])
+            return "send_card"
+    # 查询期间收到的录制完成事件没有可唤醒的任务，挂起前再检查一次
+    if ready_record_url(job):
+        return "send_card"
+    if job.attempt < POLL_COUNT - 1:
+        # 录制完成事件会提前唤醒任务，轮询只作为兜底
+        delay = max(poll_delay(job), RECORD_POLL_INTERVAL)
+        logging.info(">>> no record, retry after %s", delay)
+        return Retry(delay, key=record_key(data["meeting_id"]))
+    raise Exception("no record url")
+
+
+def on_record_error(job, e):
+    logging.error(">>> ERROR: %s", e)
+    card_content = job.data["card_content"]
+    card_content["elements"][1]["content"] = "**未查询到录制文件**"
+    bot.send_card(job.data["open_id"], card_content)
+    return None
+
+
+@meeting_pipeline.stage("wait_record")
+def stage_meeting_wait_record(job):
+    try:
+        # 根据会议ID获取会议录制文件，未就绪时挂起任务等待下次轮询
+        logging.info(">>> time %s", job.attempt + 1)
+        if ready_record_url(job):
+            return "send_card"
+        with stages("get_record"):
+            get_record_response = client.get_record(job.data["meeting_id"])
+        return on_record_response(job, get_record_response)
+    except Exception as e:
+        return on_record_error(job, e)
+
+
+@meeting_pipeline.async_stage("wait_record")
+async def async_stage_meeting_wait_record(job):
+    # 录制完成事件的读取（sqlite、redis）和结果处理为阻塞调用，在线程池中执行，不阻塞其他协程
+    try:
+        logging.info(">>> time %s", job.attempt + 1)
+        if await asyncio.to_thread(ready_record_url, job):
+            return "send_card"
+        get_record_response = await async_client.get_record(job.data["meeting_id"])
+        return await asyncio.to_thread(on_record_response, job, get_record_response)
+    except Exception as e:
+        return await asyncio.to_thread(on_record_error, job, e)
+
+
+@meeting_pipeline.stage("send_card")
+def stage_meeting_send_card(job):
+    data = job.data
+    card_content = data["card_content"]
+    meeting_topic = data["meeting_topic"]
+    record_url = data["record_url"]
+    open_id = data["open_id"]
+
+    # 发送卡片消息
+    card_content["elements"][1]["content"] = record_link(meeting_topic, record_url)
+    card_resp = bot.send_card(open_id, card_content)
+    message_id = card_resp.json()["data"]["message_id"]
+    logging.info(">>> message resp: %s", payload(card_resp.content))
+    logging.info(">>> message_id: %s", message_id)
+
+    # 授权按钮，state_dict在授权回调中原样带回
+    state = {
+        "message_id": message_id,
+        "open_id": open_id,
+        "meeting_id": data["meeting_id"],
+        "record_url": record_url,
+        "start_time": data["start_time"],
+        "end_time": data["end_time"],
+        # 授权回调沿用会议事件的trace
+        "traceparent": current_traceparent(),
+    }
+    card_content["elements"].append(
+        button("授权生成会议纪要", oauth_url(state, bot.app_id, bot.host, DOMAIN, APPLINK_HOST)))
+
+    card_resp1 = card_updater.update(message_id, card_content, final=True)
+    logging.info(">>> card_resp1 code: %s", card_resp1.status_code)
+    logging.info(">>> card_resp1 content: %s", payload(card_resp1.content))
+    return None
+
+
+meeting_workers = create_workers("meeting", meeting_pipeline, meeting_queue, MEETING_WORKERS)
+
+
+oauth_queue = create_queue_for("oauth", lambda job: json.loads(job.data["user_info"]["state_dict"])["meeting_id"])
+oauth_pipeline = Pipeline("oauth", first="meeting_detail", store=job_store)
+
+
+def user_headers(job):
+    return {"Authorization": "Bearer {}".format(job.data["user_info"]['user_access_token']['access_token'])}
+
+
+def oauth_dedup_key(meeting_id, open_id):
+    return "oauth:{}:{}".format(meeting_id, open_id)
+
+
+def release_oauth(job):
+    # 任务失败后允许用户重新点击授权
+    user_info = job.data["user_info"]
+    event_dedup.pop(oauth_dedup_key(json.loads(user_info["state_dict"])["meeting_id"], user_info["open_id"]))
+
+
+@oauth_pipeline.on_failure
+def on_oauth_failure(job):
+    # 任务异常或超时：卡片更新为失败状态，覆盖尚未发送的中间状态
+    if "card_content" in job.data:
+        oauth_fail(job, "智能纪要生成失败")
+    else:
+        release_oauth(job)
+
+
+def oauth_fail(job, content):
+    # 更新卡片按钮为失败状态并结束任务
+    release_oauth(job)
+    card_content = job.data["card_content"]
+    card_content["elements"][2]["actions"][0]["text"]["content"] = content
+    card_updater.update(job.data["message_id"], card_content, final=True)
+    return None
+
+
+@oauth_pipeline.stage("meeting_detail")
+def stage_oauth_meeting_detail(job):
+    data = job.data
+    user_info = data["user_info"]
+    logging.info("============================ oauth process")
+    logging.info(">>> user_info: %s", payload(user_info))
+
+    state_dict = json.loads(user_info["state_dict"])
+    message_id = state_dict["message_id"]
+    open_id = user_info["open_id"]
+    record_url = state_dict["record_url"]
+    meeting_id = state_dict["meeting_id"]
+    start_time = state_dict["start_time"]
+    end_time = state_dict["end_time"]
+
+    try:
+        # 获取会议详情
+        meeting_detail_response = client.get_meeting(meeting_id)
+        if meeting_detail_response.status_code == 200:
+            meeting_detail = meeting_detail_response.json()
+            if "data" in meeting_detail and "meeting" in meeting_detail['data']:
+                meeting = meeting_detail["data"]["meeting"]
+                meeting_topic = meeting["topic"]
+                # 分页获取完整参会人，会议室、外部人员等无法接收消息的参会人不在通知列表中
+                participants = participant_resolver.resolve(meeting_id, meeting, start_time, end_time)
+                meeting_users = [user["open_id"] for user in participants if is_lark_user(user)]
             else:
-                raise Exception("record detail api failed")
-            logging.info(">>> record detail: {}".format(record_detail))
-        except Exception as e:
-            logging.error(">>> ERROR: {}".format(str(e)))
-            card_content["elements"][2]["actions"][0]["text"]["content"] = "未获取到妙计详情"
-            bot.update_card(message_id, card_content)
-            continue
-
-        # file_obj = """
-        # 2024-08-24 15:19:33 CST|45分钟 6秒
-        #
-        # 关键词:
-        # 软件产品设计、用户界面、功能需求、用户体验、性能优化、竞争分析
-        #
-        # 讲话人1
-        # 大家好，今天我们主要讨论新软件产品的设计和功能需求。我先介绍一下我们的目标和方向。这款软件主要面向中小型企业，旨在提供高效的项目管理和团队协作工具。我们需要确保用户界面友好，功能强大且易于使用。
-        #
-        # 讲话人2
-        # 是的，用户界面（UI）和用户体验（UX）的设计非常重要。我建议我们采用现代简洁的设计风格，避免过多的复杂元素。按钮和操作区域需要明显且易于点击，同时确保在不同设备上的兼容性。
-        #
-        # 讲话人3
-        # 在功能方面，我们需要重点关注以下几个模块：项目管理、任务分配、团队沟通和文件共享。每个模块都需要有明确的操作流程，确保用户能够快速上手。此外，我们还需要考虑性能优化，确保在高负载情况下软件运行流畅。
-        #
-        # 讲话人4
-        # 我这里有一些竞争对手的分析数据。我们主要的竞争对手有Trelo、Asana和Monday.com。它们各有优势，但也存在一些不足。我们可以借鉴它们的优点，同时避免它们的缺点。例如，Trelo的界面简洁但功能较少，Asana功能全面但界面复杂。我们需要找到一个平衡点。
-        #
-        # 讲话人5
-        # 在测试方面，我们会分阶段进行功能测试和性能测试。首先是单元测试，确保每个功能模块都能正常运行；然后是集成测试，确保各个模块之间的交互没有问题；最后是性能测试，模拟高并发场景，确保系统的稳定性。
-        #
-        # 讲话人6
-        # 作为客户代表，我想强调用户反馈的重要性。在产品上线之前，我们可以邀请一部分目标用户进行试用，并收集他们的反馈意见。这些反馈可以帮助我们优化产品，提升用户满意度。
-        #
-        # 讲话人1
-        # 非常感谢大家的建议和意见。总结一下，我们需要在接下来的时间内完成以下任务：UI/UX设计师负责界面设计，开发团队负责功能开发和性能优化，测试团队制定测试计划，市场分析师继续进行竞争分析，客户代表准备用户试用计划。我们每周进行一次进度汇报，确保项目按计划推进。
-        #
-        # 讲话人2
-        # 没问题，我会在下周之前提交初步的界面设计稿，供大家评审。
-        #
-        # 讲话人3
-        # 我们会根据设计稿开始功能开发，并与UI/UX设计师保持密切沟通，确保设计与开发同步进行。
-        #
-        # 讲话人4
-        # 我会继续收集和分析竞争对手的动态，并定期汇报给大家。
-        #
-        # 讲话人5
-        # 我们会制定详细的测试计划，并在每个开发阶段进行相应的测试。
-        #
-        # 讲话人6
-        # 我会联系一些潜在用户，邀请他们参与我们的试用计划，并准备收集反馈。
-        #
-        # 讲话人1
-        # 好的，那今天的会议就到这里。谢谢大家的参与和贡献。我们下周同一时间再见。
-        # """
-        if False:
-            # 总结方案1: 通过大模型总结
-            try:
-                summary_data = llm_model(file_obj, model_name="gpt-4o-mini")
-                # summary_data = llm_model(file_obj, model_name="claude-3-sonnet-20240229")
-                # summary_data = llm_model(file_obj, model_name="claude-3-opus-20240229")
-                logging.info(">>> summary_data: %r", summary_data)
-            except Exception as e:
-                logging.error(">>> ERROR: {}".format(str(e)))
-                card_content["elements"][2]["actions"][0]["text"]["content"] = "调用LLM总结失败"
-                bot.update_card(message_id, card_content)
-                continue
+                raise Exception("no meeting detail")
         else:
-            # 总结方案2: 通过调用飞书会议总结api
+            raise Exception("meeting detail api failed")
+        logging.info(">>> meeting users: %s", payload(meeting_users))
+    except Exception as e:
+        logging.error(">>> ERROR: %s", e)
+        bot.send_card(open_id, "未获取到会议详情")
+        release_oauth(job)
+        return None
+
+    card_content = meeting_card(meeting_topic, start_time, end_time, record_link(meeting_topic, record_url),
+                                button("智能纪要生成中..."))
+    # 生成中状态可能很快被流式总结的进度覆盖，允许合并
+    card_updater.update(message_id, card_content)
+
+    data.update({
+        "message_id": message_id,
+        "open_id": open_id,
+        "record_url": record_url,
+        "meeting_id": meeting_id,
+        "start_time": start_time,
+        "end_time": end_time,
+        "meeting_topic": meeting_topic,
+        "meeting_users": meeting_users,
+        "participants": participants,
+        "card_content": card_content,
+        "minute_token": record_url.split("?")[0].split("minutes/")[-1],
+    })
+    return "fetch_transcript"
+
+
+def on_transcript(job, transcript):
+    # 处理妙记文字记录解析结果，同步和异步阶段共用
+    if transcript is not None and len(transcript):
+        job.data["_transcript"] = transcript
+        logging.info(">>> record file: %s turns, %s chars", len(transcript), transcript.char_count())
+        return "minute_detail"
+    if job.attempt < POLL_COUNT - 1:
+        logging.info(">>> no record file, retry after %s", poll_delay(job))
+        return Retry(poll_delay(job))
+    raise Exception("no record file")
+
+
+def on_transcript_error(job, e):
+    logging.error(">>> ERROR: %s", e)
+    return oauth_fail(job, "未查询到录制文件内容")
+
+
+@oauth_pipeline.stage("fetch_transcript")
+def stage_oauth_fetch_transcript(job):
+    try:
+        # 流式获取妙计文字记录并边读边解析，未就绪时挂起任务等待下次轮询
+        logging.info(">>> time %s", job.attempt + 1)
+        transcript = None
+        with stages("get_record_minute"):
+            response = client.get_record_minute(job.data["minute_token"], headers=user_headers(job), stream=True)
             try:
-                bbody = {
-                    "transcripts": [
-                        {
-                            "paragraph_id": 123,
-                            "start_ms": 111,
-                            "end_ms": 222,
-                            "sentences": [
-                                {
-                                    "sentence_id": 1234,
-                                    "content": file_obj,
-                                    "lang": "zh_cn",
-                                    "start_ms": 111,
-                                    "stop_ms": 222,
-                                }
-                            ]
-                        }
-                    ],
-                    "duration": record_detail["data"]["minute"]["duration"],
-                    "topic": record_detail["data"]["minute"]["title"],
-                    "operator_id": record_detail["data"]["minute"]["owner_id"],
-                }
-                summary_task_resp = client.submit_summary_task(bbody,
-                                        headers={"Authorization": "Bearer {}".format(
-                                            user_info['user_access_token']['access_token'])})
-                if summary_task_resp.status_code == 200:
-                    summary_task = summary_task_resp.json()
-                    task_id = summary_task["data"]["task_id"]
-                else:
-                    raise Exception("submit summary task api failed")
-                logging.info(">>> task_id: {}".format(task_id))
-            except Exception:
-                logging.error(">>> ERROR: {}".format(str(e)))
-                card_content["elements"][2]["actions"][0]["text"]["content"] = "提交会议总结任务失败"
-                bot.update_card(message_id, card_content)
-                continue
-
-            try:
-                # 获取智能会议总结结果
-                count = 0
-                allCount = 20
-                summary = None
-                while count < allCount:
-                    logging.info(">>> time {}".format(count + 1))
-                    get_task_response = client.get_summary_task(task_id, headers={
-                        "Authorization": "Bearer {}".format(user_info['user_access_token']['access_token'])})
-                    if get_task_response.status_code == 200:
-                        task_data = get_task_response.json()
-                        if "data" in task_data and task_data["code"] == 0:
-                            summary = task_data["data"]
-                            break
-                    if count == allCount - 1:
-                        break
-                    logging.info(">>> no summary, sleep {}".format(10 * (count + 1)))
-                    time.sleep(10 * (count + 1))
-                    count += 1
-
-                if not summary:
-                    raise Exception("no summary")
-                logging.info(">>> summary: {}".format(summary))
-
-                if "paragraph" in summary and "data" in summary["paragraph"]:
-                    summary_data = summary["paragraph"]["data"]
-                else:
-                    summary_data = ""
-                if not summary_data:
-                    card_content["elements"][2]["actions"][0]["text"]["content"] = "录制内容太短，未生成总结"
-                    bot.update_card(message_id, card_content)
-                    continue
-            except Exception as e:
-                logging.error(">>> ERROR: {}".format(str(e)))
-                card_content["elements"][2]["actions"][0]["text"]["content"] = "未查询到智能总结结果"
-                bot.update_card(message_id, card_content)
-                continue
-
+                if response.status_code == 200:
+                    parser = TranscriptParser()
+                    for chunk in response.iter_text(TRANSCRIPT_CHUNK_SIZE):
+                        parser.feed(chunk)
+                    transcript = parser.close()
+            finally:
+                response.close()
+        return on_transcript(job, transcript)
+    except Exception as e:
+        return on_transcript_error(job, e)
+
+
+@oauth_pipeline.async_stage("fetch_transcript")
+async def async_stage_oauth_fetch_transcript(job):
+    try:
+        logging.info(">>> time %s", job.attempt + 1)
+        transcript = None
+        response = await async_client.get_record_minute(job.data["minute_token"], headers=user_headers(job), stream=True)
         try:
-            # 创建云文档
-            docx_body = {
-                "title": meeting_detail["data"]["meeting"]["topic"] + " - 智能会议纪要",
-            }
-            docx_response = client.create_docx(docx_body, headers={"Authorization": "Bearer {}".format(
-                                    user_info['user_access_token']['access_token'])})
-            if docx_response.status_code == 200:
-                docx_data = docx_response.json()
-                document_id = docx_data["data"]["document"]["document_id"]
-            else:
-                raise Exception("create docx api failed")
-            logging.info(">>> document_id: {}".format(document_id))
-        except Exception:
-            logging.error(">>> ERROR: {}".format(str(e)))
-            card_content["elements"][2]["actions"][0]["text"]["content"] = "创建云文档失败"
-            bot.update_card(message_id, card_content)
-            continue
-
+            if response.status_code == 200:
+                parser = TranscriptParser()
+                async for chunk in response.aiter_text(TRANSCRIPT_CHUNK_SIZE):
+                    parser.feed(chunk)
+                transcript = parser.close()
+        finally:
+            await response.aclose()
+        return await asyncio.to_thread(on_transcript, job, transcript)
+    except Exception as e:
+        return await asyncio.to_thread(on_transcript_error, job, e)
+
+
+@oauth_pipeline.stage("minute_detail")
+def stage_oauth_minute_detail(job):
+    data = job.data
+    try:
+        # 获取妙计详情
+        record_detail_resp = client.get_minute(data["minute_token"], headers=user_headers(job))
+        if record_detail_resp.status_code == 200:
+            record_detail = record_detail_resp.json()
+        else:
+            raise Exception("record detail api failed")
+        logging.info(">>> record detail: %s", payload(record_detail))
+    except Exception as e:
+        logging.error(">>> ERROR: %s", e)
+        return oauth_fail(job, "未获取到妙计详情")
+
+    data["minute"] = {
+        "duration": record_detail["data"]["minute"]["duration"],
+        "title": record_detail["data"]["minute"]["title"],
+        "owner_id": record_detail["data"]["minute"]["owner_id"],
+    }
+    return "summarize"
+
+
+def summary_progress(job):
+    # 流式总结时把已生成的纪要推送到卡片，更新频率由card_updater控制
+    data = job.data
+
+    def on_progress(text):
+        card_content = dict(data["card_content"])
+        elements = card_content["elements"] = list(card_content["elements"])
+        elements[1] = dict(elements[1], content=elements[1]["content"] + "\n\n" + normalize_summary(text))
         try:
-            # 创建块
-            block_body = {
-                "index": 0,  # 表示创建的块的索引
-                "children": [
-                    {
-                        "block_type": 3,
-                        "heading1": {
-                            "elements": [
-                                {
-                                    "text_run": {
-                                        "content": "会议信息",
-                                        "text_element_style": {
-                                            "bold": False,
-                                            "inline_code": False,
-                                            "italic": False,
-                                            "strikethrough": False,
-                                            "underline": False
-                                        }
-                                    }
-                                }
-                            ],
-                            "style": {
-                                "align": 1,
-                                "folded": False
-                            }
-                        }
-                    },
-                    {
-                        "block_type": 2,
-                        "text": {
-                            "elements": [
-                                {
-                                    "text_run": {
-                                        "content": "会议主题：{}".format(meeting_detail["data"]["meeting"]["topic"]),
-                                        "text_element_style": {
-                                            "bold": False,
-                                            "inline_code": False,
-                                            "italic": False,
-                                            "strikethrough": False,
-                                            "underline": False
-                                        }
-                                    }
-                                }
-                            ],
-                            "style": {
-                                "align": 1,
-                                "folded": False
-                            }
-                        }
-                    },
-                    {
-                        "block_type": 2,
-                        "text": {
-                            "elements": [
-                                {
-                                    "text_run": {
-                                        "content": "会议时间：{}".format(get_gmt_time(start_time, end_time)),
-                                        "text_element_style": {
-                                            "bold": False,
-                                            "inline_code": False,
-                                            "italic": False,
-                                            "strikethrough": False,
-                                            "underline": False
-                                        }
-                                    }
-                                }
-                            ],
-                            "style": {
-                                "align": 1,
-                                "folded": False
-                            }
-                        }
-                    },
-                    {
-                        "block_type": 2,
-                        "text": {
-                            "elements": [
-                                {
-                                    "text_run": {
-                                        "content": "参会人：",
-                                        "text_element_style": {
-                                            "bold": False,
-                                            "inline_code": False,
-                                            "italic": False,
-                                            "strikethrough": False,
-                                            "underline": False
-                                        }
-                                    }
-                                },
-                            ],
-                            "style": {
-                                "align": 1,
-                                "folded": False
-                            }
-                        }
-                    },
-                    {
-                        "block_type": 3,
-                        "heading1": {
-                            "elements": [
-                                {
-                                    "text_run": {
-                                        "content": "智能纪要",
-                                        "text_element_style": {
-                                            "bold": False,
-                                            "inline_code": False,
-                                            "italic": False,
-                                            "strikethrough": False,
-                                            "underline": False
-                                        }
-                                    }
-                                }
-                            ],
-                            "style": {
-                                "align": 1,
-                                "folded": False
-                            }
-                        },
-                    },
-                    {
-                        "block_type": 34,
-                        "quote_container": {}
-                    },
-                    {
-                        "block_type": 19,
-                        "callout": {
-                            "background_color": 5,
-                            "emoji_id": "page_facing_up"
-                        },
-                    },
-                ]
-            }
-
-            quote_container_block = {
-                "index": 0,  # 表示创建的块的索引
-                "children": [
-                    {
-                        "block_type": 2,
-                        "text": {
-                            "elements": [
-                                {
-                                    "text_run": {
-                                        "content": "智能纪要依据会中总结内容生成，不代表平台立场，请谨慎甄别后使用",
-                                        "text_element_style": {
-                                            "bold": False,
-                                            "inline_code": False,
-                                            "italic": False,
-                                            "strikethrough": False,
-                                            "underline": False
-                                        }
-                                    }
-                                }
-                            ],
-                            "style": {
-                                "align": 1,
-                                "folded": False
-                            }
-                        }
-                    }
-                ]
-            }
-            callout_block = {
-                "index": 0,  # 表示创建的块的索引
-                "children": [
-                    {
-                        "block_type": 4,
-                        "heading2": {
-                            "elements": [
-                                {
-                                    "text_run": {
-                                        "content": "总结",
-                                        "text_element_style": {
-                                            "bold": True,
-                                            "inline_code": False,
-                                            "italic": False,
-                                            "strikethrough": False,
-                                            "underline": False
-                                        }
-                                    }
-                                }
-                            ],
-                            "style": {
-                                "align": 1,
-                                "folded": False
-                            }
-                        },
-                    },
-
-                ],
-            }
-
-            # 添加总结内容block
-            seqs = summary_data.strip().split("\n")
-            for item in seqs:
-                if not item.strip():
-                    continue
-                if item.startswith("- "):
-                    if "**" in item:
-                        item_list = item.split("**")
-                        block = {
-                            "block_type": 12,
-                            "bullet": {
-                                "elements": [
-                                    {
-                                        "text_run": {
-                                            "content": item_list[1],
-                                            "text_element_style": {
-                                                "bold": True,
-                                                "inline_code": False,
-                                                "italic": False,
-                                                "strikethrough": False,
-                                                "underline": False
-                                            }
-                                        }
-                                    },
-                                ],
-                                "style": {
-                                    "align": 1,
-                                    "folded": False
-                                }
-                            },
-                        }
-                        if len(item_list) >= 3:
-                            for i in range(2, len(item_list)):
-                                block["bullet"]["elements"].append(
-                                    {
-                                        "text_run": {
-                                            "content": item_list[i],
-                                            "text_element_style": {
-                                                "bold": False,
-                                                "inline_code": False,
-                                                "italic": False,
-                                                "strikethrough": False,
-                                                "underline": False
-                                            }
-                                        }
-                                    }
-                                )
-                    else:
-                        block = {
-                            "block_type": 12,
-                            "bullet": {
-                                "elements": [
-                                    {
-                                        "text_run": {
-                                            "content": item.split("- ")[-1],
-                                            "text_element_style": {
-                                                "bold": False,
-                                                "inline_code": False,
-                                                "italic": False,
-                                                "strikethrough": False,
-                                                "underline": False
-                                            }
-                                        }
-                                    },
-                                ],
-                                "style": {
-                                    "align": 1,
-                                    "folded": False
-                                }
-                            },
-                        },
-
-                    callout_block["children"].append(
-                        block
-                    )
-                else:
-                    callout_block["children"].append(
-                        {
-                            "block_type": 2,
-                            "text": {
-                                "elements": [
-                                    {
-                                        "text_run": {
-                                            "content": item,
-                                            "text_element_style": {
-                                                "bold": False,
-                                                "inline_code": False,
-                                                "italic": False,
-                                                "strikethrough": False,
-                                                "underline": False
-                                            }
-                                        }
-                                    }
-                                ],
-                                "style": {
-                                    "align": 1,
-                                    "folded": False
-                                }
-                            }
-                        }
-                    )
-
-            # 添加参会人block
-            for u in meeting_users:
-                block_body["children"][3]["text"]["elements"].append(
-                    {
-                        "mention_user": {
-                            "text_element_style": {
-                                "bold": False,
-                                "inline_code": False,
-                                "italic": False,
-                                "strikethrough": False,
-                                "underline": False
-                            },
-                            "user_id": u
-                        }
-                    }
-                )
-
-            # 先创建page block下子块
-            block_response = client.create_block(block_body, document_id=document_id, block_id=document_id, headers={"Authorization": "Bearer {}".format(
-                                          user_info['user_access_token']['access_token'])})
-            if block_response.status_code == 200:
-                block_data = block_response.json()
-            else:
-                raise Exception("create block api failed")
-            logging.info(">>> block_data: {}".format(block_data))
-            time.sleep(1)
-
-            # 再创建quote_container_block下子块
-            quote_container_block_id = block_data["data"]["children"][5]["block_id"]
-            quote_container_block_response = client.create_block(quote_container_block, document_id=document_id,
-                                                                 block_id=quote_container_block_id,
-                                                                 headers={"Authorization": "Bearer {}".format(
-                                                                     user_info['user_access_token']['access_token'])})
-            if quote_container_block_response.status_code == 200:
-                quote_container_block_data = quote_container_block_response.json()
-            else:
-                raise Exception("create quote block api failed")
-            logging.info(">>> quote_container_block_data: {}".format(quote_container_block_data))
-            time.sleep(1)
-
-            # 再创建callout_block下子块
-            callout_block_id = block_data["data"]["children"][6]["block_id"]
-            callout_block_response = client.create_block(callout_block, document_id=document_id, block_id=callout_block_id,
-                                                 headers={"Authorization": "Bearer {}".format(
-                                                     user_info['user_access_token']['access_token'])})
-            if callout_block_response.status_code == 200:
-                callout_block_data = callout_block_response.json()
-            else:
-                raise Exception("create callout block api failed")
-            logging.info(">>> callout_block_data: {}".format(callout_block_data))
-        except Exception:
-            logging.error(">>> ERROR: {}".format(str(e)))
-            card_content["elements"][2]["actions"][0]["text"]["content"] = "创建云文档block失败"
-            bot.update_card(message_id, card_content)
-            continue
-
+            card_updater.update(data["message_id"], card_content)
+        except Exception as e:
+            logging.error(">>> ERROR: %s", e)
+    return on_progress
+
+
+@oauth_pipeline.stage("summarize")
+def stage_oauth_summarize(job):
+    data = job.data
+    if "_transcript" not in data:
+        # 妙记全文不落盘，任务恢复后重新获取
+        return "fetch_transcript"
+    transcript = data["_transcript"].finish(int(data["minute"]["duration"] or 0))
+    # 相同文字稿（重复授权、任务重试）直接复用缓存的结果，不再提交总结；全文哈希每个任务只计算一次
+    if SUMMARY_BACKEND == "llm":
+        backend = "llm:{}".format(summarizer.model_name)
+    else:
+        backend = SUMMARY_BACKEND
+    file_obj = transcript.text()
+    if not data.get("summary_key"):
+        data["summary_key"] = summary_cache.key(file_obj, backend, PROMPT_VERSION)
+    summary_key = data["summary_key"]
+    summary_data = summary_cache.get(summary_key, size=len(file_obj.encode("utf-8")))
+    if summary_data:
+        logging.info(">>> summary cache hit: %s", summary_key)
+        data["summary_data"] = summary_data
+        return "create_docx"
+    # file_obj = """
+    # 2024-08-24 15:19:33 CST|45分钟 6秒
+    #
+    # 关键词:
+    # 软件产品设计、用户界面、功能需求、用户体验、性能优化、竞争分析
+    #
+    # 讲话人1
+    # 大家好，今天我们主要讨论新软件产品的设计和功能需求。我先介绍一下我们的目标和方向。这款软件主要面向中小型企业，旨在提供高效的项目管理和团队协作工具。我们需要确保用户界面友好，功能强大且易于使用。
+    #
+    # 讲话人2
+    # 是的，用户界面（UI）和用户体验（UX）的设计非常重要。我建议我们采用现代简洁的设计风格，避免过多的复杂元素。按钮和操作区域需要明显且易于点击，同时确保在不同设备上的兼容性。
+    #
+    # 讲话人3
+    # 在功能方面，我们需要重点关注以下几个模块：项目管理、任务分配、团队沟通和文件共享。每个模块都需要有明确的操作流程，确保用户能够快速上手。此外，我们还需要考虑性能优化，确保在高负载情况下软件运行流畅。
+    #
+    # 讲话人4
+    # 我这里有一些竞争对手的分析数据。我们主要的竞争对手有Trelo、Asana和Monday.com。它们各有优势，但也存在一些不足。我们可以借鉴它们的优点，同时避免它们的缺点。例如，Trelo的界面简洁但功能较少，Asana功能全面但界面复杂。我们需要找到一个平衡点。
+    #
+    # 讲话人5
+    # 在测试方面，我们会分阶段进行功能测试和性能测试。首先是单元测试，确保每个功能模块都能正常运行；然后是集成测试，确保各个模块之间的交互没有问题；最后是性能测试，模拟高并发场景，确保系统的稳定性。
+    #
+    # 讲话人6
+    # 作为客户代表，我想强调用户反馈的重要性。在产品上线之前，我们可以邀请一部分目标用户进行试用，并收集他们的反馈意见。这些反馈可以帮助我们优化产品，提升用户满意度。
+    #
+    # 讲话人1
+    # 非常感谢大家的建议和意见。总结一下，我们需要在接下来的时间内完成以下任务：UI/UX设计师负责界面设计，开发团队负责功能开发和性能优化，测试团队制定测试计划，市场分析师继续进行竞争分析，客户代表准备用户试用计划。我们每周进行一次进度汇报，确保项目按计划推进。
+    #
+    # 讲话人2
+    # 没问题，我会在下周之前提交初步的界面设计稿，供大家评审。
+    #
+    # 讲话人3
+    # 我们会根据设计稿开始功能开发，并与UI/UX设计师保持密切沟通，确保设计与开发同步进行。
+    #
+    # 讲话人4
+    # 我会继续收集和分析竞争对手的动态，并定期汇报给大家。
+    #
+    # 讲话人5
+    # 我们会制定详细的测试计划，并在每个开发阶段进行相应的测试。
+    #
+    # 讲话人6
+    # 我会联系一些潜在用户，邀请他们参与我们的试用计划，并准备收集反馈。
+    #
+    # 讲话人1
+    # 好的，那今天的会议就到这里。谢谢大家的参与和贡献。我们下周同一时间再见。
+    # """
+    if SUMMARY_BACKEND == "llm":
+        # 总结方案1: 通过大模型总结，长会议按讲话人切块后并发总结再合并
         try:
-            # 批量发送总结文档
-            document_url = f"{FEISHU_HOST}/docx/{document_id}"
-            bref_seqs = []
-            bref = ""
-            for item in seqs:
-                if not item.strip():
-                    continue
-                if len(bref_seqs) == 3:
-                    break
-                bref_seqs.append(item)
-                if not bref:
-                    bref = item
-                else:
-                    bref = bref + " \n" + item
-            bref = bref + " \n " + " ..."
-            logging.info(">>> card bref: {}".format(bref))
-            elements = [
-                {
-                    "tag": "note",
-                    "elements": [
-                        {
-                            "tag": "plain_text",
-                            "content": get_gmt_time(start_time, end_time)
-                        }
-                    ]
-                },
-                {
-                    "tag": "markdown",
-                    "content": bref,
-                    "text_align": "left",
-                    "text_size": "normal"
-                },
-                {
-                    "tag": "action",
-                    "actions": [
-                        {
-                            "tag": "button",
-                            "text": {
-                                "tag": "plain_text",
-                                "content": "查看完整会议纪要"
-                            },
-                            "url": document_url,
-                            "type": "primary",
-                            "complex_interaction": True,
-                            "width": "default",
-                            "size": "medium"
-                        }
-                    ]
-                }
-            ]
-            res_card_content = copy.deepcopy(card_content)
-            res_card_content["elements"] = elements
-            batch_url = f"{bot.host}/open-apis/message/v4/batch_send/"
-            meeting_users.remove(open_id)
-            if meeting_users:
-                message_body = {
-                    "open_ids": meeting_users,
-                    # "open_ids": [open_id],
-                    "msg_type": "interactive",
-                    "card": res_card_content
-                }
-                batch_response = bot.post(batch_url, data=json.dumps(message_body)).json()
-                # print(">>> batch_response: ", batch_response)
-                logging.info(">>> batch_response: {}".format(batch_response))
-        except Exception:
-            logging.error(">>> ERROR: {}".format(str(e)))
-            card_content["elements"][2]["actions"][0]["text"]["content"] = "批量发送总结文档失败"
-            bot.update_card(message_id, card_content)
-            continue
-
-        bot.update_card(message_id, res_card_content)
-        oauth_queue.task_done()
-threading.Thread(target=oauth_handler, daemon=True).start()
+            on_progress = summary_progress(job) if LLM_STREAMING else None
+            summary_data = summarizer.summarize(transcript, on_progress=on_progress)
+            logging.info(">>> summary_data: %s", payload(summary_data))
+            summary_cache.set(summary_key, summary_data)
+        except Exception as e:
+            logging.error(">>> ERROR: %s", e)
+            return oauth_fail(job, "调用LLM总结失败")
+        data["summary_data"] = summary_data
+        return "create_docx"
+
+    # 总结方案2: 通过调用飞书会议总结api
+    try:
+        bbody = {
+            # 按发言段落和句子提交，带讲话人和时间信息
+            "transcripts": transcript.to_transcripts(),
+            "duration": data["minute"]["duration"],
+            "topic": data["minute"]["title"],
+            "operator_id": data["minute"]["owner_id"],
+        }
+        with stages("summary"):
+            summary_task_resp = client.submit_summary_task(bbody, headers=user_headers(job))
+        if summary_task_resp.status_code == 200:
+            summary_task = summary_task_resp.json()
+            task_id = summary_task["data"]["task_id"]
+        else:
+            raise Exception("submit summary task api failed")
+        logging.info(">>> task_id: %s", task_id)
+    except Exception as e:
+        logging.error(">>> ERROR: %s", e)
+        return oauth_fail(job, "提交会议总结任务失败")
+
+    data["task_id"] = task_id
+    return "wait_summary"
+
+
+def on_summary_response(job, response):
+    # 处理智能总结任务查询结果，同步和异步阶段共用
+    summary = None
+    if response.status_code == 200:
+        task_data = response.json()
+        if "data" in task_data and task_data["code"] == 0:
+            summary = task_data["data"]
+    if not summary:
+        if job.attempt < POLL_COUNT - 1:
+            logging.info(">>> no summary, retry after %s", poll_delay(job))
+            return Retry(poll_delay(job))
+        raise Exception("no summary")
+    logging.info(">>> summary: %s", payload(summary))
+
+    if "paragraph" in summary and "data" in summary["paragraph"]:
+        summary_data = summary["paragraph"]["data"]
+    else:
+        summary_data = ""
+    if not summary_data:
+        return "summary_empty"
+    if job.data.get("summary_key"):
+        summary_cache.set(job.data["summary_key"], summary_data)
+    job.data["summary_data"] = summary_data
+    return "create_docx"
+
+
+def on_summary_error(job, e):
+    logging.error(">>> ERROR: %s", e)
+    return oauth_fail(job, "未查询到智能总结结果")
+
+
+@oauth_pipeline.stage("wait_summary")
+def stage_oauth_wait_summary(job):
+    try:
+        # 获取智能会议总结结果，未完成时挂起任务等待下次轮询
+        logging.info(">>> time %s", job.attempt + 1)
+        with stages("summary"):
+            get_task_response = client.get_summary_task(job.data["task_id"], headers=user_headers(job))
+        return on_summary_response(job, get_task_response)
+    except Exception as e:
+        return on_summary_error(job, e)
+
+
+@oauth_pipeline.async_stage("wait_summary")
+async def async_stage_oauth_wait_summary(job):
+    try:
+        logging.info(">>> time %s", job.attempt + 1)
+        get_task_response = await async_client.get_summary_task(job.data["task_id"], headers=user_headers(job))
+        return await asyncio.to_thread(on_summary_response, job, get_task_response)
+    except Exception as e:
+        return await asyncio.to_thread(on_summary_error, job, e)
+
+
+@oauth_pipeline.stage("summary_empty")
+def stage_oauth_summary_empty(job):
+    return oauth_fail(job, "录制内容太短，未生成总结")
+
+
+@oauth_pipeline.stage("create_docx")
+def stage_oauth_create_docx(job):
+    data = job.data
+    try:
+        # 创建云文档
+        docx_body = {
+            "title": data["meeting_topic"] + " - 智能会议纪要",
+        }
+        with stages("docx"):
+            docx_response = client.create_docx(docx_body, headers=user_headers(job))
+        if docx_response.status_code == 200:
+            docx_data = docx_response.json()
+            document_id = docx_data["data"]["document"]["document_id"]
+        else:
+            raise Exception("create docx api failed")
+        logging.info(">>> document_id: %s", document_id)
+    except Exception as e:
+        logging.error(">>> ERROR: %s", e)
+        return oauth_fail(job, "创建云文档失败")
+
+    data["document_id"] = document_id
+    return "create_blocks"
+
+
+@oauth_pipeline.stage("create_blocks")
+def stage_oauth_create_blocks(job):
+    data = job.data
+    document_id = data["document_id"]
+    summary_data = data["summary_data"]
+    participants = data.get("participants") or [{"open_id": user} for user in data["meeting_users"]]
+    start_time = data["start_time"]
+    end_time = data["end_time"]
+    try:
+        # 在内存中组装完整的块树后一次写入，quote_container和callout的子块作为嵌套块一起创建
+        page = document_page(data["meeting_topic"], start_time, end_time, participants, summary_data)
+        with stages("docx"):
+            calls = document_writer.write(document_id, page, headers=user_headers(job))
+        logging.info(">>> document blocks: %s blocks, %s calls", sum(b.size() for b in page), calls)
+    except Exception as e:
+        logging.error(">>> ERROR: %s", e)
+        return oauth_fail(job, "创建云文档block失败")
+    return "notify"
+
+
+@oauth_pipeline.stage("notify")
+def stage_oauth_notify(job):
+    data = job.data
+    card_content = data["card_content"]
+    meeting_users = list(data["meeting_users"])
+    open_id = data["open_id"]
+    start_time = data["start_time"]
+    end_time = data["end_time"]
+    try:
+        # 批量发送总结文档
+        document_url = f"{FEISHU_HOST}/docx/{data['document_id']}"
+        res_card_content = summary_card(card_content, data["summary_data"], document_url, start_time, end_time)
+        logging.info(">>> card bref: %s", payload(res_card_content["elements"][1]["content"]))
+        # 发起人通过更新原卡片获取结果，其余参会人分批并发发送
+        recipients = [user for user in meeting_users if user != open_id]
+        if recipients:
+            result = notifier.send_card(recipients, res_card_content)
+            logging.info(">>> batch send: %d sent, %d invalid, %d failed",
+                         len(result["sent"]), len(result["invalid"]), len(result["failed"]))
+            if result["failed"] and not result["sent"]:
+                raise Exception("batch send failed")
+    except Exception as e:
+        logging.error(">>> ERROR: %s", e)
+        return oauth_fail(job, "批量发送总结文档失败")
+
+    card_updater.update(data["message_id"], res_card_content, final=True)
+    return None
+
+
+oauth_workers = create_workers("oauth", oauth_pipeline, oauth_queue, OAUTH_WORKERS)
+worker_pools = (meeting_workers, oauth_workers)
+gauge("worker_queue_depth", "Jobs waiting for a free worker.", ("pool",),
+      func=lambda: {(pool.name,): pool.stats()["pending"] for pool in worker_pools})
+gauge("worker_busy", "Jobs currently being executed.", ("pool",),
+      func=lambda: {(pool.name,): pool.stats()["busy"] for pool in worker_pools})
+gauge("worker_utilisation", "Busy workers divided by pool size.", ("pool",),
+      func=lambda: {(pool.name,): pool.stats()["busy"] / pool.stats()["workers"] for pool in worker_pools})
+
+http_pools = {"sync": http_pool}
+if async_client:
+    http_pools["async"] = async_client.pool
+gauge("http_pool_in_flight", "Feishu requests currently holding a pooled connection.", ("pool",),
+      func=lambda: {(name,): pool.stats()["in_flight"] for name, pool in http_pools.items()})
+gauge("http_pool_utilisation", "In-flight requests divided by the connection limit.", ("pool",),
+      func=lambda: {(name,): pool.stats()["utilisation"] for name, pool in http_pools.items()})
+gauge("http_pool_peak", "Highest number of concurrent in-flight requests.", ("pool",),
+      func=lambda: {(name,): pool.stats()["peak"] for name, pool in http_pools.items()})
+counter("http_pool_requests_total", "Requests sent through the connection pool.", ("pool",),
+        func=lambda: {(name,): pool.stats()["requests"] for name, pool in http_pools.items()})
+gauge("feishu_rate_limit", "Current token bucket rate (requests/s), halved after a 429.", ("endpoint",),
+      func=lambda: {(name,): item["rate"] for name, item in rate_limiter.stats().items()})
+
+# 去重和查询缓存：event_dedup的命中即重复事件
+ttl_caches = {
+    "event_dedup": event_dedup,
+    "recording_ready": recording_ready,
+    "users": participant_resolver.users,
+    "meetings": participant_resolver.meetings,
+}
+counter("cache_hits_total", "Cache lookups that found a live entry.", ("cache",),
+        func=lambda: {(name,): cache.stats()["hits"] for name, cache in ttl_caches.items()})
+counter("cache_misses_total", "Cache lookups that found no live entry.", ("cache",),
+        func=lambda: {(name,): cache.stats()["misses"] for name, cache in ttl_caches.items()})
+gauge("cache_entries", "Entries currently held by the cache.", ("cache",),
+      func=lambda: {(name,): cache.stats()["size"] for name, cache in ttl_caches.items()})
+counter("summary_cache_hits_total", "Summaries served from the summary cache.",
+        func=lambda: {(): summary_cache.stats()["hits"]})
+counter("summary_cache_misses_total", "Summary cache lookups that had to generate a summary.",
+        func=lambda: {(): summary_cache.stats()["misses"]})
+gauge("summary_cache_hit_ratio", "Summary cache hits divided by lookups.",
+      func=lambda: {(): summary_cache.stats()["hit_ratio"]})
+counter("summary_cache_saved_bytes_total", "Transcript bytes not sent to the summary backend thanks to the cache.",
+        func=lambda: {(): summary_cache.stats()["bytes_saved"]})
+
+counter("llm_requests_total", "LLM calls by model.", ("model",),
+        func=lambda: {(name,): item["requests"] for name, item in chat_pool.stats().items()})
+counter("llm_errors_total", "Failed LLM calls by model.", ("model",),
+        func=lambda: {(name,): item["errors"] for name, item in chat_pool.stats().items()})
+counter("llm_request_seconds_total", "Total time spent in LLM calls by model.", ("model",),
+        func=lambda: {(name,): item["latency_total"] for name, item in chat_pool.stats().items()})
+gauge("llm_in_flight", "LLM calls currently running by model.", ("model",),
+      func=lambda: {(name,): item["in_flight"] for name, item in chat_pool.stats().items()})
+
+counter("card_updates_total", "Card updates requested, actually sent, and superseded by a newer update.", ("result",),
+        func=lambda: {(name,): card_updater.stats()[name] for name in ("requested", "sent", "superseded")})
+counter("notify_messages_total", "Summary notifications by result.", ("result",),
+        func=lambda: {(name,): notifier.stats()[name] for name in ("requests", "sent", "invalid", "failed")})
 
 
 @hook.on_bot_message(bot=bot, event_type="vc.meeting.all_meeting_ended_v1")
 def on_event_meeting_listen(bot, event_id, event, *args, **kwargs):
-    meeting_queue.put((event_id, event, bot))
+    if not event_dedup.add("event:{}".format(event_id)):
+        logging.info(">>> duplicate event: %s", event_id)
+        return
+    with start_span("meeting.event", event_id=event_id) as span:
+        meeting_workers.put(meeting_pipeline.new_job({"event_id": event_id, "event": event,
+                                                      "traceparent": span.traceparent}))
+
+
+@hook.on_bot_message(bot=bot, event_type="vc.meeting.recording_ready_v1")
+def on_event_recording_ready(bot, event_id, event, *args, **kwargs):
+    # 录制文件生成后唤醒等待该会议录制的任务
+    meeting_id = event["meeting"]["id"]
+    recording_ready.set(meeting_id, event["url"])
+    logging.info(">>> recording ready: %s %s", meeting_id, event["url"])
+    meeting_workers.wake(record_key(meeting_id))
 
 
 @oauth.on_bot_event(event_type="oauth:user_info", bot=bot)
 def on_oauth_user_info(bot, event_id, user_info, *args, **kwargs):
-    oauth_queue.put((bot, user_info))
+    state_dict = json.loads(user_info["state_dict"])
+    if not event_dedup.add(oauth_dedup_key(state_dict["meeting_id"], user_info["open_id"])):
+        logging.info(">>> duplicate oauth: %s %s", state_dict["meeting_id"], user_info["open_id"])
+        return
+    with start_span("oauth.callback", parent=state_dict.get("traceparent"), event_id=event_id) as span:
+        oauth_workers.put(oauth_pipeline.new_job({"event_id": event_id, "user_info": user_info,
+                                                  "traceparent": span.traceparent}))
 
 
 @hook.on_bot_message(message_type="text", bot=bot)
@@ -903,63 +858,14 @@ def on_text_message(bot, message_id, content, *args, **kwargs):
     bot.reply_text(message_id, "reply: " + text)
 
 
-def get_gmt_time(start_ts, end_ts):
-    # 将时间戳转换为datetime对象
-    start_dt_object = datetime.datetime.fromtimestamp(int(start_ts), tz=datetime.timezone(datetime.timedelta(hours=8)))
-    end_dt_object = datetime.datetime.fromtimestamp(int(end_ts), tz=datetime.timezone(datetime.timedelta(hours=8)))
-
-    # 映射星期几的英文缩写到中文
-    weekdays = ["周一", "周二", "周三", "周四", "周五", "周六", "周日"]
-    weekday_chinese = weekdays[start_dt_object.weekday()]
-
-    start_time_str = start_dt_object.strftime('%m月%d号（{}） %H:%M'.format(weekday_chinese))
-    end_time_str = end_dt_object.strftime('%H:%M')
-
-    # 将datetime对象格式化为GMT字符串时间
-    result_str = f"{start_time_str} - {end_time_str} GMT+08"
-    return result_str
-
-
-def llm_model(input, model_name="gpt-4o-mini"):
-    if "claude-3" in model_name:
-        model_config = {
-            "temperature": 0.7,
-            "model_name": model_name,
-            "streaming": False,
-            "anthropic_api_key": ANTHROPIC_API_KEY,
-            # default="https://api.anthropic.com",
-            "anthropic_api_url": ANTHROPIC_API_BASE,
-            "max_retries": 3
-        }
-        chat = ChatAnthropic(**model_config)
-    else:
-        model_config = {
-            "temperature": 0.7,
-            "model_name": model_name,
-            "streaming": False,
-            "openai_api_key": OPENAI_API_KEY,
-            "openai_api_base": OPENAI_API_BASE,
-            "max_retries": 3
-        }
-        chat = ChatOpenAI(**model_config)
-    metting_prompt = """我们来玩游戏。 你将扮演 MeetingGPT，一个帮助人们整理会议纪要的中文人工智能。
-    该 AI 旨在将用户输入的录音文字稿整理成逻辑清晰、结构清楚的会议纪要，它知道如何将每条信息放入笔记中对应的位置，尽管同一主题的信息可能散落在文字稿中不同的位置。
-    最重要的游戏规则：
-    （1）永远不要解释你自己，只要给我所要求的输出即可。 如果我要求你在“xx”之间显示一些东西，你会完全按照我的要求显示它。
-    （2）输出格式：第一行为类似'会议讨论了xxx，主要内容包括：'格式的总结内容，后续每一行都是总结的要点，所有要点都以bulletpoint的形式输出，一个bulletpoint下不可以有sub bulletpoint。
-    （3）每一个bulletpoint句末不要有标点，每一个bulletpoint的格式类似为'- **title**：content'
-    （4）以中文输出
-    我将把会议的录音文字稿发给你，你会按照要求输出整理完成的中文会议纪要。"""
-    system_message = [SystemMessage(content=metting_prompt)]
-
-    # 不需要上下文
-    messages = system_message + [HumanMessage(content=input)]
-    return chat.invoke(messages).content
-
-
 app = oauth.get_app()
 app.register_blueprint(hook.get_blueprint())
 
 
+@app.route("/metrics")
+def metrics():
+    return REGISTRY.render(), 200, {"Content-Type": "text/plain; version=0.0.4; charset=utf-8"}
+
+
 if __name__ == "__main__":
     app.run(host="0.0.0.0", port=8888)
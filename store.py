@@ -0,0 +1,104 @@
+import json
+import time
+import sqlite3
+import logging
+import threading
+
+from worker import Job
+
+
+class JobStore(object):
+    # 持久化任务状态，写入先合并到内存，由后台线程批量提交
+    # job.data中以"_"开头的字段为临时数据（如妙记文字记录），不落盘，恢复后由对应阶段重新获取；
+    # redact中的字段（如用户凭证）只在任务执行期间保存，任务结束时删除
+    def __init__(self, path, flush_interval=0.2, redact=()):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.redact = tuple(redact)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS jobs (
+                job_id TEXT PRIMARY KEY,
+                kind TEXT NOT NULL,
+                stage TEXT,
+                attempt INTEGER NOT NULL DEFAULT 0,
+                next_run REAL NOT NULL DEFAULT 0,
+                deadline REAL,
+                status TEXT NOT NULL,
+                data TEXT NOT NULL,
+                updated REAL NOT NULL,
+                wake_key TEXT
+            )
+        """)
+        # 旧版本创建的表没有wake_key列
+        columns = [row[1] for row in self._conn.execute("PRAGMA table_info(jobs)")]
+        if "wake_key" not in columns:
+            self._conn.execute("ALTER TABLE jobs ADD COLUMN wake_key TEXT")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, kind)")
+        self._conn.commit()
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._db_lock = threading.Lock()
+        self._thread = threading.Thread(target=self._run, name="job-store", daemon=True)
+        self._thread.start()
+
+    def save(self, job, next_run=None, status="pending", wake_key=None):
+        # wake_key为挂起任务的唤醒key，恢复后仍可通过wake(key)提前执行
+        redact = self.redact if status != "pending" else ()
+        data = json.dumps({k: v for k, v in job.data.items() if not k.startswith("_") and k not in redact},
+                          ensure_ascii=False)
+        row = (job.job_id, job.kind, job.stage, job.attempt, next_run or 0, job.deadline, status, data, time.time(),
+               wake_key)
+        with self._lock:
+            # 同一任务在一个批次内只保留最新状态
+            self._pending[job.job_id] = row
+
+    def finish(self, job, status="done"):
+        self.save(job, status=status)
+
+    def load(self, kind):
+        # 读取未完成的任务，用于重启后恢复
+        self.flush()
+        with self._db_lock:
+            rows = self._conn.execute(
+                "SELECT job_id, kind, stage, attempt, next_run, deadline, data, wake_key FROM jobs "
+                "WHERE status = 'pending' AND kind = ? ORDER BY next_run", (kind,)).fetchall()
+        jobs = []
+        for job_id, kind, stage, attempt, next_run, deadline, data, wake_key in rows:
+            job = Job(kind, json.loads(data), stage=stage, attempt=attempt, job_id=job_id, deadline=deadline)
+            jobs.append((job, next_run, wake_key))
+        return jobs
+
+    def purge(self, before):
+        # 清理已结束的历史任务
+        self.flush()
+        with self._db_lock:
+            self._conn.execute("DELETE FROM jobs WHERE status != 'pending' AND updated < ?", (before,))
+            self._conn.commit()
+
+    def flush(self):
+        with self._lock:
+            rows = list(self._pending.values())
+            self._pending = {}
+        if not rows:
+            return
+        try:
+            with self._db_lock:
+                self._conn.executemany("INSERT OR REPLACE INTO jobs VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+                self._conn.commit()
+        except Exception:
+            # 提交失败时放回未被更新覆盖的记录，等待下次重试
+            with self._lock:
+                for row in rows:
+                    self._pending.setdefault(row[0], row)
+            raise
+
+    def _run(self):
+        while True:
+            time.sleep(self.flush_interval)
+            try:
+                self.flush()
+            except Exception:
+                logging.exception(">>> job store flush failed")
@@ -0,0 +1,204 @@
+import os
+import json
+import time
+import queue
+import random
+import logging
+import threading
+import contextvars
+from contextlib import contextmanager
+
+import httpx
+
+# 当前线程/协程中正在执行的span
+_current = contextvars.ContextVar("span", default=None)
+
+
+class Span(object):
+    __slots__ = ("name", "trace_id", "span_id", "parent_id", "start", "end", "attributes", "error")
+
+    def __init__(self, name, trace_id, parent_id=None, attributes=None):
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = "{:016x}".format(random.getrandbits(64))
+        self.parent_id = parent_id
+        self.start = time.time_ns()
+        self.end = None
+        self.attributes = attributes or {}
+        self.error = None
+
+    @property
+    def traceparent(self):
+        return "00-{}-{}-01".format(self.trace_id, self.span_id)
+
+    def set(self, key, value):
+        self.attributes[key] = value
+
+    def to_dict(self):
+        return {
+            "name": self.name,
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "start": self.start,
+            "end": self.end,
+            "duration_ms": (self.end - self.start) / 1e6 if self.end else None,
+            "attributes": self.attributes,
+            "error": self.error,
+        }
+
+
+def parse_traceparent(traceparent):
+    # W3C traceparent: 00-<trace_id>-<parent_id>-<flags>，格式不对时返回(None, None)
+    parts = (traceparent or "").split("-")
+    if len(parts) != 4 or len(parts[1]) != 32 or len(parts[2]) != 16:
+        return None, None
+    return parts[1], parts[2]
+
+
+def current_span():
+    return _current.get()
+
+
+def current_traceparent():
+    span = _current.get()
+    return span.traceparent if span is not None else None
+
+
+@contextmanager
+def start_span(name, parent=None, **attributes):
+    # parent为traceparent字符串，跨队列、跨进程传递时使用；不指定时以当前span为父span，都没有时开始新的trace
+    trace_id, parent_id = parse_traceparent(parent)
+    if trace_id is None:
+        current = _current.get()
+        if current is not None:
+            trace_id, parent_id = current.trace_id, current.span_id
+        else:
+            trace_id = "{:032x}".format(random.getrandbits(128))
+    span = Span(name, trace_id, parent_id, attributes)
+    token = _current.set(span)
+    try:
+        yield span
+    except BaseException as e:
+        span.error = "{}: {}".format(type(e).__name__, e)
+        raise
+    finally:
+        _current.reset(token)
+        span.end = time.time_ns()
+        _tracer.export(span)
+
+
+def bind(func):
+    # 在线程池中执行时沿用提交时的span上下文
+    context = contextvars.copy_context()
+
+    def wrapper(*args, **kwargs):
+        return context.copy().run(func, *args, **kwargs)
+    return wrapper
+
+
+class FileExporter(object):
+    # 每个span一行json，便于用jq按trace_id过滤
+    def __init__(self, path):
+        self.path = path
+
+    def export(self, spans):
+        with open(self.path, "a", encoding="utf-8") as f:
+            for span in spans:
+                f.write(json.dumps(span.to_dict(), ensure_ascii=False) + "\n")
+
+
+class OtlpExporter(object):
+    # 以OTLP/HTTP JSON格式发送到collector，如http://localhost:4318/v1/traces
+    def __init__(self, endpoint, service_name="feishu-ai-robot-meetingsummary", timeout=5):
+        self.endpoint = endpoint
+        self.service_name = service_name
+        self.client = httpx.Client(timeout=timeout)
+
+    @staticmethod
+    def _attributes(attributes):
+        result = []
+        for key, value in attributes.items():
+            if isinstance(value, bool):
+                typed = {"boolValue": value}
+            elif isinstance(value, int):
+                typed = {"intValue": str(value)}
+            elif isinstance(value, float):
+                typed = {"doubleValue": value}
+            else:
+                typed = {"stringValue": str(value)}
+            result.append({"key": key, "value": typed})
+        return result
+
+    def export(self, spans):
+        body = {"resourceSpans": [{
+            "resource": {"attributes": self._attributes({"service.name": self.service_name})},
+            "scopeSpans": [{
+                "scope": {"name": "tracing"},
+                "spans": [{
+                    "traceId": span.trace_id,
+                    "spanId": span.span_id,
+                    "parentSpanId": span.parent_id or "",
+                    "name": span.name,
+                    "kind": 1,
+                    "startTimeUnixNano": str(span.start),
+                    "endTimeUnixNano": str(span.end),
+                    "attributes": self._attributes(span.attributes),
+                    "status": {"code": 2, "message": span.error} if span.error else {"code": 1},
+                } for span in spans],
+            }],
+        }]}
+        self.client.post(self.endpoint, json=body).raise_for_status()
+
+
+class Tracer(object):
+    # 结束的span先进入队列，由后台线程批量导出，不阻塞业务线程；队列满时丢弃
+    def __init__(self, exporter=None, batch_size=256, flush_interval=1.0, max_queue=10000):
+        self.exporter = exporter
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.dropped = 0
+        self._queue = queue.Queue(max_queue)
+        self._thread = None
+        if exporter is not None:
+            self._thread = threading.Thread(target=self._run, name="tracer", daemon=True)
+            self._thread.start()
+
+    def export(self, span):
+        if self.exporter is None:
+            return
+        try:
+            self._queue.put_nowait(span)
+        except queue.Full:
+            self.dropped += 1
+
+    def _run(self):
+        while True:
+            spans = []
+            try:
+                spans.append(self._queue.get(timeout=self.flush_interval))
+                while len(spans) < self.batch_size:
+                    spans.append(self._queue.get_nowait())
+            except queue.Empty:
+                pass
+            if not spans:
+                continue
+            try:
+                self.exporter.export(spans)
+            except Exception:
+                logging.exception(">>> trace export failed")
+
+
+_tracer = Tracer()
+
+
+def configure_tracing(exporter=None, path="traces.jsonl", endpoint=None, service_name=None):
+    # exporter为file、otlp或空（不导出）
+    global _tracer
+    if exporter == "file":
+        _tracer = Tracer(FileExporter(os.path.abspath(path)))
+    elif exporter == "otlp":
+        _tracer = Tracer(OtlpExporter(endpoint, service_name=service_name or "feishu-ai-robot-meetingsummary"))
+    else:
+        _tracer = Tracer()
+    return _tracer
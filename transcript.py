@@ -0,0 +1,239 @@
+import re
+from array import array
+
+# 讲话人行末尾可带时间戳，如"讲话人1 01:02:03"或"讲话人1 02:03"
+SPEAKER_TIME = re.compile(r"^(.*?)\s+(?:(\d{1,2}):)?(\d{1,2}):(\d{2})$")
+# 首行时长，如"45分钟 6秒"、"1小时 2分钟 3秒"
+DURATION = re.compile(r"(?:(\d+)\s*小时)?\s*(?:(\d+)\s*分钟)?\s*(?:(\d+)\s*秒)?\s*$")
+# 句子结束标点，标点保留在句尾
+SENTENCE_END = re.compile(r"[。！？!?；;…]+|\.(?=\s|$)|\n+")
+
+
+def parse_duration(header):
+    # 从首行"时间|时长"中解析时长，返回毫秒，解析失败返回0
+    if "|" not in header:
+        return 0
+    match = DURATION.search(header.split("|", 1)[1])
+    if not match:
+        return 0
+    hours, minutes, seconds = (int(i or 0) for i in match.groups())
+    return ((hours * 60 + minutes) * 60 + seconds) * 1000
+
+
+class Paragraph(object):
+    __slots__ = ("paragraph_id", "speaker", "start_ms", "end_ms", "sentences")
+
+    def __init__(self, paragraph_id, speaker, start_ms, end_ms, sentences):
+        self.paragraph_id = paragraph_id
+        self.speaker = speaker
+        self.start_ms = start_ms
+        self.end_ms = end_ms
+        self.sentences = sentences
+
+
+class Sentence(object):
+    __slots__ = ("sentence_id", "content", "start_ms", "stop_ms")
+
+    def __init__(self, sentence_id, content, start_ms, stop_ms):
+        self.sentence_id = sentence_id
+        self.content = content
+        self.start_ms = start_ms
+        self.stop_ms = stop_ms
+
+
+class Transcript(object):
+    # 紧凑的妙记文字记录：讲话人去重存储，每段发言只保存讲话人下标、起止时间和文本，
+    # 句子只记录在段落文本中的结束位置，Paragraph/Sentence对象在遍历时按需生成
+    __slots__ = ("header", "keywords", "duration_ms", "timed", "speakers", "turn_speakers", "turn_texts",
+                 "turn_start_ms", "turn_end_ms", "turn_sentences", "sentence_ends", "_speaker_index")
+
+    def __init__(self):
+        self.header = ""
+        self.keywords = ""
+        self.duration_ms = 0
+        # 导出文本中是否带有时间戳，None表示尚未判断
+        self.timed = None
+        self.speakers = []
+        self.turn_speakers = array("I")
+        self.turn_texts = []
+        # 未知时间记为-1，在finish中按字数补全
+        self.turn_start_ms = array("q")
+        self.turn_end_ms = array("q")
+        # 第i段的句子为sentence_ends[turn_sentences[i]:turn_sentences[i + 1]]
+        self.turn_sentences = array("I", [0])
+        self.sentence_ends = array("I")
+        self._speaker_index = {}
+
+    def __len__(self):
+        return len(self.turn_texts)
+
+    def __iter__(self):
+        speakers = self.speakers
+        for speaker, text in zip(self.turn_speakers, self.turn_texts):
+            yield speakers[speaker], text
+
+    def add_turn(self, speaker, text, start_ms=-1):
+        index = self._speaker_index.get(speaker)
+        if index is None:
+            index = self._speaker_index[speaker] = len(self.speakers)
+            self.speakers.append(speaker)
+        self.turn_speakers.append(index)
+        self.turn_texts.append(text)
+        self.turn_start_ms.append(start_ms)
+        self.turn_end_ms.append(-1)
+        self._split_sentences(text)
+
+    def append_text(self, text):
+        # 没有讲话人的孤立文本归入上一段发言
+        self.turn_texts[-1] += "\n" + text
+        del self.sentence_ends[self.turn_sentences[-2]:]
+        self.turn_sentences.pop()
+        self._split_sentences(self.turn_texts[-1])
+
+    def _split_sentences(self, text):
+        start = 0
+        for match in SENTENCE_END.finditer(text):
+            end = match.end()
+            if text[start:end].strip():
+                self.sentence_ends.append(end)
+            start = end
+        if text[start:].strip():
+            self.sentence_ends.append(len(text))
+        self.turn_sentences.append(len(self.sentence_ends))
+
+    def finish(self, duration_ms=0):
+        # 补全段落起止时间：有时间戳的段落以下一段开始作为结束，没有时间戳的按字数比例分配时长，
+        # 可在拿到更准确的时长后再次调用
+        self.duration_ms = int(duration_ms or self.duration_ms or parse_duration(self.header))
+        count = len(self.turn_texts)
+        if not count:
+            return self
+        starts = self.turn_start_ms
+        if self.timed is None:
+            self.timed = max(starts) >= 0
+        if not self.timed:
+            total = self.char_count() or 1
+            offset = 0
+            for i, text in enumerate(self.turn_texts):
+                starts[i] = offset * self.duration_ms // total
+                offset += len(text)
+        else:
+            last = 0
+            for i in range(count):
+                if starts[i] < 0:
+                    starts[i] = last
+                last = starts[i]
+        for i in range(count - 1):
+            self.turn_end_ms[i] = max(starts[i + 1], starts[i])
+        self.turn_end_ms[count - 1] = max(self.duration_ms, starts[count - 1])
+        return self
+
+    def char_count(self):
+        return sum(len(text) for text in self.turn_texts)
+
+    def text(self):
+        # 还原为"讲话人\n内容"格式的全文，供大模型总结使用
+        return "\n\n".join("{}\n{}".format(speaker, text) for speaker, text in self)
+
+    def paragraphs(self):
+        # 生成段落和句子记录，句子时间按字数在段落内线性分配
+        sentence_id = 0
+        for i, text in enumerate(self.turn_texts):
+            start_ms = self.turn_start_ms[i]
+            end_ms = self.turn_end_ms[i]
+            span = max(end_ms - start_ms, 0)
+            size = len(text) or 1
+            sentences = []
+            begin = 0
+            for end in self.sentence_ends[self.turn_sentences[i]:self.turn_sentences[i + 1]]:
+                sentence_id += 1
+                sentences.append(Sentence(sentence_id, text[begin:end].strip(),
+                                          start_ms + span * begin // size, start_ms + span * end // size))
+                begin = end
+            yield Paragraph(i + 1, self.speakers[self.turn_speakers[i]], start_ms, end_ms, sentences)
+
+    def to_transcripts(self, lang="zh_cn"):
+        # 转换为会议智能总结接口的transcripts字段，讲话人写在每段第一句之前
+        transcripts = []
+        for paragraph in self.paragraphs():
+            sentences = []
+            for sentence in paragraph.sentences:
+                content = sentence.content
+                if not sentences:
+                    content = "{}：{}".format(paragraph.speaker, content)
+                sentences.append({
+                    "sentence_id": sentence.sentence_id,
+                    "content": content,
+                    "lang": lang,
+                    "start_ms": sentence.start_ms,
+                    "stop_ms": sentence.stop_ms,
+                })
+            transcripts.append({
+                "paragraph_id": paragraph.paragraph_id,
+                "start_ms": paragraph.start_ms,
+                "end_ms": paragraph.end_ms,
+                "sentences": sentences,
+            })
+        return transcripts
+
+
+class TranscriptParser(object):
+    # 增量解析妙记导出的txt：首行为时间和时长，其后为关键词块，再之后每段为"讲话人[ 时间]\n内容"，段之间以空行分隔
+    def __init__(self):
+        self.transcript = Transcript()
+        self._buffer = ""
+        self._block = []
+        self._state = "header"
+
+    def feed(self, chunk):
+        if not chunk:
+            return
+        lines = (self._buffer + chunk).split("\n")
+        self._buffer = lines.pop()
+        for line in lines:
+            self._line(line.rstrip("\r"))
+
+    def close(self, duration_ms=0):
+        if self._buffer:
+            self._line(self._buffer.rstrip("\r"))
+            self._buffer = ""
+        self._flush()
+        return self.transcript.finish(duration_ms)
+
+    def _line(self, line):
+        if not line.strip():
+            self._flush()
+            return
+        if self._state == "header":
+            self.transcript.header = line.strip()
+            self._state = "body"
+        elif self._state == "keywords":
+            self.transcript.keywords = line.strip()
+            self._state = "body"
+        elif not self._block and line.startswith("关键词"):
+            keywords = line.split(":", 1)[-1].split("：", 1)[-1].strip()
+            if keywords and keywords != line:
+                self.transcript.keywords = keywords
+            else:
+                self._state = "keywords"
+        else:
+            self._block.append(line)
+
+    def _flush(self):
+        block = self._block
+        if len(block) >= 2:
+            speaker, start_ms = block[0].strip(), -1
+            match = SPEAKER_TIME.match(speaker)
+            if match:
+                hours, minutes, seconds = (int(i or 0) for i in match.groups()[1:])
+                speaker, start_ms = match.group(1), ((hours * 60 + minutes) * 60 + seconds) * 1000
+            self.transcript.add_turn(speaker, "\n".join(block[1:]), start_ms)
+        elif block and len(self.transcript):
+            self.transcript.append_text(block[0])
+        self._block = []
+
+
+def parse_transcript(text, duration_ms=0):
+    parser = TranscriptParser()
+    parser.feed(text)
+    return parser.close(duration_ms)
@@ -0,0 +1,493 @@
+import time
+import uuid
+import heapq
+import asyncio
+import logging
+import itertools
+import threading
+import contextvars
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+from metrics import STAGE_SECONDS, STAGE_TOTAL_SECONDS, STAGE_RETRIES, JOBS
+from tracing import start_span, bind
+from log import log_context
+
+
+class JobTimeout(Exception):
+    pass
+
+
+# 当前任务的截止时间；使用contextvars，tracing.bind提交到线程池的调用（如大模型分段总结）同样可以读取
+_deadline = contextvars.ContextVar("deadline", default=None)
+
+
+def remaining_time():
+    # 当前任务剩余可执行时间，None表示不限制
+    deadline = _deadline.get()
+    if deadline is None:
+        return None
+    return max(deadline - time.time(), 0)
+
+
+def check_deadline():
+    # 任务超时后在下一个检查点抛出JobTimeout
+    left = remaining_time()
+    if left is not None and left <= 0:
+        raise JobTimeout("job timeout")
+
+
+def run_with_deadline(func, job):
+    # 在线程中执行阶段函数，并为当前上下文设置任务截止时间
+    token = _deadline.set(job.deadline)
+    try:
+        return func(job)
+    finally:
+        _deadline.reset(token)
+
+
+class StageLimiter(object):
+    def __init__(self, limits=None):
+        # 每个阶段的最大并发数，未配置的阶段不限制
+        self.limits = dict(limits or {})
+        self.semaphores = {name: threading.BoundedSemaphore(n) for name, n in self.limits.items() if n > 0}
+
+    @contextmanager
+    def __call__(self, name):
+        check_deadline()
+        semaphore = self.semaphores.get(name)
+        if semaphore is None:
+            yield
+            return
+        if not semaphore.acquire(timeout=remaining_time()):
+            raise JobTimeout("stage {} timeout".format(name))
+        try:
+            yield
+        finally:
+            semaphore.release()
+
+
+class Retry(object):
+    def __init__(self, delay, key=None):
+        # 阶段未完成，delay秒后重新执行当前阶段；指定key时可通过wake(key)提前唤醒
+        self.delay = delay
+        self.key = key
+
+
+def trace_result(result):
+    if isinstance(result, Retry):
+        return "retry:{}".format(result.delay)
+    return result or "end"
+
+
+class Job(object):
+    def __init__(self, kind, data, stage=None, attempt=0, job_id=None, deadline=None, stage_started=None):
+        self.job_id = job_id or uuid.uuid4().hex
+        self.kind = kind
+        self.data = data
+        self.stage = stage
+        self.attempt = attempt
+        self.deadline = deadline
+        # 进入当前阶段的时间，随sqlite、redis队列中的任务保存，挂起等待的时间计入阶段总耗时
+        self.stage_started = stage_started or time.time()
+
+    def __repr__(self):
+        return "<Job {} {} stage={} attempt={}>".format(self.kind, self.job_id, self.stage, self.attempt)
+
+
+class Pipeline(object):
+    def __init__(self, name, first, store=None):
+        self.name = name
+        self.first = first
+        self.store = store
+        self.stages = {}
+        self.async_stages = {}
+        self.failure_hooks = []
+
+    def stage(self, name):
+        def decorator(func):
+            self.stages[name] = func
+            return func
+        return decorator
+
+    def async_stage(self, name):
+        # 注册阶段的协程版本，异步流水线优先使用，未注册的阶段在线程池中执行同步版本
+        def decorator(func):
+            self.async_stages[name] = func
+            return func
+        return decorator
+
+    def on_failure(self, func):
+        # 任务因异常或超时结束时调用，用于释放任务占用的资源
+        self.failure_hooks.append(func)
+        return func
+
+    def new_job(self, data):
+        return Job(self.name, data, stage=self.first)
+
+    def _advance(self, job, result):
+        # 记录阶段结果，返回Retry时任务挂起等待重试
+        if isinstance(result, Retry):
+            STAGE_RETRIES.inc(self.name, job.stage)
+            job.attempt += 1
+            if self.store:
+                self.store.save(job, next_run=time.time() + result.delay, wake_key=result.key)
+            return result
+        logging.info(">>> %s %s: %s -> %s", self.name, job.job_id, job.stage, result)
+        now = time.time()
+        STAGE_TOTAL_SECONDS.observe(now - job.stage_started, self.name, job.stage)
+        job.stage_started = now
+        job.stage = result
+        job.attempt = 0
+        if self.store and job.stage:
+            self.store.save(job)
+        return None
+
+    def _fail(self, job):
+        JOBS.inc(self.name, "failed")
+        if self.store:
+            self.store.finish(job, status="failed")
+        for hook in self.failure_hooks:
+            try:
+                hook(job)
+            except Exception:
+                logging.exception(">>> %s failure hook failed: %r", self.name, job)
+
+    def _finish(self, job):
+        JOBS.inc(self.name, "done")
+        if self.store:
+            self.store.finish(job)
+
+    def _run_stage(self, job):
+        stage = job.stage
+        start = time.perf_counter()
+        with self._span(job) as span:
+            try:
+                result = self.stages[stage](job)
+            finally:
+                STAGE_SECONDS.observe(time.perf_counter() - start, self.name, stage)
+            span.set("result", trace_result(result))
+            return result
+
+    @contextmanager
+    def _span(self, job):
+        # 每次执行阶段（包括每次轮询）为一个span，父span为任务入口处记录的traceparent；
+        # 阶段内的日志附带任务的event_id、meeting_id和阶段名
+        with start_span("{}.{}".format(self.name, job.stage), parent=job.data.get("traceparent"),
+                        job_id=job.job_id, attempt=job.attempt) as span, \
+                log_context(event_id=job.data.get("event_id"), meeting_id=job.data.get("meeting_id"),
+                            job_id=job.job_id, stage=job.stage):
+            yield span
+
+    def run(self, job):
+        # 依次执行阶段，阶段返回下一个阶段名，None表示结束，Retry表示挂起等待重试
+        try:
+            while job.stage:
+                retry = self._advance(job, self._run_stage(job))
+                if retry:
+                    return retry
+        except Exception:
+            self._fail(job)
+            raise
+        self._finish(job)
+
+    async def run_async(self, job, executor=None):
+        loop = asyncio.get_running_loop()
+        try:
+            while job.stage:
+                stage = job.stage
+                func = self.async_stages.get(stage)
+                start = time.perf_counter()
+                with self._span(job) as span:
+                    try:
+                        if func is not None:
+                            timeout = None if job.deadline is None else max(job.deadline - time.time(), 0)
+                            try:
+                                result = await asyncio.wait_for(func(job), timeout)
+                            except asyncio.TimeoutError:
+                                raise JobTimeout("stage {} timeout".format(stage))
+                        else:
+                            result = await loop.run_in_executor(executor, bind(run_with_deadline),
+                                                                self.stages[stage], job)
+                    finally:
+                        STAGE_SECONDS.observe(time.perf_counter() - start, self.name, stage)
+                    span.set("result", trace_result(result))
+                retry = self._advance(job, result)
+                if retry:
+                    return retry
+        except Exception:
+            # 失败回调可能调用飞书接口（如更新卡片），在线程池中执行
+            await loop.run_in_executor(executor, bind(self._fail), job)
+            raise
+        self._finish(job)
+
+
+class EarlyWakes(object):
+    # 没有对应的挂起任务（任务正在执行或尚未挂起）时收到的wake(key)，ttl秒内以该key挂起的任务立即执行；
+    # 不加锁，由调用方在自己的锁内使用
+    def __init__(self, ttl=600):
+        self.ttl = ttl
+        self._keys = OrderedDict()
+
+    def add(self, key):
+        now = time.time()
+        self._keys.pop(key, None)
+        self._keys[key] = now
+        while self._keys:
+            first, when = next(iter(self._keys.items()))
+            if when > now - self.ttl:
+                break
+            del self._keys[first]
+
+    def take(self, key):
+        when = self._keys.pop(key, None)
+        return when is not None and when > time.time() - self.ttl
+
+
+class Scheduler(object):
+    def __init__(self, wake_ttl=600):
+        self._heap = []
+        self._keys = {}
+        self._woken = EarlyWakes(wake_ttl)
+        self._cancelled = 0
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="scheduler", daemon=True)
+        self._thread.start()
+        return self
+
+    def __len__(self):
+        return len(self._heap) - self._cancelled
+
+    def call_later(self, delay, func, *args, key=None):
+        # 延迟执行，回调在调度线程中运行，应尽快返回
+        with self._cond:
+            if key is not None and self._woken.take(key):
+                delay = 0
+            entry = [time.time() + delay, next(self._seq), func, args, key]
+            if key is not None:
+                self._cancel(key)
+                self._keys[key] = entry
+            heapq.heappush(self._heap, entry)
+            self._cond.notify()
+
+    def wake(self, key):
+        # 立即执行key对应的延迟任务；不存在（如任务正在执行）时记录下来，之后以该key调度时立即执行，返回False
+        with self._cond:
+            cancelled = self._cancel(key)
+            if cancelled is None:
+                self._woken.add(key)
+                return False
+            func, args = cancelled
+            heapq.heappush(self._heap, [time.time(), next(self._seq), func, args, None])
+            self._cond.notify()
+            return True
+
+    def _cancel(self, key):
+        # 堆中的记录延迟删除，出堆时跳过；返回被取消任务的(func, args)
+        entry = self._keys.pop(key, None)
+        if entry is None:
+            return None
+        func, args = entry[2], entry[3]
+        entry[2] = None
+        self._cancelled += 1
+        return func, args
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._heap:
+                    self._cond.wait()
+                when = self._heap[0][0]
+                now = time.time()
+                if when > now:
+                    self._cond.wait(when - now)
+                    continue
+                _, _, func, args, key = heapq.heappop(self._heap)
+                if func is None:
+                    self._cancelled -= 1
+                    continue
+                if key is not None:
+                    self._keys.pop(key, None)
+            try:
+                func(*args)
+            except Exception:
+                logging.exception(">>> scheduler callback failed")
+
+
+def settle(jobs, lease, result):
+    # 挂起的任务放回队列，delay秒后重新可见；结束或失败的任务从队列中删除
+    try:
+        if isinstance(result, Retry):
+            jobs.nack(lease, result.delay, key=result.key)
+        else:
+            jobs.ack(lease)
+    except Exception:
+        # 未确认的任务在租约到期后重新执行
+        logging.exception(">>> ack failed: %r", lease)
+
+
+class WorkerPool(object):
+    def __init__(self, name, handler, jobs, workers=1, timeout=None, store=None):
+        self.name = name
+        self.handler = handler
+        self.jobs = jobs
+        self.workers = workers
+        self.timeout = timeout
+        self.store = store
+        self.busy = 0
+        self.threads = []
+        self._lock = threading.Lock()
+
+    def start(self):
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._run, name="{}-{}".format(self.name, i), daemon=True)
+            thread.start()
+            self.threads.append(thread)
+        return self
+
+    def put(self, job):
+        if job.deadline is None and self.timeout:
+            job.deadline = time.time() + self.timeout
+        if self.store:
+            self.store.save(job)
+        self.jobs.put(job)
+
+    def wake(self, key):
+        # 外部事件到达时提前唤醒挂起的任务
+        return self.jobs.wake(key)
+
+    def resume(self):
+        resume(self.name, self.jobs, self.store)
+        return self
+
+    def stats(self):
+        return {
+            "name": self.name,
+            "workers": self.workers,
+            "busy": self.busy,
+            "pending": self.jobs.qsize(),
+            "scheduled": self.jobs.delayed(),
+        }
+
+    def _run(self):
+        while True:
+            lease = take(self.name, self.jobs)
+            job = lease.job
+            with self._lock:
+                self.busy += 1
+            token = _deadline.set(job.deadline)
+            result = None
+            try:
+                result = self.handler(job)
+            except JobTimeout as e:
+                logging.error(">>> %s job timeout: %r %s", self.name, job, e)
+            except Exception:
+                logging.exception(">>> %s job failed: %r", self.name, job)
+            finally:
+                _deadline.reset(token)
+                with self._lock:
+                    self.busy -= 1
+                settle(self.jobs, lease, result)
+
+
+def take(name, jobs):
+    # 队列不可用（如redis断开）时等待后重试，不退出worker线程
+    while True:
+        try:
+            return jobs.get()
+        except Exception:
+            logging.exception(">>> %s queue get failed", name)
+            time.sleep(1)
+
+
+def resume(name, jobs, store):
+    # 重启后恢复未完成的任务，从最后完成的阶段继续执行；
+    # sqlite、redis队列中的任务不随进程退出丢失，不需要恢复
+    if jobs.durable or not store:
+        return
+    now = time.time()
+    loaded = store.load(name)
+    for job, next_run, wake_key in loaded:
+        jobs.put(job, delay=max(next_run - now, 0), key=wake_key)
+    if loaded:
+        logging.info(">>> %s resumed %d jobs", name, len(loaded))
+
+
+def start_event_loop():
+    # 在后台线程中运行事件循环，供异步流水线共享
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, name="event-loop", daemon=True).start()
+    return loop
+
+
+class AsyncWorkerPool(object):
+    # 在事件循环中并发执行流水线任务，挂起的任务留在队列中，不占用协程
+    def __init__(self, name, pipeline, loop, jobs, concurrency=100, executor_workers=4, timeout=None, store=None):
+        self.name = name
+        self.pipeline = pipeline
+        self.loop = loop
+        self.jobs = jobs
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.store = store
+        self.executor = ThreadPoolExecutor(executor_workers, thread_name_prefix=name)
+        self.slots = threading.BoundedSemaphore(concurrency)
+        self.busy = 0
+
+    def start(self):
+        threading.Thread(target=self._feed, name="{}-feeder".format(self.name), daemon=True).start()
+        return self
+
+    def put(self, job):
+        if job.deadline is None and self.timeout:
+            job.deadline = time.time() + self.timeout
+        if self.store:
+            self.store.save(job)
+        self.jobs.put(job)
+
+    def resume(self):
+        resume(self.pipeline.name, self.jobs, self.store)
+        return self
+
+    def stats(self):
+        return {
+            "name": self.name,
+            "workers": self.concurrency,
+            "busy": self.busy,
+            "pending": self.jobs.qsize(),
+            "scheduled": self.jobs.delayed(),
+        }
+
+    def wake(self, key):
+        return self.jobs.wake(key)
+
+    def _feed(self):
+        # 在后台线程中从队列取出任务交给事件循环，同时执行的任务不超过concurrency个
+        while True:
+            self.slots.acquire()
+            lease = take(self.name, self.jobs)
+            self.loop.call_soon_threadsafe(self._spawn, lease)
+
+    def _spawn(self, lease):
+        self.loop.create_task(self._process(lease))
+
+    async def _process(self, lease):
+        job = lease.job
+        self.busy += 1
+        result = None
+        try:
+            result = await self.pipeline.run_async(job, self.executor)
+        except JobTimeout as e:
+            logging.error(">>> %s job timeout: %r %s", self.name, job, e)
+        except Exception:
+            logging.exception(">>> %s job failed: %r", self.name, job)
+        finally:
+            self.busy -= 1
+            # sqlite、redis队列的确认为阻塞调用，在线程池中执行
+            await self.loop.run_in_executor(self.executor, settle, self.jobs, lease, result)
+            self.slots.release()